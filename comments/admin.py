@@ -1,28 +1,162 @@
+import json
+
+from django.conf import settings
 from django.contrib import admin
-from .models import Comment, User, Attachment
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Sum
+from django.db.models.functions import Substr
+from django.utils.functional import cached_property
+
+from . import deadlines, deletion
+from .models import Comment, User, Attachment, ThreadNamespace, MIME_BY_FORMAT
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+        On Postgres, counts come from the planner estimate (EXPLAIN) and only
+        fall back to an exact COUNT(*) when the estimate is small.
+    """
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        connection = connections[qs.db]
+        if connection.vendor != "postgresql":
+            return super().count
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]["Plan"]["Plan Rows"])
+        if estimate < settings.ADMIN_EXACT_COUNT_LIMIT:
+            return super().count
+        return estimate
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+        Changelist that stays flat on multi-million-row tables: estimated
+        counts, index-friendly search (``id`` / exact email / name prefix
+        instead of ``ILIKE '%…%'`` over joins), a column projection and the
+        ``admin`` time budget.
+    """
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # lookup -> predicate on the search term; first match wins.
+    indexed_search = ()
+    # .only() fields for the changelist query.
+    changelist_fields = ()
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term or not self.indexed_search:
+            return queryset, False
+        for lookup, accepts in self.indexed_search:
+            if accepts(term):
+                return queryset.filter(**{lookup: term}), False
+        return queryset.none(), False
+
+    def _is_changelist(self, request):
+        match = request.resolver_match
+        return bool(match and match.url_name and match.url_name.endswith("_changelist"))
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if self.changelist_fields and self._is_changelist(request):
+            qs = qs.only(*self.changelist_fields)
+        return qs
+
+    def changelist_view(self, request, extra_context=None):
+        # Only listing is budgeted: POSTs run actions (hide, purge) with their own transactions.
+        if request.method not in ("GET", "HEAD"):
+            return super().changelist_view(request, extra_context)
+        with deadlines.budget("admin"), deadlines.atomic(self.model):
+            response = super().changelist_view(request, extra_context)
+            # Evaluate the queries while the budget and transaction are active.
+            if hasattr(response, "render"):
+                response.render()
+            return response
+
+
+def _is_id(term):
+    return term.isdigit()
+
+
+def _is_email(term):
+    return "@" in term
+
+
+def _is_text(term):
+    return True
+
+
+class ContentTypeFilter(admin.SimpleListFilter):
+    """Fixed choices instead of SELECT DISTINCT content_type over the table."""
+
+    title = "content type"
+    parameter_name = "content_type"
+
+    def lookups(self, request, model_admin):
+        types = [*MIME_BY_FORMAT.values(), "text/plain; charset=utf-8"]
+        return [(t, t) for t in types]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(content_type=self.value())
+        return queryset
 
 
 @admin.register(User)
-class UserAdmin(admin.ModelAdmin):
+class UserAdmin(LargeTableAdmin):
     list_display = ("id", "name", "email", "home_page", "ip")
     search_fields = ("name", "email")
-    list_filter = ("ip",)
+    search_help_text = "ID, exact email or name prefix."
+    indexed_search = (
+        ("pk", _is_id),
+        ("email", _is_email),
+        ("name__startswith", _is_text),
+    )
+    changelist_fields = ("id", "name", "email", "home_page", "ip")
 
 
 @admin.register(Comment)
-class CommentAdmin(admin.ModelAdmin):
+class CommentAdmin(LargeTableAdmin):
     list_display = (
         "id",
         "author_name",
         "author_email",
         "short_text",
-        "parent",
+        "thread_key",
+        "parent_id",
         "created_at",
+        "deleted_at",
     )
-    list_select_related = ("author", "parent")
-    search_fields = ("author__name", "author__email", "text_raw")
-    list_filter = ("created_at",)
+    list_select_related = ("author",)
+    list_filter = (("deleted_at", admin.EmptyFieldListFilter),)
+    actions = ("hide_with_replies", "restore_with_replies")
+    raw_id_fields = ("author", "parent")
+    search_fields = ("author__name", "author__email")
+    search_help_text = "ID, exact author email or author name prefix."
+    date_hierarchy = "created_at"
     ordering = ("-created_at",)
+    indexed_search = (
+        ("pk", _is_id),
+        ("author__email", _is_email),
+        ("author__name__startswith", _is_text),
+    )
+    changelist_fields = (
+        "id", "thread_key", "parent_id", "created_at", "deleted_at", "author__name", "author__email",
+    )
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if self._is_changelist(request):
+            qs = qs.annotate(text_head=Substr("text_raw", 1, 51))
+        return qs
 
     @admin.display(description="User Name", ordering="author__name")
     def author_name(self, obj: Comment) -> str:
@@ -34,13 +168,85 @@ class CommentAdmin(admin.ModelAdmin):
 
     @admin.display(description="Text")
     def short_text(self, obj: Comment) -> str:
-        txt = obj.text_raw or ""
+        txt = getattr(obj, "text_head", None)
+        if txt is None:
+            txt = obj.text_raw or ""
         return (txt[:50] + "…") if len(txt) > 50 else txt
 
+    # Deletes go through comments/deletion.py: Django's collector would load
+    # every reply of the thread, level by level, to confirm and to delete.
+    def get_deleted_objects(self, objs, request):
+        objs = list(objs)
+        sizes = {obj.pk: deletion.subtree_size(obj.pk) for obj in objs}
+        perms_needed = set() if self.has_delete_permission(request) else {self.opts.verbose_name}
+        return (
+            [f"{obj} (#{obj.pk}) with {sizes[obj.pk] - 1} replies" for obj in objs],
+            {self.opts.verbose_name_plural: sum(sizes.values())},
+            perms_needed,
+            [],
+        )
+
+    def delete_model(self, request, obj):
+        deletion.purge(obj.pk)
+
+    def delete_queryset(self, request, queryset):
+        for pk in queryset.values_list("pk", flat=True):
+            deletion.purge(pk)
+
+    @admin.action(description="Hide selected comments with their replies", permissions=["change"])
+    def hide_with_replies(self, request, queryset):
+        hidden = sum(deletion.hide(pk) for pk in queryset.values_list("pk", flat=True))
+        self.message_user(request, f"Hidden {hidden} comment(s) with their replies.")
+
+    @admin.action(description="Restore selected hidden comments", permissions=["change"])
+    def restore_with_replies(self, request, queryset):
+        restored = sum(deletion.restore(pk) for pk in queryset.values_list("pk", flat=True))
+        self.message_user(request, f"Restored {restored} comment(s) with their replies.")
+
 
 @admin.register(Attachment)
-class AttachmentAdmin(admin.ModelAdmin):
-    list_display = ("id", "comment", "is_image", "content_type", "size", "width", "height", "created_at")
-    list_select_related = ("comment",)
-    search_fields = ("comment__author__name", "comment__text_raw")
-    list_filter = ("is_image", "content_type", "created_at")
+class AttachmentAdmin(LargeTableAdmin):
+    list_display = ("id", "comment_id", "is_image", "content_type", "size", "width", "height", "created_at")
+    raw_id_fields = ("comment",)
+    search_fields = ("id", "comment__id")
+    search_help_text = "Attachment ID or comment ID (c123)."
+    list_filter = ("is_image", ContentTypeFilter)
+    date_hierarchy = "created_at"
+    indexed_search = (
+        ("pk", _is_id),
+    )
+    changelist_fields = (
+        "id", "comment_id", "is_image", "content_type", "size", "width", "height", "created_at",
+    )
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if term[:1] in ("c", "C"):
+            return queryset.filter(comment_id=term[1:]) if term[1:].isdigit() else queryset.none(), False
+        return super().get_search_results(request, queryset, search_term)
+
+
+@admin.register(ThreadNamespace)
+class ThreadNamespaceAdmin(LargeTableAdmin):
+    list_display = ("key", "threads_count", "comments_count", "created_at")
+    search_fields = ("key",)
+    search_help_text = "Section key prefix."
+    ordering = ("key",)
+    indexed_search = (
+        ("key__startswith", _is_text),
+    )
+    readonly_fields = ("threads_count", "comments_count", "created_at")
+
+    def get_queryset(self, request):
+        # Counts are spread over NamespaceCounter stripes.
+        return super().get_queryset(request).annotate(
+            threads=Sum("counters__threads_count"), comments=Sum("counters__comments_count"),
+        )
+
+    @admin.display(description="Threads", ordering="threads")
+    def threads_count(self, obj: ThreadNamespace) -> int:
+        return obj.threads or 0
+
+    @admin.display(description="Comments", ordering="comments")
+    def comments_count(self, obj: ThreadNamespace) -> int:
+        return obj.comments or 0
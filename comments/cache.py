@@ -0,0 +1,220 @@
+"""
+Two-tier cache: a small per-process LRU in front of the shared Django cache.
+
+Keys are namespaced and versioned (``<ns>:v<version>:<key>``); bumping a
+namespace version with :func:`invalidate` drops all its keys at once without
+scanning the backend. Keys can also belong to a ``scope`` (a comment
+section) with a version of its own, so ``invalidate(ns, scope)`` drops only
+that scope's keys. Versions are re-read from the shared tier at most every
+``CACHE_VERSION_TTL`` seconds per process: a local hit costs no round trip,
+and an invalidation in another worker is seen within that time (at once in
+the worker that made it). :func:`get_or_set` is single-flight: one thread per
+process and one process per cluster recompute a missing value, the rest wait
+for it.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import caches
+
+_MISSING = object()
+
+# Per-namespace options. ``local`` — keep a copy in the process LRU; values
+# that must be consumed exactly once belong only in the shared tier.
+NAMESPACES = {
+    "comments": {"local": True, "ttl": 60},
+    "file_urls": {"local": True, "ttl": 3600},
+}
+
+_local = TTLCache(
+    maxsize=getattr(settings, "CACHE_LOCAL_MAXSIZE", 1024),
+    ttl=getattr(settings, "CACHE_LOCAL_TTL", 2),
+)
+_local_lock = threading.Lock()
+_flight_locks: dict[str, threading.Lock] = {}
+_flight_guard = threading.Lock()
+_stats = defaultdict(lambda: {"local_hits": 0, "shared_hits": 0, "misses": 0})
+# Version key -> (version, monotonic time it is re-read after).
+_versions: dict[str, tuple[int, float]] = {}
+
+
+def _shared():
+    return caches[getattr(settings, "CACHE_SHARED_ALIAS", "default")]
+
+
+def _opts(ns):
+    return NAMESPACES.get(ns, {"local": True, "ttl": 60})
+
+
+def _local_get(key):
+    with _local_lock:
+        return _local.get(key, _MISSING)
+
+
+def _local_set(key, value):
+    with _local_lock:
+        _local[key] = value
+
+
+def _local_pop(key):
+    with _local_lock:
+        _local.pop(key, None)
+
+
+def _vkey(ns, scope=None):
+    return f"{ns}:version" if scope is None else f"{ns}:{scope}:version"
+
+
+def _read_version(vkey):
+    now = time.monotonic()
+    cached = _versions.get(vkey)
+    if cached and cached[1] > now:
+        return cached[0]
+    v = _shared().get(vkey)
+    if v is None:
+        _shared().add(vkey, 1, timeout=None)
+        v = _shared().get(vkey) or 1
+    _versions[vkey] = (v, now + getattr(settings, "CACHE_VERSION_TTL", 1))
+    return v
+
+
+def _version(ns, scope=None):
+    v = _read_version(_vkey(ns))
+    return v if scope is None else f"{v}.{scope}.{_read_version(_vkey(ns, scope))}"
+
+
+def _key(ns, version, key):
+    return f"{ns}:v{version}:{key}"
+
+
+def make_key(ns, key, scope=None):
+    return _key(ns, _version(ns, scope), key)
+
+
+def get(ns, key, default=None, scope=None):
+    full = make_key(ns, key, scope)
+    opts = _opts(ns)
+    if opts["local"]:
+        value = _local_get(full)
+        if value is not _MISSING:
+            _stats[ns]["local_hits"] += 1
+            return value
+    value = _shared().get(full, _MISSING)
+    if value is _MISSING:
+        _stats[ns]["misses"] += 1
+        return default
+    _stats[ns]["shared_hits"] += 1
+    if opts["local"]:
+        _local_set(full, value)
+    return value
+
+
+def set(ns, key, value, ttl=None, scope=None):
+    full = make_key(ns, key, scope)
+    opts = _opts(ns)
+    _shared().set(full, value, ttl if ttl is not None else opts["ttl"])
+    if opts["local"]:
+        _local_set(full, value)
+
+
+def get_many(ns, keys) -> dict:
+    """Values found for ``keys`` (missing ones left out): one shared-cache round trip besides the version."""
+    opts = _opts(ns)
+    v = _version(ns)
+    full = {_key(ns, v, k): k for k in keys}
+    found = {}
+    if opts["local"]:
+        for fk, k in full.items():
+            value = _local_get(fk)
+            if value is not _MISSING:
+                found[k] = value
+        _stats[ns]["local_hits"] += len(found)
+    rest = [fk for fk, k in full.items() if k not in found]
+    if rest:
+        shared = _shared().get_many(rest)
+        _stats[ns]["shared_hits"] += len(shared)
+        _stats[ns]["misses"] += len(rest) - len(shared)
+        for fk, value in shared.items():
+            found[full[fk]] = value
+            if opts["local"]:
+                _local_set(fk, value)
+    return found
+
+
+def set_many(ns, mapping: dict, ttl=None):
+    opts = _opts(ns)
+    version = _version(ns)
+    full = {_key(ns, version, k): v for k, v in mapping.items()}
+    _shared().set_many(full, ttl if ttl is not None else opts["ttl"])
+    if opts["local"]:
+        for fk, value in full.items():
+            _local_set(fk, value)
+
+
+def delete(ns, key, scope=None):
+    full = make_key(ns, key, scope)
+    _local_pop(full)
+    _shared().delete(full)
+
+
+def invalidate(ns, scope=None):
+    """Drop every key in a namespace (or in one scope of it) by bumping its version."""
+    vkey = _vkey(ns, scope)
+    try:
+        v = _shared().incr(vkey)
+    except ValueError:
+        v = 2
+        _shared().set(vkey, v, timeout=None)
+    _versions[vkey] = (v, time.monotonic() + getattr(settings, "CACHE_VERSION_TTL", 1))
+
+
+def get_or_set(ns, key, producer, ttl=None, lock_timeout=10, scope=None):
+    value = get(ns, key, _MISSING, scope)
+    if value is not _MISSING:
+        return value
+
+    full = make_key(ns, key, scope)
+    with _flight_guard:
+        lock = _flight_locks.setdefault(full, threading.Lock())
+    with lock:
+        try:
+            value = get(ns, key, _MISSING, scope)
+            if value is not _MISSING:
+                return value
+
+            shared = _shared()
+            lock_key = f"lock:{full}"
+            if not shared.add(lock_key, 1, timeout=lock_timeout):
+                deadline = time.monotonic() + lock_timeout
+                while time.monotonic() < deadline:
+                    time.sleep(0.05)
+                    value = shared.get(full, _MISSING)
+                    if value is not _MISSING:
+                        if _opts(ns)["local"]:
+                            _local_set(full, value)
+                        return value
+            try:
+                value = producer()
+                # Under the version read before producing: after a concurrent invalidate() it is simply unused.
+                shared.set(full, value, ttl if ttl is not None else _opts(ns)["ttl"])
+                if _opts(ns)["local"]:
+                    _local_set(full, value)
+                return value
+            finally:
+                shared.delete(lock_key)
+        finally:
+            with _flight_guard:
+                _flight_locks.pop(full, None)
+
+
+def stats():
+    """Per-namespace counters for this process, with ``hit_ratio``."""
+    out = {}
+    for ns, s in _stats.items():
+        total = s["local_hits"] + s["shared_hits"] + s["misses"]
+        hits = s["local_hits"] + s["shared_hits"]
+        out[ns] = {**s, "hit_ratio": (hits / total) if total else 0.0}
+    return out
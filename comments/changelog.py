@@ -0,0 +1,174 @@
+"""
+Change feed for incremental client refreshes (``Query.commentsSince``).
+
+Every comment insert appends, in its own transaction, one ``created`` row
+for the list it lands in and one ``replies changed`` row for the list that
+shows its parent, both under the comment's section (``thread_key``).
+Hiding a subtree (see comments/deletion.py) appends a ``deleted`` row for
+its root the same way; restoring it appends ``created`` again. A
+client keeps the opaque token of the last change it has seen and asks for
+newer changes of one list: an index-only range scan on
+``(thread_key, parent_id, txid, id)``.
+
+Ids come from a sequence, so they are handed out in insert order but may
+commit out of order, and a write may run for any time (admin, maintenance
+commands). On Postgres every change therefore records its transaction id and
+the feed is read in ``(txid, id)`` order up to the oldest transaction still
+running (``pg_snapshot_xmin``): every transaction below it has committed or
+rolled back, and any later commit sorts after the returned token. Other
+backends (SQLite) run one write transaction at a time, so ids commit in
+order; their ``txid`` is 0. A transaction left open on a shard holds its
+feed back until it ends. With sharding every shard logs the changes of
+its own threads and a token holds one position per shard.
+"""
+import base64
+
+from django.db import connections, router
+from django.db.models import Q
+
+from . import sharding
+from .models import Comment, CommentChange
+from .routers import use_shard
+
+
+def _txid() -> int:
+    conn = connections[router.db_for_write(CommentChange)]
+    if conn.vendor != "postgresql":
+        return 0
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_current_xact_id()::text::bigint")
+        return cursor.fetchone()[0]
+
+
+def _horizon():
+    """Oldest transaction id still running, as seen by this read; None where ids commit in order."""
+    conn = connections[router.db_for_read(CommentChange)]
+    if conn.vendor != "postgresql":
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+        return cursor.fetchone()[0]
+
+
+def record_comment(comment: Comment):
+    """Log a new comment; call inside its transaction."""
+    record_comments([comment])
+
+
+def record_comments(comments):
+    """Log new comments with one insert (and one parent lookup for replies)."""
+    parent_ids = {c.parent_id for c in comments if c.parent_id is not None}
+    grandparents = dict(Comment.objects.filter(pk__in=parent_ids).values_list("id", "parent_id")) if parent_ids else {}
+    rows = []
+    txid = _txid()
+    for c in comments:
+        key = c.thread_key
+        rows.append(CommentChange(
+            thread_key=key, parent_id=c.parent_id, comment_id=c.id, kind=CommentChange.CREATED, txid=txid,
+        ))
+        if c.parent_id is not None:
+            rows.append(CommentChange(
+                thread_key=key, parent_id=grandparents.get(c.parent_id), comment_id=c.parent_id,
+                kind=CommentChange.REPLIED, txid=txid,
+            ))
+    CommentChange.objects.bulk_create(rows)
+
+
+def record_deleted(comment: Comment, grandparent_id=None):
+    """Log a hidden subtree root; call inside its transaction."""
+    txid = _txid()
+    rows = [CommentChange(
+        thread_key=comment.thread_key, parent_id=comment.parent_id, comment_id=comment.id,
+        kind=CommentChange.DELETED, txid=txid,
+    )]
+    if comment.parent_id is not None:
+        rows.append(CommentChange(
+            thread_key=comment.thread_key, parent_id=grandparent_id, comment_id=comment.parent_id,
+            kind=CommentChange.REPLIED, txid=txid,
+        ))
+    CommentChange.objects.bulk_create(rows)
+
+
+def encode_token(position) -> str:
+    """Token for ``position``: the last ``(txid, id)`` seen on each shard, in ``COMMENT_SHARDS`` order."""
+    pairs = ".".join(f"{txid}-{pk}" for txid, pk in position)
+    return base64.urlsafe_b64encode(f"v2:{pairs}".encode()).decode().rstrip("=")
+
+
+def decode_token(token: str) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        version, _, pairs = raw.partition(":")
+        if version == "v2":
+            position = [tuple(int(n) for n in pair.split("-")) for pair in pairs.split(".")]
+            if any(len(p) != 2 for p in position):
+                raise ValueError(token)
+        elif version == "v1":
+            # Id-only tokens: newer changes (txid > 0) are all sent, some of them again.
+            position = [(0, int(i)) for i in pairs.split(".")]
+        else:
+            raise ValueError(token)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid sinceToken") from None
+    # Shards added since the token was issued start from their beginning.
+    n = len(sharding.aliases())
+    return (position + [(0, 0)] * n)[:n]
+
+
+def head_token() -> str:
+    """Token covering every change committed so far, for clients starting from a full load."""
+    position = []
+    for alias in sharding.aliases():
+        with use_shard(alias):
+            horizon = _horizon()
+            if horizon is None:
+                position.append((0, CommentChange.objects.order_by("-id").values_list("id", flat=True).first() or 0))
+            else:
+                # Everything below the oldest running transaction; the rest sorts after (horizon, 0).
+                position.append((horizon, 0))
+    return encode_token(position)
+
+
+def changes_since(thread_key: str, parent_id, since: list, limit: int):
+    """
+        Committed changes of one list after position ``since``, in commit order per shard.
+
+        Returns ``(created_ids, replied_ids, deleted_ids, position, has_more)``;
+        of a comment created and deleted again only the last change is kept.
+        A reply list is read from its thread's shard, the top level from every
+        shard (up to ``limit`` changes each).
+    """
+    shards = sharding.aliases()
+    targets = shards if parent_id is None else [sharding.shard_of(parent_id)]
+    position = list(since)
+    rows, has_more = [], False
+    for alias in targets:
+        i = shards.index(alias)
+        txid, pk = since[i]
+        with use_shard(alias):
+            horizon = _horizon()
+            qs = CommentChange.objects.filter(
+                Q(txid__gt=txid) | Q(txid=txid, id__gt=pk), thread_key=thread_key, parent_id=parent_id,
+            )
+            if horizon is not None:
+                qs = qs.filter(txid__lt=horizon)
+            part = list(qs.order_by("txid", "id").values_list("txid", "id", "comment_id", "kind")[: limit + 1])
+        has_more |= len(part) > limit
+        part = part[:limit]
+        if part:
+            position[i] = part[-1][:2]
+        rows += part
+
+    created, replied, deleted = [], [], []
+    for _, _, comment_id, kind in rows:
+        if kind == CommentChange.REPLIED:
+            if comment_id not in replied:
+                replied.append(comment_id)
+            continue
+        target, other = (created, deleted) if kind == CommentChange.CREATED else (deleted, created)
+        if comment_id in other:
+            other.remove(comment_id)
+        if comment_id not in target:
+            target.append(comment_id)
+    replied = [r for r in replied if r not in created and r not in deleted]
+    return created, replied, deleted, position, has_more
@@ -0,0 +1,20 @@
+from django.core.checks import Error, Tags, register
+from django.db import DatabaseError
+
+from . import sharding
+from .models import IdSequence
+from .routers import PRIMARY_DB
+
+
+@register(Tags.database)
+def shard_layout(app_configs, databases=None, **kwargs):
+    """Run by ``migrate``: refuse a ``COMMENT_SHARDS`` that remaps existing threads."""
+    if not databases or PRIMARY_DB not in databases:
+        return []
+    try:
+        row = IdSequence.objects.using(PRIMARY_DB).filter(name=sharding.SEQUENCE).first()
+    except DatabaseError:
+        # Not migrated yet.
+        return []
+    error = row and sharding.layout_error(row)
+    return [Error(error, id="comments.E001")] if error else []
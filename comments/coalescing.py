@@ -0,0 +1,297 @@
+"""
+Comment inserts, optionally coalesced.
+
+:func:`create` writes one new comment (its author row, the comment, the
+thread snapshot, the change log and the section counters) in one
+transaction. With ``COMMENT_WRITE_COALESCING=1`` it hands the comment to a
+per-process writer thread instead: comments arriving within
+``COMMENT_COALESCE_WINDOW_MS`` of the first one (up to
+``COMMENT_COALESCE_MAX_BATCH``) are written together — one transaction, one
+``bulk_create`` for users and one for comments — so a burst costs one commit
+instead of one per comment. Requests from the threads of one gunicorn worker
+(``GTHREADS``) share a batch.
+
+Each caller gets its own comment or its own error: a missing parent fails
+only that comment, and if the batch as a whole fails (rolls back) its
+comments are retried one transaction each. Callers' time budgets carry over; a batch runs
+under the earliest of them, and a retried comment under its own (one past
+it fails). With sharding a batch is written as one transaction per shard,
+and only the comments of a shard whose transaction failed are retried.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections, router, transaction
+from django.utils import timezone
+
+from . import cache as tiered_cache
+from . import changelog, deadlines, deletion, namespaces, sharding, snapshots
+from .models import Comment, User
+from .routers import mark_wrote, use_primary, use_shard
+from .utils import SANITIZE_POLICY_VERSION
+
+log = logging.getLogger("coalescing")
+
+
+@dataclass
+class NewComment:
+    """An already validated and sanitized comment to insert."""
+    name: str
+    email: str
+    text_raw: str
+    text_html: str
+    home_page: str = ""
+    parent_id: Optional[int] = None
+    thread_key: str = ""
+    ip: Optional[str] = None
+    user_agent: str = ""
+
+    def user(self) -> User:
+        return User(
+            name=self.name, email=self.email, home_page=self.home_page,
+            ip=self.ip or "0.0.0.0", user_agent=self.user_agent,
+        )
+
+    def comment(self, author: User) -> Comment:
+        return Comment(
+            author=author,
+            parent_id=self.parent_id,
+            thread_key=self.thread_key,
+            text_raw=self.text_raw,
+            text_html=self.text_html,
+            sanitize_version=SANITIZE_POLICY_VERSION,
+            ip=self.ip or None,
+            user_agent=self.user_agent,
+        )
+
+
+def _invalidate(keys):
+    # Only the cached listings of the sections written to.
+    for key in sorted(set(keys)):
+        tiered_cache.invalidate("comments", scope=key)
+
+
+@contextmanager
+def _atomic():
+    """
+        ``deadlines.atomic`` for comment inserts. An error raised after the
+        commit (a failing on_commit hook) is logged instead of raised: the
+        rows are written, and retrying them would insert them twice.
+    """
+    committed = []
+    try:
+        with deadlines.atomic(Comment):
+            transaction.on_commit(lambda: committed.append(True), using=router.db_for_write(Comment))
+            yield
+    except Exception:
+        if not committed:
+            raise
+        log.exception("comments committed, a post-commit step failed")
+
+
+def write_one(item: NewComment) -> Comment:
+    comment_id = sharding.new_comment_id(item.parent_id)
+    with sharding.thread(comment_id or item.parent_id), use_primary(), _atomic():
+        if item.parent_id is not None:
+            parent = Comment.objects.filter(pk=item.parent_id).first()
+            if parent is None or deletion.is_hidden(parent):
+                raise ValueError("Parent comment not found")
+        user = item.user()
+        user.save()
+        comment = item.comment(user)
+        comment.id = comment_id
+        comment.save()
+        snapshots.on_comment_created(comment)
+        changelog.record_comment(comment)
+        namespaces.on_comment_created(comment)
+        transaction.on_commit(
+            lambda: _invalidate([comment.thread_key]), using=router.db_for_write(Comment), robust=True,
+        )
+    return comment
+
+
+class BatchFailed(Exception):
+    """Result of an item whose shard transaction rolled back; ``error`` is what failed it."""
+
+    def __init__(self, error: Exception):
+        super().__init__(str(error))
+        self.error = error
+
+
+def write_many(items) -> list:
+    """
+        Insert ``items``, one transaction per shard; returns a Comment or an
+        exception per item, in order. The items of a shard whose transaction
+        failed get :class:`BatchFailed`; other shards' items are unaffected.
+    """
+    ids = [sharding.new_comment_id(item.parent_id) for item in items]
+    by_shard = {}
+    for n, (item, comment_id) in enumerate(zip(items, ids)):
+        by_shard.setdefault(sharding.shard_of(comment_id or item.parent_id), []).append(n)
+    results = [None] * len(items)
+    for alias, ns in by_shard.items():
+        try:
+            with use_shard(alias):
+                shard_results = _write_shard([items[n] for n in ns], [ids[n] for n in ns])
+        except Exception as e:
+            shard_results = [BatchFailed(e)] * len(ns)
+        for n, result in zip(ns, shard_results):
+            results[n] = result
+    return results
+
+
+def _write_shard(items, ids) -> list:
+    results = [None] * len(items)
+    with use_primary(), _atomic():
+        parent_ids = {i.parent_id for i in items if i.parent_id is not None}
+        parents = Comment.objects.filter(pk__in=parent_ids).only("id", "parent_id", "thread_key", "deleted_at")
+        # Replies join their parent's section (Comment.save does this for single inserts);
+        # a parent inside a hidden subtree counts as missing.
+        parent_keys = {p.id: p.thread_key for p in (parents if parent_ids else []) if not deletion.is_hidden(p)}
+        ok = []
+        for n, item in enumerate(items):
+            if item.parent_id is not None and item.parent_id not in parent_keys:
+                results[n] = ValueError("Parent comment not found")
+            else:
+                ok.append(n)
+        if not ok:
+            return results
+
+        users = User.objects.bulk_create([items[n].user() for n in ok])
+        now = timezone.now()
+        rows = []
+        for n, user in zip(ok, users):
+            c = items[n].comment(user)
+            c.id = ids[n]
+            if c.parent_id is None:
+                c.last_activity_at = now
+            else:
+                c.thread_key = parent_keys[c.parent_id]
+            rows.append(c)
+        comments = Comment.objects.bulk_create(rows)
+        snapshots.on_comments_created(comments)
+        changelog.record_comments(comments)
+        namespaces.on_comments_created(comments)
+        keys = [c.thread_key for c in comments]
+        transaction.on_commit(lambda: _invalidate(keys), using=router.db_for_write(Comment), robust=True)
+    for n, c in zip(ok, comments):
+        results[n] = c
+    return results
+
+
+class CoalescingWriter:
+    """Daemon thread that drains submitted comments into batched transactions."""
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="comment-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, item: NewComment) -> Future:
+        fut = Future()
+        left = deadlines.remaining()
+        self._queue.put((item, fut, None if left is None else time.monotonic() + left))
+        return fut
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            until = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                left = until - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=left) if left > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            close_old_connections()
+            try:
+                self._flush(batch)
+            except Exception as e:
+                log.exception("comment batch failed")
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+            finally:
+                close_old_connections()
+
+    def _flush(self, batch):
+        now = time.monotonic()
+        live = []
+        for entry in batch:
+            if entry[2] is not None and entry[2] <= now:
+                entry[1].set_exception(deadlines.DeadlineExceeded("mutation"))
+            else:
+                live.append(entry)
+        if not live:
+            return
+        expiries = [e[2] for e in live if e[2] is not None]
+        try:
+            with deadlines.expires_in(min(expiries) - now, "mutation") if expiries else nullcontext():
+                results = write_many([e[0] for e in live])
+        except Exception:
+            # Nothing was written (the ids couldn't be allocated, or not in time).
+            log.warning("comment batch of %d failed, writing one by one", len(live), exc_info=True)
+            results = [self._write_alone(item, expiry) for item, _, expiry in live]
+        failed = [r.error for r in results if isinstance(r, BatchFailed)]
+        if failed:
+            log.warning("%d comments of a batch rolled back with their shard", len(failed), exc_info=failed[0])
+        for (item, fut, expiry), result in zip(live, results):
+            if isinstance(result, BatchFailed):
+                # Only this shard's comments are retried.
+                result = self._write_alone(item, expiry)
+            if isinstance(result, BaseException):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+    @staticmethod
+    def _write_alone(item, expiry):
+        # The batch ran under the earliest deadline; only items past their own one fail.
+        if expiry is not None and expiry <= time.monotonic():
+            return deadlines.DeadlineExceeded("mutation")
+        try:
+            if expiry is None:
+                return write_one(item)
+            with deadlines.expires_in(expiry - time.monotonic(), "mutation"):
+                return write_one(item)
+        except Exception as e:
+            return e
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> CoalescingWriter:
+    """Per-process writer, started lazily (and again after a fork)."""
+    global _writer, _writer_pid
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = CoalescingWriter(
+                settings.COMMENT_COALESCE_WINDOW_MS / 1000, settings.COMMENT_COALESCE_MAX_BATCH,
+            )
+            _writer_pid = os.getpid()
+        return _writer
+
+
+def create(item: NewComment, coalesce: Optional[bool] = None) -> Comment:
+    """Insert one comment, through the coalescing writer when enabled."""
+    if coalesce is None:
+        coalesce = settings.COMMENT_WRITE_COALESCING
+    if not coalesce:
+        return write_one(item)
+    comment = get_writer().submit(item).result()
+    # The writer thread's router calls don't reach this request's context.
+    mark_wrote()
+    return comment
@@ -0,0 +1,144 @@
+"""
+Compressed API responses.
+
+``CompressionMiddleware`` compresses JSON responses of the API paths
+(``COMPRESS_PATHS``) with Brotli (when the ``brotli`` package is installed)
+or gzip, whichever the client prefers in ``Accept-Encoding``; bodies under
+``COMPRESS_MIN_SIZE`` bytes are sent as is. Static files are left to
+WhiteNoise.
+
+Views with a response cache store the output of :func:`encode` — the bytes
+already compressed for the negotiated encoding — and serve them with
+:func:`cached_response`, so a hot page is compressed once per encoding, not
+on every hit. ``stats()`` reports the bytes saved.
+"""
+import gzip
+import threading
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_COMPRESSIBLE = ("application/json", "application/graphql-response+json", "text/")
+
+# A response body prepared for one encoding; ``encoding`` is None when it is sent uncompressed.
+Encoded = namedtuple("Encoded", "encoding content raw_size")
+
+_stats = defaultdict(lambda: {"responses": 0, "raw_bytes": 0, "sent_bytes": 0})
+_stats_lock = threading.Lock()
+
+
+def available() -> tuple:
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(request):
+    """Best encoding ``request`` accepts, or None."""
+    header = request.META.get("HTTP_ACCEPT_ENCODING", "")
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    best, best_q = None, 0.0
+    for coding in available():
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=settings.COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=settings.COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+def encode(data: bytes, encoding) -> Encoded:
+    """``data`` prepared for ``encoding``; kept as is when small or when compression doesn't help."""
+    if encoding and len(data) >= settings.COMPRESS_MIN_SIZE:
+        packed = compress(data, encoding)
+        if len(packed) < len(data):
+            return Encoded(encoding, packed, len(data))
+    return Encoded(None, data, len(data))
+
+
+def _record(body: Encoded, cached=False):
+    with _stats_lock:
+        for key in ("all", body.encoding or "identity") + (("cached",) if cached else ()):
+            s = _stats[key]
+            s["responses"] += 1
+            s["raw_bytes"] += body.raw_size
+            s["sent_bytes"] += len(body.content)
+
+
+def _finish(response, body: Encoded):
+    if body.encoding:
+        response["Content-Encoding"] = body.encoding
+        etag = response.get("ETag")
+        if etag and not etag.startswith("W/"):
+            response["ETag"] = "W/" + etag
+    response["Content-Length"] = str(len(body.content))
+    patch_vary_headers(response, ("Accept-Encoding",))
+
+
+def cached_response(body: Encoded, content_type="application/json") -> HttpResponse:
+    """Response for a body taken from a response cache; the middleware leaves it alone."""
+    response = HttpResponse(body.content, content_type=content_type)
+    _finish(response, body)
+    response.precompressed = True
+    _record(body, cached=True)
+    return response
+
+
+def stats():
+    """Bytes before and after compression in this process, with ``saved_ratio``."""
+    with _stats_lock:
+        return {
+            k: {**s, "saved_ratio": 1 - s["sent_bytes"] / s["raw_bytes"] if s["raw_bytes"] else 0.0}
+            for k, s in _stats.items()
+        }
+
+
+class CompressionMiddleware:
+    """Compresses API responses for clients that accept gzip or Brotli."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.paths = tuple(settings.COMPRESS_PATHS)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not request.path.startswith(self.paths) or getattr(response, "precompressed", False):
+            return response
+        if (
+            response.streaming
+            or response.has_header("Content-Encoding")
+            or not response.get("Content-Type", "").startswith(_COMPRESSIBLE)
+        ):
+            return response
+        # Whether or not this one is compressed, the next may be.
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encoding = negotiate(request)
+        if not encoding:
+            return response
+        body = encode(response.content, encoding)
+        response.content = body.content
+        _finish(response, body)
+        _record(body)
+        return response
@@ -0,0 +1,66 @@
+"""
+Pooled Postgres connections (``DB_POOL=1``).
+
+Without a pool every request thread keeps its own connection for
+``CONN_MAX_AGE`` seconds, so a container holds ``WEB_CONCURRENCY x GTHREADS``
+connections per database and each new worker pays for TLS and auth before
+its first query. With ``DB_POOL=1`` Django's psycopg pool gives each process
+at most ``DB_POOL_MAX`` connections per database alias: a request borrows one
+for its duration and returns it at the end, connections are checked on
+checkout and closed after ``DB_POOL_MAX_IDLE`` idle seconds.
+
+``DB_PGBOUNCER=1`` is for a PgBouncer in transaction mode in front of
+Postgres: no server-side cursors and no prepared statements. The code sets no
+session state of its own (statement timeouts are transaction-local, see
+``deadlines.atomic``).
+
+:func:`stats` reports per alias the pool size, checkouts and the time
+requests waited for a connection.
+"""
+from django.db import connections
+
+
+def _pools() -> dict:
+    """``{alias: pool}`` for the pools this process has created."""
+    out = {}
+    for alias in connections:
+        conn = connections[alias]
+        # ``conn.pool`` would create one; only look at existing pools.
+        pools = getattr(conn, "_connection_pools", {})
+        if alias in pools:
+            out[alias] = pools[alias]
+    return out
+
+
+def stats():
+    """Pool size, checkouts and waits per database alias in this process."""
+    out = {}
+    for alias, pool in _pools().items():
+        s = pool.get_stats()
+        checkouts = s.get("requests_num", 0)
+        opened = s.get("connections_num", 0)
+        out[alias] = {
+            "size": s.get("pool_size", 0),
+            "available": s.get("pool_available", 0),
+            "min_size": s.get("pool_min", 0),
+            "max_size": s.get("pool_max", 0),
+            "waiting": s.get("requests_waiting", 0),
+            "checkouts": checkouts,
+            "queued": s.get("requests_queued", 0),
+            "wait_ms": s.get("requests_wait_ms", 0),
+            "wait_ms_avg": s.get("requests_wait_ms", 0) / checkouts if checkouts else 0.0,
+            "timeouts": s.get("requests_errors", 0),
+            "connections_opened": opened,
+            "connect_ms_avg": s.get("connections_ms", 0) / opened if opened else 0.0,
+            "connections_lost": s.get("connections_lost", 0),
+            "returned_bad": s.get("returns_bad", 0),
+        }
+    return out
+
+
+def close_all():
+    """Close this thread's connections and every pool; for the gunicorn master before forking."""
+    for alias in connections:
+        connections[alias].close()
+    for alias in _pools():
+        connections[alias].close_pool()
@@ -0,0 +1,155 @@
+"""
+Per-operation time budgets.
+
+``budget("comments")`` starts a deadline for the operation, taken from
+``OPERATION_BUDGETS_MS``. It is enforced in two places:
+
+* ``atomic()`` opens the operation's transaction with Postgres
+  ``statement_timeout`` set (``SET LOCAL``) to the time left, so the server
+  cancels a runaway query instead of holding the connection and the worker;
+* ``check()`` runs between the expensive Python steps (sanitizing,
+  thumbnailing) and raises ``DeadlineExceeded`` once the time is spent.
+
+Both end the operation with ``DeadlineExceeded``. ``DeadlineMiddleware``
+turns it into a 503 for plain HTTP views, GraphQL reports it as a field
+error, and timeouts are counted per operation in ``stats()``.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import OperationalError, connections, router, transaction
+from django.http import JsonResponse
+
+from .routers import use_database
+
+log = logging.getLogger("deadlines")
+
+# SQLSTATE query_canceled, raised when statement_timeout fires.
+QUERY_CANCELED = "57014"
+
+# (operation, time.monotonic() deadline) of the innermost budget.
+_current: ContextVar = ContextVar("comments_deadline", default=None)
+_timeouts = Counter()
+_timeouts_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, operation=None):
+        super().__init__(operation)
+        self.operation = operation
+
+    def __str__(self):
+        return f"Operation '{self.operation or 'request'}' ran out of time and was cancelled"
+
+
+def remaining():
+    """Seconds left in the current budget, or None outside any budget."""
+    cur = _current.get()
+    return None if cur is None else cur[1] - time.monotonic()
+
+
+def check():
+    cur = _current.get()
+    if cur is not None and time.monotonic() >= cur[1]:
+        raise DeadlineExceeded(cur[0])
+
+
+@contextmanager
+def expires_in(seconds, operation=None):
+    """Set a deadline ``seconds`` from now unless an enclosing one is sooner; nothing is counted."""
+    expires = time.monotonic() + seconds
+    cur = _current.get()
+    if cur is not None and cur[1] <= expires:
+        yield
+        return
+    token = _current.set((operation or (cur[0] if cur else None), expires))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def _is_canceled(exc) -> bool:
+    cause = exc.__cause__
+    return QUERY_CANCELED in (getattr(cause, "sqlstate", None), getattr(cause, "pgcode", None))
+
+
+def count_timeout(operation):
+    with _timeouts_lock:
+        _timeouts[operation] += 1
+    log.warning("operation %s exceeded its %s ms budget", operation, settings.OPERATION_BUDGETS_MS.get(operation))
+
+
+def _count(exc, operation):
+    if not getattr(exc, "counted", False):
+        exc.counted = True
+        count_timeout(operation)
+
+
+@contextmanager
+def budget(operation, seconds=None):
+    """Run the block under ``operation``'s time budget (``OPERATION_BUDGETS_MS``; 0 disables it)."""
+    if seconds is None:
+        seconds = settings.OPERATION_BUDGETS_MS.get(operation, 0) / 1000
+    if seconds <= 0:
+        yield
+        return
+    try:
+        with expires_in(seconds, operation):
+            yield
+    except DeadlineExceeded as e:
+        _count(e, e.operation or operation)
+        raise
+    except OperationalError as e:
+        if not _is_canceled(e):
+            raise
+        exc = DeadlineExceeded(operation)
+        _count(exc, operation)
+        raise exc from e
+
+
+@contextmanager
+def atomic(model, using=None):
+    """
+        ``transaction.atomic()`` on ``model``'s database with statement_timeout
+        set to the time left. Reads inside the block stay on that database,
+        so a read-only operation runs in one transaction on one replica.
+    """
+    using = using or router.db_for_read(model)
+    with use_database(using), transaction.atomic(using=using):
+        left = remaining()
+        if left is not None:
+            check()
+            conn = connections[using]
+            if conn.vendor == "postgresql":
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT set_config('statement_timeout', %s, true)", [f"{max(int(left * 1000), 1)}ms"]
+                    )
+        yield
+
+
+def stats():
+    """Timeouts per operation in this process."""
+    with _timeouts_lock:
+        return {"timeouts": dict(_timeouts), "budgets_ms": dict(settings.OPERATION_BUDGETS_MS)}
+
+
+class DeadlineMiddleware:
+    """Answers ``DeadlineExceeded`` escaping a view with a 503."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, DeadlineExceeded):
+            return JsonResponse({"error": str(exception)}, status=503)
+        return None
@@ -0,0 +1,204 @@
+"""
+Deleting comments together with their replies.
+
+:func:`hide` is the soft delete: it flags only the subtree's root
+(``Comment.deleted_at``), so a thread of any size drops out of listings,
+reply counts, section counters, snapshots and the change feed in one short
+transaction, and :func:`restore` brings it back.
+
+:func:`purge` removes a subtree for good. Its ids come from one recursive
+CTE over ``parent_id``, deepest first, and are deleted in batches of
+``COMMENT_PURGE_BATCH`` (attachments, snapshot, comments, their authors),
+one transaction each, so no batch leaves a reply without its parent. An
+interrupted purge leaves a smaller, still hidden subtree; running it again
+finishes the job. Attachment files are not deleted inline: each batch queues
+their names in ``OrphanedFile`` and :func:`sweep_files` removes them from
+storage later.
+
+The admin deletes through :func:`purge` instead of Django's collector, which
+walks the tree level by level with every row in memory;
+``manage.py purge_comments`` purges tombstones older than
+``COMMENT_TOMBSTONE_DAYS`` and sweeps the file queue.
+"""
+import logging
+from typing import Optional
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import cache as tiered_cache
+from . import changelog, namespaces, sharding, snapshots
+from .models import Attachment, Comment, OrphanedFile, ThreadSnapshot, User
+from .routers import use_primary, use_shard
+
+log = logging.getLogger("deletion")
+
+
+def replies_count():
+    """``Count`` of a comment's visible replies, for ``annotate``."""
+    return Count("children", filter=Q(children__deleted_at__isnull=True))
+
+
+def _invalidate(key):
+    tiered_cache.invalidate("comments", scope=key)
+
+
+def _connection():
+    return connections[router.db_for_write(Comment)]
+
+
+def _subtree_sql(conn, select, visible_only=False):
+    table = conn.ops.quote_name(Comment._meta.db_table)
+    # Hidden subtrees inside this one are already uncounted; don't descend into them.
+    step = " AND c.deleted_at IS NULL" if visible_only else ""
+    return (
+        f"WITH RECURSIVE subtree (id, depth) AS ("
+        f" SELECT id, 0 FROM {table} WHERE id = %s"
+        f" UNION ALL"
+        f" SELECT c.id, s.depth + 1 FROM {table} c JOIN subtree s ON c.parent_id = s.id{step}"
+        f") {select}"
+    )
+
+
+def subtree_size(comment_id, visible_only=False) -> int:
+    """Number of comments in the subtree rooted at ``comment_id``, the root included."""
+    with sharding.thread(comment_id):
+        conn = _connection()
+    with conn.cursor() as cursor:
+        cursor.execute(_subtree_sql(conn, "SELECT COUNT(*) FROM subtree", visible_only), [comment_id])
+        return cursor.fetchone()[0]
+
+
+def _ancestors(comment: Comment) -> list:
+    """``(id, deleted_at)`` of the comment's ancestors, nearest first."""
+    out = []
+    parent_id = comment.parent_id
+    while parent_id is not None:
+        row = Comment.objects.filter(pk=parent_id).values_list("parent_id", "deleted_at").first()
+        if row is None:
+            break
+        out.append((parent_id, row[1]))
+        parent_id = row[0]
+    return out
+
+
+def is_hidden(comment: Comment) -> bool:
+    """True if the comment or one of its ancestors is hidden; such comments take no replies or uploads."""
+    return comment.deleted_at is not None or any(deleted_at for _, deleted_at in _ancestors(comment))
+
+
+def visible(comment_id) -> Optional[Comment]:
+    """The comment, or None if it is missing or inside a hidden subtree."""
+    comment = Comment.objects.filter(pk=comment_id).first()
+    return None if comment is None or is_hidden(comment) else comment
+
+
+def hide(comment_id) -> bool:
+    """Soft-delete a comment with all its replies; False if it is missing or already hidden."""
+    with sharding.thread(comment_id), use_primary(), transaction.atomic(using=_connection().alias):
+        comment = Comment.objects.select_for_update().filter(pk=comment_id).first()
+        if comment is None or comment.deleted_at is not None:
+            return False
+        ancestors = _ancestors(comment)
+        size = subtree_size(comment.id, visible_only=True)
+        comment.deleted_at = timezone.now()
+        comment.save(update_fields=["deleted_at"])
+        # Under a hidden ancestor the subtree is already out of every list and counter.
+        if not any(deleted_at for _, deleted_at in ancestors):
+            snapshots.on_subtree_hidden(comment, ancestors[-1][0] if ancestors else comment.id)
+            changelog.record_deleted(comment, ancestors[1][0] if len(ancestors) > 1 else None)
+            namespaces.on_comments_removed(comment.thread_key, int(comment.parent_id is None), size)
+        transaction.on_commit(lambda: _invalidate(comment.thread_key), using=_connection().alias)
+    return True
+
+
+def restore(comment_id) -> bool:
+    """Undo :func:`hide`; False if the comment is missing or not hidden."""
+    with sharding.thread(comment_id), use_primary(), transaction.atomic(using=_connection().alias):
+        comment = Comment.objects.select_for_update().filter(pk=comment_id).first()
+        if comment is None or comment.deleted_at is None:
+            return False
+        ancestors = _ancestors(comment)
+        comment.deleted_at = None
+        comment.save(update_fields=["deleted_at"])
+        if not any(deleted_at for _, deleted_at in ancestors):
+            root_id = ancestors[-1][0] if ancestors else comment.id
+            snapshots.rebuild(Comment.objects.select_related("author").get(pk=root_id))
+            changelog.record_comments([comment])
+            namespaces.on_comments_restored(
+                comment.thread_key, int(comment.parent_id is None), subtree_size(comment.id, visible_only=True),
+            )
+        transaction.on_commit(lambda: _invalidate(comment.thread_key), using=_connection().alias)
+    return True
+
+
+def purge(comment_id, batch_size=None) -> int:
+    """Delete a comment and all its replies for good; returns the number of comments removed."""
+    batch_size = batch_size or settings.COMMENT_PURGE_BATCH
+    hide(comment_id)
+    removed = 0
+    with sharding.thread(comment_id), use_primary():
+        conn = _connection()
+        # A reply written under the subtree while it is purged shows up in the next pass.
+        while True:
+            with conn.cursor() as cursor:
+                cursor.execute(_subtree_sql(conn, "SELECT id FROM subtree ORDER BY depth DESC"), [comment_id])
+                ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                return removed
+            # Deepest first: a batch's replies were deleted by an earlier batch or are in it.
+            for i in range(0, len(ids), batch_size):
+                removed += _delete_batch(conn, ids[i:i + batch_size])
+
+
+def _delete_batch(conn, ids) -> int:
+    table = conn.ops.quote_name(Comment._meta.db_table)
+    with transaction.atomic(using=conn.alias):
+        authors = list(Comment.objects.filter(pk__in=ids).values_list("author_id", flat=True))
+        attachments = Attachment.objects.filter(comment_id__in=ids)
+        OrphanedFile.objects.bulk_create(
+            [OrphanedFile(name=name) for name in attachments.values_list("file", flat=True) if name]
+        )
+        attachments.delete()
+        ThreadSnapshot.objects.filter(root_id__in=ids).delete()
+        with conn.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+            removed = cursor.rowcount
+        # Author rows are per comment (one-to-one), nothing else points at them.
+        User.objects.filter(pk__in=authors).delete()
+    return removed
+
+
+def sweep_files(batch_size=None) -> tuple:
+    """Delete queued attachment files from storage, on every shard; returns ``(deleted, failed)``."""
+    deleted = failed = 0
+    for alias in sharding.aliases():
+        with use_shard(alias):
+            d, f = _sweep(batch_size or settings.COMMENT_PURGE_BATCH)
+        deleted, failed = deleted + d, failed + f
+    return deleted, failed
+
+
+def _sweep(batch_size):
+    storage = Attachment._meta.get_field("file").storage
+    deleted = failed = 0
+    last_id = 0
+    while True:
+        rows = list(OrphanedFile.objects.filter(pk__gt=last_id).order_by("id")[:batch_size])
+        if not rows:
+            return deleted, failed
+        last_id = rows[-1].id
+        done = []
+        for row in rows:
+            try:
+                storage.delete(row.name)
+            except Exception:
+                # Stays queued for the next sweep.
+                log.warning("could not delete %s", row.name, exc_info=True)
+                failed += 1
+                continue
+            done.append(row.id)
+        OrphanedFile.objects.filter(pk__in=done).delete()
+        deleted += len(done)
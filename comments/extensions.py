@@ -0,0 +1,105 @@
+from django.conf import settings
+from graphql import GraphQLError
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode, OperationDefinitionNode
+from graphql.utilities import value_from_ast_untyped
+from strawberry.extensions import SchemaExtension
+
+# Cost of resolving a field once (roughly: DB queries it issues). Fields not
+# listed are free (scalars, plain object fields).
+FIELD_COSTS = {
+    "comments": 2,
+    "commentsSince": 2,
+    "attachments": 1,
+    "threadSnapshot": 1,
+    "createComment": 5,
+    "uploadAttachment": 10,
+    "uploadAttachments": 30,
+}
+DEFAULT_PAGE_SIZE = 25
+# List fields -> (page size argument, its default).
+PAGE_ARGS = {
+    "comments": ("pageSize", DEFAULT_PAGE_SIZE),
+    "commentsSince": ("limit", 50),
+}
+
+
+class QueryCostLimiter(SchemaExtension):
+    """
+        Static cost analysis before execution.
+
+        Each field costs ``FIELD_COSTS[name]`` times the number of times it
+        will be resolved: ``results`` of ``comments`` multiply by the requested
+        ``pageSize`` (``created`` of ``commentsSince`` by ``limit``),
+        ``attachments`` by ``GRAPHQL_COST_ATTACHMENTS_PER_COMMENT``.
+        Operations over ``GRAPHQL_MAX_COST`` are rejected without running; the
+        computed cost is returned in ``extensions.cost`` either way.
+    """
+
+    def __init__(self, *, execution_context=None):
+        self.cost = None
+
+    def on_validate(self):
+        ctx = self.execution_context
+        document = ctx.graphql_document
+        if document is not None:
+            self.cost = self.compute(document, ctx.operation_name, ctx.variables or {})
+            budget = settings.GRAPHQL_MAX_COST
+            if self.cost > budget:
+                ctx.pre_execution_errors = [
+                    GraphQLError(f"Query cost {self.cost} exceeds the budget of {budget}.")
+                ]
+        yield
+
+    def get_results(self):
+        if self.cost is None:
+            return {}
+        return {"cost": {"requested": self.cost, "budget": settings.GRAPHQL_MAX_COST}}
+
+    @classmethod
+    def compute(cls, document, operation_name, variables) -> int:
+        fragments = {}
+        operation = None
+        for d in document.definitions:
+            if isinstance(d, OperationDefinitionNode):
+                if operation is None or (d.name and d.name.value == operation_name):
+                    operation = d
+            elif hasattr(d, "type_condition"):
+                fragments[d.name.value] = d
+        if operation is None:
+            return 0
+        return cls._cost(operation.selection_set, 1, DEFAULT_PAGE_SIZE, fragments, variables, set())
+
+    @classmethod
+    def _cost(cls, selection_set, mult, page_size, fragments, variables, seen) -> int:
+        if selection_set is None:
+            return 0
+        total = 0
+        for sel in selection_set.selections:
+            if isinstance(sel, FragmentSpreadNode):
+                name = sel.name.value
+                if name in seen or name not in fragments:
+                    continue
+                total += cls._cost(fragments[name].selection_set, mult, page_size, fragments, variables, seen | {name})
+                continue
+            if isinstance(sel, InlineFragmentNode):
+                total += cls._cost(sel.selection_set, mult, page_size, fragments, variables, seen)
+                continue
+            if not isinstance(sel, FieldNode):
+                continue
+
+            name = sel.name.value
+            total += FIELD_COSTS.get(name, 0) * mult
+            child_mult, child_page = mult, page_size
+            args = {a.name.value: value_from_ast_untyped(a.value, variables) for a in sel.arguments}
+            if name in PAGE_ARGS:
+                arg, default = PAGE_ARGS[name]
+                try:
+                    child_page = max(int(args.get(arg) or default), 1)
+                except (TypeError, ValueError):
+                    child_page = default
+            elif name in ("results", "created"):
+                child_mult = mult * page_size
+            elif name == "attachments":
+                child_mult = mult * settings.GRAPHQL_COST_ATTACHMENTS_PER_COMMENT
+            total += cls._cost(sel.selection_set, child_mult, child_page, fragments, variables, seen)
+        return total
@@ -0,0 +1,139 @@
+"""
+Attachment checks and thumbnailing on plain bytes/file objects.
+
+Kept free of Django models so it can run in upload pool worker processes.
+"""
+import gzip
+import io
+
+from django.core.files.base import ContentFile
+
+from . import deadlines
+
+MAX_TXT_SIZE = 100 * 1024
+MAX_IMAGE_SIZE = (320, 240)
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "GIF"}
+MIME_BY_FORMAT = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif"}
+
+def _is_text_file(file, max_bytes=100 * 1024) -> bool:
+    name = (getattr(file, "name", "") or "").lower()
+    if not name.endswith(".txt"):
+        return False
+    pos = file.tell()
+    try:
+        if file.size > max_bytes:
+            return False
+        sample = file.read(min(file.size, 4096))
+        if b"\x00" in sample:
+            return False
+        try:
+            sample.decode("utf-8")
+        except UnicodeDecodeError:
+            return False
+        return True
+    finally:
+        file.seek(pos)
+
+def _open_image(file):
+    from PIL import Image
+
+    pos = file.tell()
+    try:
+        img = Image.open(file)
+        img.verify()
+        file.seek(pos)
+        return Image.open(file)
+    except Exception:
+        file.seek(pos)
+        return None
+
+
+EXT_BY_FORMAT = {"JPEG": "jpg", "PNG": "png", "GIF": "gif"}
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+# Text attachments are stored gzip-compressed as "<name>.txt.gz"; the storage
+# serves them with Content-Encoding: gzip (see comments/storage.py).
+GZIP_SUFFIX = ".gz"
+TEXT_PREVIEW_LINES = 10
+TEXT_PREVIEW_CHARS = 1024
+
+
+def pack_text(name: str, data: bytes) -> dict:
+    """Compressed bytes, stored name, preview and counts for a validated text file."""
+    text = data.decode("utf-8", errors="replace")
+    preview = "".join(text.splitlines(keepends=True)[:TEXT_PREVIEW_LINES])[:TEXT_PREVIEW_CHARS]
+    return {
+        "name": name if name.endswith(GZIP_SUFFIX) else name + GZIP_SUFFIX,
+        "data": gzip.compress(data, mtime=0),
+        "preview": preview.rstrip("\r\n"),
+        "line_count": len(text.splitlines()),
+        "char_count": len(text),
+    }
+
+
+def read_text(file) -> str:
+    """Text of a stored text attachment, compressed or not."""
+    with file.open("rb") as f:
+        data = f.read()
+    if file.name.endswith(GZIP_SUFFIX):
+        data = gzip.decompress(data)
+    return data.decode("utf-8")
+
+
+def make_thumbnail(img, fmt):
+    """Fit ``img`` into MAX_IMAGE_SIZE; returns (bytes, extension, (width, height))."""
+    from PIL import ImageOps
+
+    deadlines.check()
+    img = ImageOps.exif_transpose(img)
+    deadlines.check()
+    img.thumbnail(MAX_IMAGE_SIZE)
+    deadlines.check()
+
+    buf = io.BytesIO()
+    save_kwargs = {"optimize": True}
+    if fmt == "JPEG":
+        save_kwargs["quality"] = 85
+    img.save(buf, format=fmt, **save_kwargs)
+    return buf.getvalue(), EXT_BY_FORMAT[fmt], img.size
+
+
+def prepare_upload(name: str, data: bytes, timeout=None) -> dict:
+    """
+        Validate one uploaded file and thumbnail it if it is an image.
+
+        Returns the attachment fields plus the bytes to store; raises
+        ``ValueError`` with a user-facing message for rejected files and
+        ``DeadlineExceeded`` once ``timeout`` seconds have passed.
+    """
+    if timeout is not None:
+        with deadlines.expires_in(timeout, "upload"):
+            return prepare_upload(name, data)
+
+    f = ContentFile(data, name=name)
+    img = _open_image(f)
+    if img is not None:
+        fmt = (getattr(img, "format", "") or "").upper()
+        if fmt not in ALLOWED_IMAGE_FORMATS:
+            raise ValueError("Допустимы только JPG, PNG или GIF.")
+        thumb, ext, (width, height) = make_thumbnail(img, fmt)
+        return {
+            "name": f"{name.rsplit('.', 1)[0]}.{ext}",
+            "data": thumb,
+            "content_type": MIME_BY_FORMAT[fmt],
+            "is_image": True,
+            "width": width,
+            "height": height,
+            "size": len(thumb),
+        }
+
+    if _is_text_file(f, MAX_TXT_SIZE):
+        return {
+            **pack_text(name, data),
+            "content_type": TEXT_CONTENT_TYPE,
+            "is_image": False,
+            "width": None,
+            "height": None,
+            "size": len(data),
+        }
+
+    raise ValueError("Разрешены только изображения (JPG/PNG/GIF) или TXT ≤ 100KB.")
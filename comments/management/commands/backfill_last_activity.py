@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce, Greatest
+
+from comments import sharding
+from comments.models import Comment
+from comments.routers import use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute last_activity_at of top-level comments as the newest "
+        "created_at in their thread (replies at any depth), on every shard."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true", help="Count threads that would change, write nothing.")
+
+    def handle(self, *args, **opts):
+        seen = changed = 0
+        for alias in sharding.aliases():
+            with use_shard(alias):
+                shard_seen, shard_changed = self._backfill(alias, opts)
+            seen += shard_seen
+            changed += shard_changed
+
+        verb = "would change" if opts["dry_run"] else "updated"
+        self.stdout.write(f"checked {seen} threads, {changed} {verb}")
+
+    def _backfill(self, alias, opts):
+        """``(checked, changed)`` threads on shard ``alias``."""
+        roots = Comment.objects.filter(parent__isnull=True).order_by("id")
+        seen = changed = 0
+        last_id = 0
+        while True:
+            batch = list(roots.filter(pk__gt=last_id).values_list("id", "created_at", "last_activity_at")[: opts["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            seen += len(batch)
+
+            # Newest reply per root, walking the threads one level at a time.
+            newest = {}
+            root_of = {pk: pk for pk, _, _ in batch}
+            level = list(root_of)
+            while level:
+                children = list(Comment.objects.filter(parent_id__in=level).values_list("id", "parent_id", "created_at"))
+                for pk, parent_id, created in children:
+                    root = root_of[pk] = root_of[parent_id]
+                    if root not in newest or created > newest[root]:
+                        newest[root] = created
+                level = [pk for pk, _, _ in children]
+
+            stale = {}
+            for pk, created, current in batch:
+                if current is None:
+                    stale[pk] = newest.get(pk, created)
+                elif pk in newest and newest[pk] > current:
+                    stale[pk] = newest[pk]
+            changed += len(stale)
+            if stale and not opts["dry_run"]:
+                with transaction.atomic(using=alias):
+                    for pk, at in stale.items():
+                        # GREATEST keeps a newer value written by a concurrent reply.
+                        Comment.objects.filter(pk=pk).update(
+                            last_activity_at=Greatest(Coalesce("last_activity_at", Value(at)), Value(at))
+                        )
+        return seen, changed
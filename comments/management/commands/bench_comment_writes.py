@@ -0,0 +1,93 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from comments import cache as tiered_cache
+from comments.coalescing import CoalescingWriter, NewComment, write_one
+from comments.models import Comment, CommentChange, ThreadNamespace, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Sustained comment inserts per second from concurrent threads, one "
+        "transaction per comment vs the coalescing writer. Rows go to a "
+        "throwaway section and are deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16, help="Concurrent writers (request threads).")
+        parser.add_argument("--seconds", type=float, default=5.0, help="Duration of each run.")
+        parser.add_argument("--window-ms", type=float, default=settings.COMMENT_COALESCE_WINDOW_MS)
+        parser.add_argument("--max-batch", type=int, default=settings.COMMENT_COALESCE_MAX_BATCH)
+        parser.add_argument("--keep", action="store_true", help="Keep the inserted rows.")
+
+    def handle(self, *args, **opts):
+        if opts["threads"] < 1 or opts["seconds"] <= 0:
+            raise CommandError("--threads and --seconds must be positive.")
+        key = f"bench/{int(time.time())}"
+        self.stdout.write(f"{opts['threads']} threads x {opts['seconds']:.0f}s into section {key!r} on {connection.vendor}")
+        try:
+            self._run("one transaction each", key, opts, write_one)
+            writer = CoalescingWriter(opts["window_ms"] / 1000, opts["max_batch"])
+            self._run(
+                f"coalesced ({opts['window_ms']:g} ms, <= {opts['max_batch']})", key, opts,
+                lambda item: writer.submit(item).result(),
+            )
+        finally:
+            if not opts["keep"]:
+                self._cleanup(key)
+
+    def _run(self, label, key, opts, write):
+        stop = time.monotonic() + opts["seconds"]
+        done, errors, latencies = [0], [0], []
+        lock = threading.Lock()
+
+        def worker(n):
+            i = 0
+            try:
+                while time.monotonic() < stop:
+                    i += 1
+                    item = NewComment(
+                        name=f"bench{n}", email=f"bench{n}@example.com", text_raw=f"comment {i}",
+                        text_html=f"comment {i}", thread_key=key, ip="127.0.0.1", user_agent="bench",
+                    )
+                    started = time.perf_counter()
+                    try:
+                        write(item)
+                    except Exception:
+                        with lock:
+                            errors[0] += 1
+                        continue
+                    with lock:
+                        done[0] += 1
+                        latencies.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(opts["threads"])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - started
+
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000 if latencies else 0
+        self.stdout.write(
+            f"  {label:32} {done[0] / elapsed:8.0f} inserts/s, p50 {p50:.1f} ms, p99 {p99:.1f} ms, {errors[0]} errors"
+        )
+
+    def _cleanup(self, key):
+        with transaction.atomic():
+            # Authors cascade to their comments and thread snapshots.
+            User.objects.filter(comment__thread_key=key).delete()
+            CommentChange.objects.filter(thread_key=key).delete()
+            ThreadNamespace.objects.filter(key=key).delete()
+        tiered_cache.invalidate("comments")
+        left = Comment.objects.filter(thread_key=key).count()
+        self.stdout.write(f"cleaned up section {key!r}" + (f" ({left} rows left)" if left else ""))
@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import connection
+
+from comments import dbpool, deadlines
+from comments.models import Comment
+
+MODES = {"persistent": "0", "pool": "1"}
+
+
+def _pct(values, p):
+    return values[min(len(values) - 1, len(values) * p // 100)] if values else 0.0
+
+
+class Command(BaseCommand):
+    help = (
+        "Scale-out benchmark: worker processes with request threads start one "
+        "after another and run a top-level page query per request, with one "
+        "persistent connection per thread vs a per-process pool (DB_POOL). "
+        "Reports peak Postgres connections, throughput and latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Worker processes (gunicorn workers).")
+        parser.add_argument("--threads", type=int, default=8, help="Request threads per worker.")
+        parser.add_argument("--stagger", type=float, default=1.0, help="Seconds between worker starts.")
+        parser.add_argument("--seconds", type=float, default=5.0, help="Run time of each worker.")
+        parser.add_argument("--pool-max", type=int, help="DB_POOL_MAX for the pool run (default: threads + 2).")
+        parser.add_argument("--think-ms", type=float, default=2.0, help="Non-database time per request.")
+        parser.add_argument("--pgbouncer", action="store_true", help="Both runs with DB_PGBOUNCER=1.")
+        parser.add_argument("--modes", default="persistent,pool")
+        parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+
+    def handle(self, *args, **opts):
+        if opts["worker"]:
+            return self._worker(opts)
+        if connection.vendor != "postgresql":
+            raise CommandError("Needs PostgreSQL (DB_HOST): connections are counted in pg_stat_activity.")
+        if opts["workers"] < 1 or opts["threads"] < 1 or opts["seconds"] <= 0:
+            raise CommandError("--workers, --threads and --seconds must be positive.")
+        modes = [m.strip() for m in opts["modes"].split(",") if m.strip()]
+        if not set(modes) <= set(MODES):
+            raise CommandError(f"--modes: choose from {', '.join(MODES)}")
+
+        self.stdout.write(
+            f"{opts['workers']} workers x {opts['threads']} threads, one every {opts['stagger']:g}s, "
+            f"{opts['seconds']:g}s each" + (", PgBouncer mode" if opts["pgbouncer"] else "")
+        )
+        for mode in modes:
+            self._run(mode, opts)
+
+    def _run(self, mode, opts):
+        env = {
+            **os.environ,
+            "DB_POOL": MODES[mode],
+            "DB_POOL_MAX": str(opts["pool_max"] or opts["threads"] + 2),
+            "DB_PGBOUNCER": "1" if opts["pgbouncer"] else "0",
+        }
+        cmd = [
+            sys.executable, sys.argv[0], "bench_db_connections", "--worker",
+            "--threads", str(opts["threads"]), "--seconds", str(opts["seconds"]), "--think-ms", str(opts["think_ms"]),
+        ]
+        baseline = self._connections()
+        samples, stop = [], threading.Event()
+
+        def sample():
+            while not stop.is_set():
+                samples.append(self._connections() - baseline)
+                stop.wait(0.1)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        started = time.monotonic()
+        procs = []
+        try:
+            for n in range(opts["workers"]):
+                if n:
+                    time.sleep(opts["stagger"])
+                procs.append(subprocess.Popen(cmd, cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, text=True))
+            outputs = [p.communicate()[0] for p in procs]
+        finally:
+            for p in procs:
+                if p.poll() is None:
+                    p.kill()
+            stop.set()
+            sampler.join()
+        elapsed = time.monotonic() - started
+        connection.close()
+
+        latencies, cold, errors, requests, pools = [], [], 0, 0, []
+        for p, out in zip(procs, outputs):
+            if p.returncode:
+                raise CommandError(f"{mode}: a worker exited with {p.returncode}")
+            result = json.loads(out.strip().splitlines()[-1])
+            latencies += result["latencies"]
+            cold += result["cold"]
+            errors += result["errors"]
+            requests += len(result["latencies"])
+            pools.append(result["pool"].get("default"))
+        latencies.sort()
+        cold.sort()
+        self.stdout.write(
+            f"  {mode:10} peak {max(samples, default=0):4d} connections, {requests / elapsed:7.0f} req/s, "
+            f"p50 {_pct(latencies, 50):.1f} ms, p99 {_pct(latencies, 99):.1f} ms, "
+            f"p99 in a worker's first second {_pct(cold, 99):.1f} ms, {errors} errors"
+        )
+        pools = [p for p in pools if p]
+        if pools:
+            checkouts = sum(p["checkouts"] for p in pools)
+            wait = sum(p["wait_ms"] for p in pools)
+            self.stdout.write(
+                f"  {'':10} pool: {checkouts} checkouts, {sum(p['queued'] for p in pools)} waited "
+                f"({wait / checkouts if checkouts else 0:.2f} ms avg), "
+                f"{sum(p['connections_opened'] for p in pools)} connections opened, "
+                f"{sum(p['timeouts'] for p in pools)} timeouts"
+            )
+
+    def _connections(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()"
+            )
+            return cursor.fetchone()[0]
+
+    def _worker(self, opts):
+        # One gunicorn worker: request threads with Django's request signals around each request.
+        started = time.monotonic()
+        stop = started + opts["seconds"]
+        latencies, cold, errors = [], [], [0]
+        lock = threading.Lock()
+        qs = Comment.objects.filter(parent__isnull=True, deleted_at__isnull=True).order_by("-created_at", "-id")
+
+        def thread():
+            while time.monotonic() < stop:
+                request_started.send(sender=self.__class__)
+                t = time.perf_counter()
+                try:
+                    with deadlines.budget("comments"), deadlines.atomic(Comment):
+                        list(qs.values_list("id", flat=True)[:25])
+                    time.sleep(opts["think_ms"] / 1000)
+                except Exception:
+                    with lock:
+                        errors[0] += 1
+                    continue
+                finally:
+                    request_finished.send(sender=self.__class__)
+                ms = (time.perf_counter() - t) * 1000
+                with lock:
+                    latencies.append(ms)
+                    if time.monotonic() - started < 1:
+                        cold.append(ms)
+            connection.close()
+
+        threads = [threading.Thread(target=thread) for _ in range(opts["threads"])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.stdout.write(json.dumps({
+            "latencies": latencies, "cold": cold, "errors": errors[0], "pool": dbpool.stats(),
+        }))
@@ -0,0 +1,85 @@
+import datetime as dt
+import hashlib
+import secrets
+import statistics
+import time
+
+from django.core.files.storage import Storage
+from django.core.management.base import BaseCommand, CommandError
+
+from comments import cache as tiered_cache
+from comments import file_urls
+
+
+class SigningStorage(Storage):
+    """
+        Stand-in for GoogleCloudStorage with ``querystring_auth``: every
+        ``url()`` signs with an RSA-2048 key, as a V4 signed URL does.
+    """
+
+    querystring_auth = True
+    bucket_name = "bench-bucket"
+    expiration = dt.timedelta(days=1)
+
+    def __init__(self):
+        self.calls = 0
+        try:
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.asymmetric import padding, rsa
+        except ImportError:
+            # Two 1024-bit exponentiations cost about what a CRT RSA-2048 private-key op does.
+            mods = [(secrets.randbits(1024) | (1 << 1023) | 1, secrets.randbits(1024)) for _ in range(2)]
+            self._sign = lambda data: [
+                pow(int.from_bytes(hashlib.sha256(data).digest(), "big"), d, n) for n, d in mods
+            ]
+            self.signer = "modexp-2x1024"
+        else:
+            key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            self._sign = lambda data: key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+            self.signer = "rsa-2048"
+
+    def url(self, name):
+        self.calls += 1
+        expires = int(time.time()) + int(self.expiration.total_seconds())
+        sig = self._sign(f"GET\n{expires}\n/{self.bucket_name}/{name}".encode())
+        digest = hashlib.sha256(str(sig).encode()).hexdigest()
+        return f"https://storage.googleapis.com/{self.bucket_name}/{name}?X-Goog-Expires={expires}&X-Goog-Signature={digest}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Attachment URL benchmark for a signing storage: storage.url() per "
+        "attachment vs file_urls.urls() per page (one cache round trip, signs misses only)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--files", type=int, default=500, help="Distinct attachments.")
+        parser.add_argument("--page", type=int, default=50, help="Attachments per rendered page.")
+        parser.add_argument("--pages", type=int, default=200, help="Pages rendered per strategy.")
+
+    def handle(self, *args, **opts):
+        files, page, pages = opts["files"], opts["page"], opts["pages"]
+        if min(files, page, pages) < 1:
+            raise CommandError("--files, --page and --pages must be positive.")
+        storage = SigningStorage()
+        names = [f"attachments/2026/01/01/file-{i}.png" for i in range(files)]
+        batches = [[names[(p * page + i) % files] for i in range(page)] for p in range(pages)]
+        tiered_cache.invalidate(file_urls.NS)
+
+        self.stdout.write(f"signer: {storage.signer}, {files} files, {pages} pages x {page} attachments")
+        self._run("per attachment", storage, batches, lambda b: [storage.url(n) for n in b])
+        self._run("batched + cached", storage, batches, lambda b: file_urls.urls(b, storage))
+
+    def _run(self, label, storage, batches, render):
+        storage.calls = 0
+        times = []
+        for batch in batches:
+            started = time.perf_counter()
+            render(batch)
+            times.append((time.perf_counter() - started) * 1000)
+        times.sort()
+        self.stdout.write(
+            f"  {label:18} {statistics.mean(times):8.2f} ms/page mean, "
+            f"p50 {times[len(times) // 2]:.2f}, p99 {times[min(len(times) - 1, len(times) * 99 // 100)]:.2f}, "
+            f"{storage.calls} signatures"
+        )
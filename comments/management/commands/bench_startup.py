@@ -0,0 +1,103 @@
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+IMPORTTIME_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = (
+        "Startup benchmark: `python -X importtime` report for loading the app and "
+        "time until the first successful POST /graphql/."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=15, help="Slowest top-level imports to show.")
+        parser.add_argument("--server", choices=["gunicorn", "runserver"], default="gunicorn")
+        parser.add_argument("--fast-start", action="store_true", help="Boot with FAST_START=1.")
+        parser.add_argument("--timeout", type=float, default=60.0)
+
+    def handle(self, *args, **opts):
+        base = settings.BASE_DIR
+        env = {**os.environ, "DJANGO_SETTINGS_MODULE": "core.settings"}
+        if opts["fast_start"]:
+            env["FAST_START"] = "1"
+
+        self._importtime(base, env, opts["top"])
+        self._first_response(base, env, opts["server"], opts["timeout"])
+
+    def _importtime(self, base, env, top):
+        code = "import core.wsgi; import core.urls"
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=base, env=env, capture_output=True, text=True,
+        )
+        if proc.returncode:
+            raise CommandError(proc.stderr[-2000:])
+
+        # Self time summed per top-level package.
+        by_package = defaultdict(int)
+        total = 0
+        for line in proc.stderr.splitlines():
+            m = IMPORTTIME_RE.match(line)
+            if not m:
+                continue
+            by_package[m.group(4).split(".")[0]] += int(m.group(1))
+            if len(m.group(3)) <= 1:
+                total += int(m.group(2))
+        rows = sorted(by_package.items(), key=lambda kv: kv[1], reverse=True)
+
+        self.stdout.write(f"import core.wsgi + core.urls: {total / 1000:.1f} ms")
+        for name, us in rows[:top]:
+            self.stdout.write(f"  {us / 1000:9.1f} ms  {name}")
+
+    def _first_response(self, base, env, server, timeout):
+        port = _free_port()
+        if server == "gunicorn":
+            cmd = [sys.executable, "-m", "gunicorn", "core.wsgi:application",
+                   "--bind", f"127.0.0.1:{port}", "--workers", "1"]
+            if env.get("FAST_START") == "1":
+                cmd += ["-c", "core/gunicorn_conf.py"]
+        else:
+            cmd = [sys.executable, "manage.py", "runserver", "--noreload", f"127.0.0.1:{port}"]
+
+        body = json.dumps({"query": "{ __typename }"}).encode()
+        started = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=base, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - started < timeout:
+                if proc.poll() is not None:
+                    raise CommandError(f"{server} exited with {proc.returncode}")
+                req = urllib.request.Request(
+                    f"http://127.0.0.1:{port}/graphql/", data=body,
+                    headers={"Content-Type": "application/json", "Host": "localhost"},
+                )
+                try:
+                    with urllib.request.urlopen(req, timeout=2) as resp:
+                        if resp.status == 200:
+                            elapsed = time.perf_counter() - started
+                            self.stdout.write(f"first /graphql/ 200 after {elapsed * 1000:.0f} ms ({server})")
+                            return
+                except (urllib.error.URLError, ConnectionError, OSError):
+                    pass
+                time.sleep(0.05)
+            raise CommandError(f"no successful /graphql/ response within {timeout}s")
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
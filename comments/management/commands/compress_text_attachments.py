@@ -0,0 +1,92 @@
+import gzip
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from comments import cache as tiered_cache
+from comments import sharding, snapshots
+from comments.imaging import GZIP_SUFFIX, pack_text
+from comments.models import Attachment, Comment
+from comments.routers import use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Store text attachments uploaded before compression as *.txt.gz and "
+        "fill in their preview, line and character counts, on every shard."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=200)
+        parser.add_argument("--dry-run", action="store_true", help="Count attachments that would change, write nothing.")
+        parser.add_argument("--keep-originals", action="store_true", help="Don't delete the uncompressed files.")
+
+    def handle(self, *args, **opts):
+        totals = [0, 0, 0, 0]
+        for alias in sharding.aliases():
+            with use_shard(alias):
+                totals = [a + b for a, b in zip(totals, self._compress(alias, opts))]
+        seen, changed, missing, saved = totals
+
+        if changed and not opts["dry_run"]:
+            tiered_cache.invalidate("comments")
+        verb = "would change" if opts["dry_run"] else "updated"
+        self.stdout.write(
+            f"checked {seen} text attachments, {changed} {verb}, {missing} missing, {saved / 1024:.0f} KB saved"
+        )
+
+    def _compress(self, alias, opts):
+        """``(checked, changed, missing, bytes saved)`` on shard ``alias``."""
+        storage = Attachment._meta.get_field("file").storage
+        pending = Attachment.objects.filter(is_image=False, line_count__isnull=True).order_by("id")
+        seen = changed = missing = saved = 0
+        last_id = 0
+        while True:
+            batch = list(pending.filter(pk__gt=last_id)[: opts["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            seen += len(batch)
+
+            updated, originals = [], []
+            for att in batch:
+                name = att.file.name
+                try:
+                    with storage.open(name, "rb") as f:
+                        data = f.read()
+                except (FileNotFoundError, OSError):
+                    missing += 1
+                    self.stderr.write(f"  attachment {att.id}: {name} is missing")
+                    continue
+                if name.endswith(GZIP_SUFFIX):
+                    data = gzip.decompress(data)
+                packed = pack_text(name, data)
+                att.preview, att.line_count, att.char_count = (
+                    packed["preview"], packed["line_count"], packed["char_count"],
+                )
+                if not name.endswith(GZIP_SUFFIX):
+                    saved += len(data) - len(packed["data"])
+                    if not opts["dry_run"]:
+                        att.file.name = storage.save(packed["name"], ContentFile(packed["data"]))
+                        originals.append(name)
+                updated.append(att)
+            changed += len(updated)
+            if not updated or opts["dry_run"]:
+                continue
+
+            with transaction.atomic(using=alias):
+                Attachment.objects.bulk_update(updated, ["file", "preview", "line_count", "char_count"])
+                roots = {
+                    snapshots.find_root_id(pk, parent_id)
+                    for pk, parent_id in Comment.objects.filter(
+                        pk__in={a.comment_id for a in updated}
+                    ).values_list("pk", "parent_id")
+                }
+                for root in Comment.objects.filter(pk__in=roots):
+                    snapshots.rebuild(root)
+            if not opts["keep_originals"]:
+                for name in originals:
+                    storage.delete(name)
+
+        return seen, changed, missing, saved
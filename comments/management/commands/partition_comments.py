@@ -0,0 +1,66 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from comments import cache as tiered_cache
+from comments import partitioning, sharding
+from comments.routers import use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Maintain monthly partitions of comments_comment: create future partitions "
+        "and detach/archive old ones to gzip-compressed NDJSON, on every shard "
+        "(archived under --archive-dir/<shard> when sharded). Run daily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ahead", type=int, default=3, help="Months to pre-create.")
+        parser.add_argument("--archive-older-than", type=int, metavar="MONTHS",
+                            help="Archive partitions entirely older than this many months.")
+        parser.add_argument("--archive-dir", default=str(settings.BASE_DIR / "archive"))
+        parser.add_argument("--keep-detached", action="store_true",
+                            help="Leave archived partitions as detached tables instead of dropping them.")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **opts):
+        for alias in sharding.aliases():
+            if sharding.enabled():
+                self.stdout.write(f"{alias}:")
+            with use_shard(alias):
+                self._maintain(alias, opts)
+
+    def _maintain(self, alias, opts):
+        connection = connections[alias]
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning is only supported on PostgreSQL.")
+        # Partitions of every shard have the same names.
+        archive_dir = os.path.join(opts["archive_dir"], alias) if sharding.enabled() else opts["archive_dir"]
+
+        with transaction.atomic(using=alias), connection.cursor() as cursor:
+            if not partitioning.is_partitioned(cursor):
+                raise CommandError(
+                    f"comments_comment is not partitioned on {alias!r}; set COMMENTS_PARTITIONED=1 and run migrate."
+                )
+
+            if opts["dry_run"]:
+                self.stdout.write(f"existing: {[str(m) for m in partitioning.list_partitions(cursor)]}")
+            else:
+                for name in partitioning.ensure_partitions(cursor, opts["ahead"]):
+                    self.stdout.write(f"created {name}")
+
+            if opts["archive_older_than"] is not None:
+                done = partitioning.archive_partitions(
+                    cursor,
+                    opts["archive_older_than"],
+                    archive_dir,
+                    drop=not opts["keep_detached"],
+                    dry_run=opts["dry_run"],
+                )
+                verb = "would archive" if opts["dry_run"] else "archived"
+                for name, rows, replies, attachments in done:
+                    self.stdout.write(f"{verb} {name}: {rows} rows, {replies} later replies, {attachments} attachments")
+                if done and not opts["dry_run"]:
+                    transaction.on_commit(lambda: tiered_cache.invalidate("comments"), using=alias)
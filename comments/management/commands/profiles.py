@@ -0,0 +1,65 @@
+import os
+import sys
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from comments import profiling
+
+
+class Command(BaseCommand):
+    help = (
+        "Work with request profiles captured by comments.profiling: issue an "
+        "X-Profile token, list stored profiles or merge them into one "
+        "collapsed-stack file for flamegraph.pl / speedscope."
+    )
+
+    def add_arguments(self, parser):
+        sub = parser.add_subparsers(dest="action", required=True)
+        sub.add_parser("token", help="Print a signed X-Profile header value.")
+
+        ls = sub.add_parser("list", help="List stored profiles, newest first.")
+        ls.add_argument("--tag", help="Only this operation/view.")
+        ls.add_argument("--limit", type=int, default=50)
+
+        merge = sub.add_parser("merge", help="Merge profiles into one collapsed-stack file.")
+        merge.add_argument("names", nargs="*", help="Profile file names; default: all matching --tag.")
+        merge.add_argument("--tag", help="Only this operation/view.")
+        merge.add_argument("-o", "--output", help="Output file (default: stdout).")
+
+    def handle(self, *args, **opts):
+        getattr(self, f"_{opts['action']}")(opts)
+
+    def _token(self, opts):
+        self.stdout.write(profiling.make_token())
+
+    def _selected(self, opts, names=()):
+        profiles = profiling.list_profiles()
+        if names:
+            known = {p["name"]: p for p in profiles}
+            missing = [n for n in names if n not in known]
+            if missing:
+                raise CommandError(f"Unknown profiles: {', '.join(missing)}")
+            return [known[n] for n in names]
+        return [p for p in profiles if not opts["tag"] or p["tag"] == opts["tag"]]
+
+    def _list(self, opts):
+        for p in self._selected(opts)[: opts["limit"]]:
+            self.stdout.write(f"{p['name']}  {p['tag']}  {p['ms']} ms")
+
+    def _merge(self, opts):
+        profiles = self._selected(opts, opts["names"])
+        if not profiles:
+            raise CommandError("No profiles to merge.")
+        total = Counter()
+        for p in profiles:
+            total.update(profiling.read_profile(p["path"]))
+        out = open(opts["output"], "w", encoding="utf-8") if opts["output"] else sys.stdout
+        try:
+            for stack, n in total.most_common():
+                out.write(f"{stack} {n}\n")
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if opts["output"]:
+            self.stderr.write(f"merged {len(profiles)} profiles into {os.path.abspath(opts['output'])}")
@@ -0,0 +1,63 @@
+import datetime as dt
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from comments import deletion, sharding
+from comments.models import Comment, OrphanedFile
+from comments.routers import use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete soft-deleted comment subtrees older than --days for good, in "
+        "batches, then remove the files of their attachments from storage. "
+        "Meant to run from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=float, default=settings.COMMENT_TOMBSTONE_DAYS,
+                            help="Keep subtrees hidden less than this long (restorable from the admin).")
+        parser.add_argument("--root", type=int, action="append", help="Purge these comments now, hidden or not.")
+        parser.add_argument("--batch-size", type=int, default=settings.COMMENT_PURGE_BATCH)
+        parser.add_argument("--dry-run", action="store_true", help="Count what would be purged, delete nothing.")
+        parser.add_argument("--files-only", action="store_true", help="Only sweep the queued attachment files.")
+
+    def handle(self, *args, **opts):
+        if not opts["files_only"]:
+            if opts["root"]:
+                roots = list(opts["root"])
+            else:
+                cutoff = timezone.now() - dt.timedelta(days=opts["days"])
+                roots = []
+                for alias in sharding.aliases():
+                    with use_shard(alias):
+                        roots += Comment.objects.filter(deleted_at__lte=cutoff).order_by("deleted_at").values_list(
+                            "pk", flat=True,
+                        )
+            if opts["dry_run"]:
+                total = sum(deletion.subtree_size(pk) for pk in roots)
+                self.stdout.write(f"would purge {len(roots)} subtrees, {total} comments")
+                self.stdout.write(f"{_queued()} files queued for deletion")
+                return
+            removed = 0
+            for pk in roots:
+                n = deletion.purge(pk, opts["batch_size"])
+                removed += n
+                self.stdout.write(f"  comment {pk}: {n} comments removed")
+            self.stdout.write(f"purged {len(roots)} subtrees, {removed} comments")
+        elif opts["dry_run"]:
+            self.stdout.write(f"{_queued()} files queued for deletion")
+            return
+
+        deleted, failed = deletion.sweep_files(opts["batch_size"])
+        self.stdout.write(f"deleted {deleted} files" + (f", {failed} failed (still queued)" if failed else ""))
+
+
+def _queued():
+    total = 0
+    for alias in sharding.aliases():
+        with use_shard(alias):
+            total += OrphanedFile.objects.count()
+    return total
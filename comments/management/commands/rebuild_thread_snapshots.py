@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+
+from comments import sharding, snapshots
+from comments.models import Comment, ThreadSnapshot
+from comments.routers import use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild per-thread snapshot documents from the comment tables, or with "
+        "--check compare stored snapshots against a fresh build."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--root", type=int, action="append", help="Only these root comment ids.")
+        parser.add_argument("--check", action="store_true", help="Report missing/stale snapshots, write nothing.")
+        parser.add_argument("--fix", action="store_true", help="With --check, rebuild the ones that differ.")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **opts):
+        roots = Comment.objects.filter(parent__isnull=True, deleted_at__isnull=True).select_related("author").order_by("id")
+        if opts["root"]:
+            roots = roots.filter(pk__in=opts["root"])
+
+        seen = rebuilt = bad = 0
+        for alias in sharding.aliases():
+            with use_shard(alias):
+                counts = self._rebuild(roots, opts)
+            seen, rebuilt, bad = seen + counts[0], rebuilt + counts[1], bad + counts[2]
+
+        if opts["check"]:
+            self.stdout.write(f"checked {seen} threads, {bad} inconsistent, {rebuilt} rebuilt")
+            if bad and not opts["fix"]:
+                raise SystemExit(1)
+        else:
+            self.stdout.write(f"rebuilt {rebuilt} thread snapshots")
+
+    def _rebuild(self, roots, opts):
+        seen = rebuilt = bad = 0
+        last_id = 0
+        while True:
+            batch = list(roots.filter(pk__gt=last_id)[: opts["batch_size"]])
+            if not batch:
+                return seen, rebuilt, bad
+            last_id = batch[-1].pk
+            stored = dict(
+                ThreadSnapshot.objects.filter(root_id__in=[r.pk for r in batch]).values_list("root_id", "document")
+            )
+            for root in batch:
+                seen += 1
+                if opts["check"]:
+                    fresh = snapshots.build_document(root)
+                    if stored.get(root.pk) == fresh:
+                        continue
+                    bad += 1
+                    state = "missing" if root.pk not in stored else "stale"
+                    self.stdout.write(f"{state}: thread {root.pk}")
+                    if not opts["fix"]:
+                        continue
+                with transaction.atomic(using=router.db_for_write(ThreadSnapshot)):
+                    snapshots.rebuild(root)
+                rebuilt += 1
@@ -0,0 +1,139 @@
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from comments import cache as tiered_cache
+from comments import sharding, snapshots
+from comments.models import Comment
+from comments.routers import PRIMARY_DB, use_shard
+from comments.utils import SANITIZE_POLICY_VERSION, sanitize_many
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-run the HTML sanitizer over comments stored under an older "
+        "SANITIZE_POLICY_VERSION. text_raw is streamed in id order, sanitized in "
+        "a process pool and only rows whose text_html changed are rewritten. "
+        "Shards are processed one after another."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("--dry-run", action="store_true", help="Count rows that would change, write nothing.")
+        parser.add_argument(
+            "--checkpoint", default="resanitize_comments.checkpoint",
+            help="File storing the last processed id of each shard; the run resumes from it.",
+        )
+        parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint.")
+
+    def handle(self, *args, **opts):
+        version = SANITIZE_POLICY_VERSION
+        batch_size, workers = opts["batch_size"], max(opts["workers"], 1)
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive.")
+        dry_run, checkpoint = opts["dry_run"], opts["checkpoint"]
+        self.verbosity = opts["verbosity"]
+
+        positions = {} if opts["restart"] or dry_run else self._load(checkpoint, version)
+        stale = Comment.objects.filter(sanitize_version__lt=version).order_by("id")
+
+        def chunks(after):
+            while True:
+                rows = list(stale.filter(pk__gt=after).values_list("id", "text_raw", "text_html")[:batch_size])
+                if not rows:
+                    return
+                after = rows[-1][0]
+                yield rows
+
+        seen = changed = 0
+        started = time.monotonic()
+
+        def drain(alias, rows, future):
+            nonlocal seen, changed
+            changed += self._apply(alias, rows, future.result(), version, dry_run)
+            seen += len(rows)
+            if not dry_run:
+                positions[alias] = rows[-1][0]
+                self._save(checkpoint, positions)
+            if self.verbosity >= 2:
+                rate = seen / (time.monotonic() - started)
+                self.stdout.write(
+                    f"  {alias} up to id {rows[-1][0]}: {seen} checked, {changed} changed, {rate:.0f} rows/s"
+                )
+
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            for alias in sharding.aliases():
+                if positions.get(alias):
+                    self.stdout.write(f"resuming {alias} after id {positions[alias]}")
+                with use_shard(alias):
+                    pending = deque()
+                    for rows in chunks(positions.get(alias, 0)):
+                        pending.append((alias, rows, pool.submit(sanitize_many, [(pk, raw) for pk, raw, _ in rows])))
+                        if len(pending) >= workers * 2:
+                            drain(*pending.popleft())
+                    while pending:
+                        drain(*pending.popleft())
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        elapsed = time.monotonic() - started
+        verb = "would change" if dry_run else "changed"
+        self.stdout.write(
+            f"{seen} rows checked, {changed} {verb}, {elapsed:.1f}s ({seen / elapsed if elapsed else 0:.0f} rows/s)"
+        )
+        if not dry_run:
+            if changed:
+                tiered_cache.invalidate("comments")
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+
+    def _apply(self, alias, rows, fresh, version, dry_run) -> int:
+        """Write back one chunk; returns the number of rows whose ``text_html`` changed."""
+        old = {pk: html for pk, _, html in rows}
+        diff = {pk: html for pk, html in fresh if html != old[pk]}
+        if self.verbosity >= 3:
+            for pk in diff:
+                self.stdout.write(f"  changed: comment {pk}")
+        if dry_run:
+            return len(diff)
+
+        with transaction.atomic(using=alias):
+            if diff:
+                Comment.objects.bulk_update(
+                    [Comment(pk=pk, text_html=html, sanitize_version=version) for pk, html in diff.items()],
+                    ["text_html", "sanitize_version"],
+                )
+                snapshots.patch_text(list(diff), diff)
+            same = [pk for pk in old if pk not in diff]
+            if same:
+                Comment.objects.filter(pk__in=same).update(sanitize_version=version)
+        return len(diff)
+
+    def _load(self, path, version) -> dict:
+        """``{shard: last processed id}`` from the checkpoint."""
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            raise CommandError(f"Unreadable checkpoint {path}; pass --restart to ignore it.")
+        if state.get("version") != version:
+            return {}
+        last_id = state["last_id"]
+        # Checkpoints from before sharding hold one id, on "default".
+        return {PRIMARY_DB: last_id} if isinstance(last_id, int) else last_id
+
+    def _save(self, path, positions):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": SANITIZE_POLICY_VERSION, "last_id": positions}, f)
+        os.replace(tmp, path)
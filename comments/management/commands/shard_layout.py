@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models.functions import Mod
+
+from comments import sharding
+from comments.models import Comment, IdSequence
+from comments.routers import PRIMARY_DB, use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare COMMENT_SHARDS with the shard list comment ids were allocated "
+        "under and count the threads whose shard would change. Comment writes "
+        "and migrate refuse a changed list until --accept records it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--accept", action="store_true",
+                            help="Record the current COMMENT_SHARDS (after the listed threads were moved).")
+
+    def handle(self, *args, **opts):
+        with transaction.atomic(using=PRIMARY_DB):
+            row = IdSequence.objects.using(PRIMARY_DB).select_for_update().filter(name=sharding.SEQUENCE).first()
+            if row is None:
+                raise CommandError("No comment id sequence; run migrate.")
+            current = sorted(sharding.aliases())
+            recorded = row.shards or current
+            self.stdout.write(f"recorded: {recorded}\ncurrent:  {current}")
+            if recorded == current:
+                return
+
+            old, new = sharding._slot_map(tuple(recorded)), sharding._slot_map(tuple(current))
+            moved = [slot for slot in range(sharding.SLOTS) if old[slot] != new[slot]]
+            self.stdout.write(f"{len(moved)} of {sharding.SLOTS} slots map to another shard")
+            for alias in recorded:
+                if alias not in connections:
+                    self.stdout.write(f"  {alias}: not configured, its threads can't be counted")
+                    continue
+                with use_shard(alias):
+                    n = Comment.objects.filter(
+                        parent__isnull=True, pk__gte=sharding.SHARDED_ID_MIN,
+                    ).annotate(slot=Mod("id", sharding.SLOTS)).filter(slot__in=moved).count()
+                self.stdout.write(f"  {alias}: {n} threads to move")
+
+            if opts["accept"]:
+                row.shards = current
+                row.save(using=PRIMARY_DB, update_fields=["shards"])
+                self.stdout.write("recorded the current layout")
+            elif row.next_value:
+                raise CommandError("Layout changed; move the threads above, then run with --accept.")
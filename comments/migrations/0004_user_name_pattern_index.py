@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-19 18:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0003_alter_attachment_content_type'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['name'], name='comments_user_name_like', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
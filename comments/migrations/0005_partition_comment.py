@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.db import migrations
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql" or not settings.COMMENTS_PARTITIONED:
+        return
+    from comments.partitioning import convert_to_partitioned
+
+    with schema_editor.connection.cursor() as cursor:
+        convert_to_partitioned(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0004_user_name_pattern_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, migrations.RunPython.noop),
+    ]
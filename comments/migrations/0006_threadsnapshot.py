@@ -0,0 +1,22 @@
+# Generated by Django 5.2.5 on 2026-10-19 18:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0005_partition_comment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadSnapshot',
+            fields=[
+                ('root', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='comments.comment')),
+                ('document', models.JSONField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 18:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0006_threadsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='sanitize_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-19 18:43
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def seed_roots(apps, schema_editor):
+    # Replies are folded in by `manage.py backfill_last_activity`.
+    Comment = apps.get_model("comments", "Comment")
+    Comment.objects.using(schema_editor.connection.alias).filter(parent__isnull=True).update(last_activity_at=F("created_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0007_comment_sanitize_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='last_activity_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(seed_roots, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['parent', 'last_activity_at', 'id'], name='comments_co_parent__0a0a41_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.5 on 2026-10-19 18:46
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0008_comment_last_activity_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('parent_id', models.BigIntegerField(blank=True, null=True)),
+                ('comment_id', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('c', 'created'), ('r', 'replies changed')], max_length=1)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['parent_id', 'id', 'comment_id', 'kind', 'created_at'], name='comments_change_feed')],
+            },
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.2.5 on 2026-10-19 18:57
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def parent_index(apps, schema_editor):
+    # A partitioned comment table lost the parent_id FK index in 0005; the
+    # (parent_id, created_at) index removed here was its only replacement.
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    from comments.partitioning import TABLE, is_partitioned
+
+    with schema_editor.connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS comments_comment_parent_idx ON {TABLE} (parent_id)")
+
+
+def seed_counters(apps, schema_editor):
+    Comment = apps.get_model("comments", "Comment")
+    ThreadNamespace = apps.get_model("comments", "ThreadNamespace")
+    db = schema_editor.connection.alias
+    totals = Comment.objects.using(db).aggregate(comments=Count("id"), threads=Count("id", filter=Q(parent__isnull=True)))
+    if totals["comments"]:
+        ThreadNamespace.objects.using(db).create(key="", threads_count=totals["threads"], comments_count=totals["comments"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0009_commentchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadNamespace',
+            fields=[
+                ('key', models.CharField(blank=True, max_length=200, primary_key=True, serialize=False)),
+                ('threads_count', models.PositiveIntegerField(default=0)),
+                ('comments_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='comment',
+            name='comments_co_parent__10bc81_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='comment',
+            name='comments_co_parent__0a0a41_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='commentchange',
+            name='comments_change_feed',
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='thread_key',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='commentchange',
+            name='thread_key',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['thread_key', 'parent', 'created_at', 'id'], name='comments_co_thread__dd9b97_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['thread_key', 'parent', 'last_activity_at', 'id'], name='comments_co_thread__c6e2cd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='commentchange',
+            index=models.Index(fields=['thread_key', 'parent_id', 'id', 'comment_id', 'kind', 'created_at'], name='comments_change_feed'),
+        ),
+        migrations.RunPython(parent_index, migrations.RunPython.noop),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
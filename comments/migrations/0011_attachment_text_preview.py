@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-19 19:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0010_thread_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='char_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='line_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='preview',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-19 19:15
+
+from django.db import migrations, models
+
+
+def seed_sequence(apps, schema_editor):
+    IdSequence = apps.get_model("comments", "IdSequence")
+    IdSequence.objects.using(schema_editor.connection.alias).get_or_create(name="comment")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0012_comment_deleted_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(seed_sequence, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def restore(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    from comments.partitioning import is_partitioned, restore_constraints
+
+    with schema_editor.connection.cursor() as cursor:
+        # Tables converted by an earlier 0005 lost the author FK and the reference checks.
+        if is_partitioned(cursor):
+            restore_constraints(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0014_cache_table'),
+    ]
+
+    operations = [
+        migrations.RunPython(restore, migrations.RunPython.noop),
+    ]
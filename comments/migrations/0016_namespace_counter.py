@@ -0,0 +1,47 @@
+# Generated by Django 5.2.5 on 2026-10-19 19:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_counts(apps, schema_editor):
+    # Existing counts become stripe 0 of their section.
+    ThreadNamespace = apps.get_model("comments", "ThreadNamespace")
+    NamespaceCounter = apps.get_model("comments", "NamespaceCounter")
+    db = schema_editor.connection.alias
+    NamespaceCounter.objects.using(db).bulk_create(
+        NamespaceCounter(namespace_id=ns.key, stripe=0, threads_count=ns.threads_count, comments_count=ns.comments_count)
+        for ns in ThreadNamespace.objects.using(db).iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0015_partition_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NamespaceCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe', models.PositiveSmallIntegerField()),
+                ('threads_count', models.IntegerField(default=0)),
+                ('comments_count', models.IntegerField(default=0)),
+                ('namespace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='counters', to='comments.threadnamespace')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('namespace', 'stripe'), name='comments_namespace_stripe')],
+            },
+        ),
+        migrations.RunPython(move_counts, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='threadnamespace',
+            name='comments_count',
+        ),
+        migrations.RemoveField(
+            model_name='threadnamespace',
+            name='threads_count',
+        ),
+    ]
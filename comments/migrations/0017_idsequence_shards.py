@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 19:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0016_namespace_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idsequence',
+            name='shards',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
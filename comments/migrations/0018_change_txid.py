@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-19 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0017_idsequence_shards'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='commentchange',
+            name='comments_change_feed',
+        ),
+        migrations.AddField(
+            model_name='commentchange',
+            name='txid',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='commentchange',
+            index=models.Index(fields=['thread_key', 'parent_id', 'txid', 'id', 'comment_id', 'kind'], name='comments_change_feed'),
+        ),
+    ]
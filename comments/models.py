@@ -1,4 +1,4 @@
-import io, os
+import os
 import mimetypes
 import uuid
 
@@ -6,7 +6,7 @@ from django.db import models
 from django.core.validators import RegexValidator, URLValidator
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
-from PIL import Image, ImageOps
+from django.utils import timezone
 
 username_validator = RegexValidator(
     regex=r"^[A-Za-z0-9А-Яа-яЁё _\-.']+$",
@@ -16,44 +16,18 @@ username_validator = RegexValidator(
 ALLOWED_TAGS = ["a", "code", "i", "strong"]
 ALLOWED_ATTRS = {"a": ["href", "title"]}
 
-MAX_TXT_SIZE = 100 * 1024
-MAX_IMAGE_SIZE = (320, 240)
-ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "GIF"}
-MIME_BY_FORMAT = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif"}
-
-def _is_text_file(file, max_bytes=100 * 1024) -> bool:
-    name = (getattr(file, "name", "") or "").lower()
-    if not name.endswith(".txt"):
-        return False
-    pos = file.tell()
-    try:
-        if file.size > max_bytes:
-            return False
-        sample = file.read(min(file.size, 4096))
-        if b"\x00" in sample:
-            return False
-        try:
-            sample.decode("utf-8")
-        except UnicodeDecodeError:
-            return False
-        return True
-    finally:
-        file.seek(pos)
-
-def _open_image(file):
-    pos = file.tell()
-    try:
-        img = Image.open(file)
-        img.verify()
-        file.seek(pos)
-        return Image.open(file)
-    except Exception:
-        file.seek(pos)
-        return None
+from .imaging import (  # noqa: F401
+    MAX_TXT_SIZE, MAX_IMAGE_SIZE, ALLOWED_IMAGE_FORMATS, MIME_BY_FORMAT,
+    _is_text_file, _open_image, make_thumbnail, pack_text, GZIP_SUFFIX,
+)
 
 class Comment(models.Model):
     author = models.OneToOneField('comments.User', on_delete=models.CASCADE, related_name='comment')
 
+    # Comment section (page, article) the thread belongs to; "" is the default
+    # one. Replies always carry their root's key (see comments/namespaces.py).
+    thread_key = models.CharField(max_length=200, default="", blank=True)
+
     parent = models.ForeignKey(
         "self", null=True, blank=True,
         on_delete=models.CASCADE, related_name="children"
@@ -61,16 +35,31 @@ class Comment(models.Model):
 
     text_raw = models.TextField()
     text_html = models.TextField()
+    # utils.SANITIZE_POLICY_VERSION that produced text_html (0 = unknown).
+    sanitize_version = models.PositiveSmallIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Top-level comments only: time of the newest comment in the thread, bumped
+    # by snapshots.on_comment_created in each reply's transaction.
+    last_activity_at = models.DateTimeField(null=True, blank=True)
 
     ip = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(blank=True)
+    # Set on the root of a deleted subtree only: the whole subtree is hidden at
+    # once and its rows are removed later, in batches (see comments/deletion.py).
+    deleted_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         indexes = [
-            models.Index(fields=["parent", "created_at"]),
+            # Listings filter on the section first, so each scans only its own rows.
+            models.Index(fields=["thread_key", "parent", "created_at", "id"]),
+            models.Index(fields=["thread_key", "parent", "last_activity_at", "id"]),
             models.Index(fields=["created_at"]),
             models.Index(fields=["author"]),
+            # Tombstones are few; purge_comments finds them without a table scan.
+            models.Index(
+                fields=["deleted_at"], condition=models.Q(deleted_at__isnull=False),
+                name="comments_comment_deleted_idx",
+            ),
         ]
         ordering = ["-created_at"]
 
@@ -78,6 +67,16 @@ class Comment(models.Model):
         if not self.text_raw.strip():
             raise ValidationError("Текст сообщения обязателен.")
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            if self.parent_id is None:
+                if self.last_activity_at is None:
+                    self.last_activity_at = timezone.now()
+            else:
+                parent_key = Comment.objects.filter(pk=self.parent_id).values_list("thread_key", flat=True).first()
+                self.thread_key = parent_key or ""
+        return super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.author.name}: {self.text_raw[:30]}"
 
@@ -94,6 +93,8 @@ class User(models.Model):
         indexes = [
             models.Index(fields=['name']),
             models.Index(fields=['email']),
+            # Prefix search (name LIKE 'abc%') in the admin; Postgres only.
+            models.Index(fields=['name'], name='comments_user_name_like', opclasses=['varchar_pattern_ops']),
         ]
 
     def __str__(self):
@@ -107,6 +108,10 @@ class Attachment(models.Model):
     width = models.PositiveIntegerField(null=True, blank=True)
     height = models.PositiveIntegerField(null=True, blank=True)
     is_image = models.BooleanField(default=False)
+    # Text files only: the first lines (about 1 KB) and counts, stored at upload.
+    preview = models.TextField(blank=True)
+    line_count = models.PositiveIntegerField(null=True, blank=True)
+    char_count = models.PositiveIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def clean(self):
@@ -155,6 +160,13 @@ class Attachment(models.Model):
             if self.size and self.size > MAX_TXT_SIZE:
                 raise ValidationError("Текстовый файл должен быть не больше 100 KB.")
 
+            if self._state.adding and not self.file.name.endswith(GZIP_SUFFIX):
+                self.file.seek(0)
+                packed = pack_text(self.file.name, self.file.read())
+                self.preview, self.line_count, self.char_count = (
+                    packed["preview"], packed["line_count"], packed["char_count"],
+                )
+                self.file.save(packed["name"], ContentFile(packed["data"]), save=False)
             return super().save(*args, **kwargs)
 
         fmt = (getattr(img, "format", "") or "").upper()
@@ -163,23 +175,93 @@ class Attachment(models.Model):
 
         self.is_image = True
 
-        img = ImageOps.exif_transpose(img)
-        img.thumbnail((320, 240))
-
-        buf = io.BytesIO()
-        save_fmt = "JPEG" if fmt == "JPEG" else fmt
-        save_kwargs = {"optimize": True}
-        if save_fmt == "JPEG":
-            save_kwargs["quality"] = 85
-        img.save(buf, format=save_fmt, **save_kwargs)
-        buf.seek(0)
+        data, ext, (self.width, self.height) = make_thumbnail(img, fmt)
 
         base = self.file.name.rsplit(".", 1)[0]
-        ext = {"JPEG": "jpg", "PNG": "png", "GIF": "gif"}[save_fmt]
-        self.file.save(f"{base}.{ext}", ContentFile(buf.read()), save=False)
+        self.file.save(f"{base}.{ext}", ContentFile(data), save=False)
 
-        self.width, self.height = img.size
-        self.content_type = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif"}[save_fmt]
+        self.content_type = MIME_BY_FORMAT[fmt]
         self.size = self.file.size
 
         return super().save(*args, **kwargs)
+
+class CommentChange(models.Model):
+    """Append-only change feed behind Query.commentsSince (see comments/changelog.py)."""
+
+    CREATED = "c"
+    REPLIED = "r"
+    DELETED = "d"
+    KINDS = [(CREATED, "created"), (REPLIED, "replies changed"), (DELETED, "deleted")]
+
+    # The list that changed: replies of parent_id, or the section's top level when NULL.
+    # Plain ids rather than FKs: appends stay cheap and work with a partitioned comment table.
+    thread_key = models.CharField(max_length=200, default="", blank=True)
+    parent_id = models.BigIntegerField(null=True, blank=True)
+    comment_id = models.BigIntegerField()
+    kind = models.CharField(max_length=1, choices=KINDS)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Writing transaction (Postgres xid8, 0 elsewhere): the feed is read in (txid, id) order.
+    txid = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Every column in the key so a feed read is an index-only scan.
+            models.Index(
+                fields=["thread_key", "parent_id", "txid", "id", "comment_id", "kind"],
+                name="comments_change_feed",
+            ),
+        ]
+
+class ThreadNamespace(models.Model):
+    """A comment section; its counts live in NamespaceCounter stripes (see comments/namespaces.py)."""
+    key = models.CharField(max_length=200, primary_key=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key or "(default)"
+
+class NamespaceCounter(models.Model):
+    """One stripe of a section's counters; the section's counts are the sum of its stripes."""
+    namespace = models.ForeignKey(ThreadNamespace, on_delete=models.CASCADE, related_name="counters")
+    stripe = models.PositiveSmallIntegerField()
+    # A stripe may go negative when comments it didn't count are hidden.
+    threads_count = models.IntegerField(default=0)
+    comments_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["namespace", "stripe"], name="comments_namespace_stripe"),
+        ]
+
+    def __str__(self):
+        return f"{self.namespace_id or '(default)'} #{self.stripe}"
+
+class OrphanedFile(models.Model):
+    """Storage file of a purged attachment, waiting for deletion.sweep_files."""
+    name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.name
+
+class IdSequence(models.Model):
+    """Block allocator behind sharding.new_comment_id; one row per sequence, on the primary only."""
+    name = models.CharField(max_length=50, primary_key=True)
+    next_value = models.BigIntegerField(default=0)
+    # COMMENT_SHARDS the ids were allocated under (sorted); see sharding.check_layout.
+    shards = models.JSONField(default=list, blank=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
+
+class ThreadSnapshot(models.Model):
+    """Denormalized JSON document of a whole top-level thread (see comments/snapshots.py)."""
+    root = models.OneToOneField(
+        Comment, primary_key=True, on_delete=models.CASCADE,
+        related_name="snapshot", db_constraint=False,
+    )
+    document = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"snapshot of #{self.root_id}"
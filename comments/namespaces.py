@@ -0,0 +1,99 @@
+"""
+Comment sections (``Comment.thread_key``).
+
+One deployment serves many pages or articles: every top-level comment is
+created under a key (``threadKey`` in GraphQL, ``thread_key`` in REST; ""
+is the default section) and its replies inherit it in ``Comment.save``.
+Every listing index leads with ``thread_key``, so a section's lists scan
+only its own rows.
+
+``ThreadNamespace`` rows are the sections; their thread and comment counts
+are kept in ``NamespaceCounter`` stripes, bumped in the insert transaction
+(and lowered when a subtree is hidden). Each transaction updates one stripe
+picked at random out of ``NAMESPACE_COUNTER_STRIPES``, so concurrent inserts
+into a busy section rarely wait on the same row lock, and a top-level list's
+``count`` is the sum of a few primary-key-adjacent rows instead of a
+``COUNT(*)``.
+"""
+import random
+import re
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.db.models import F, Sum
+
+from .models import Comment, NamespaceCounter, ThreadNamespace
+from .routers import shard_aliases, use_shard
+
+DEFAULT = ""
+KEY_RE = re.compile(r"^[\w.:/@-]{1,200}$")
+
+
+def clean_key(key) -> str:
+    """Normalized section key; ValueError for one that can't be stored."""
+    key = (key or "").strip()
+    if key and not KEY_RE.match(key):
+        raise ValueError("Invalid threadKey")
+    return key
+
+
+def on_comment_created(comment: Comment):
+    """Count a new comment in its section; call inside its transaction."""
+    on_comments_created([comment])
+
+
+def on_comments_created(comments):
+    totals = {}
+    for c in comments:
+        t = totals.setdefault(c.thread_key, [0, 0])
+        t[0] += c.parent_id is None
+        t[1] += 1
+    stripe = _stripe()
+    # Fixed order, so concurrent batches lock the counter rows the same way.
+    for key, (threads, total) in sorted(totals.items()):
+        _bump(key, stripe, threads, total)
+
+
+def on_comments_removed(key, threads, total):
+    """Uncount a hidden subtree (``total`` comments, ``threads`` of them top-level)."""
+    _bump(key, _stripe(), -threads, -total)
+
+
+def on_comments_restored(key, threads, total):
+    _bump(key, _stripe(), threads, total)
+
+
+def _stripe() -> int:
+    return random.randrange(settings.NAMESPACE_COUNTER_STRIPES)
+
+
+def _bump(key, stripe, threads, total):
+    counts = NamespaceCounter.objects.filter(namespace_id=key, stripe=stripe)
+    bump = {"threads_count": F("threads_count") + threads, "comments_count": F("comments_count") + total}
+    if counts.update(**bump):
+        return
+    # First write to this stripe of the section.
+    try:
+        with transaction.atomic(using=router.db_for_write(NamespaceCounter)):
+            ThreadNamespace.objects.get_or_create(key=key)
+            NamespaceCounter.objects.create(namespace_id=key, stripe=stripe, threads_count=threads, comments_count=total)
+    except IntegrityError:
+        # Another transaction created it first.
+        counts.update(**bump)
+
+
+def counts(key: str) -> tuple:
+    """``(threads, comments)`` of a section on the current shard."""
+    sums = NamespaceCounter.objects.filter(namespace_id=key).aggregate(
+        threads=Sum("threads_count"), comments=Sum("comments_count"),
+    )
+    return sums["threads"] or 0, sums["comments"] or 0
+
+
+def threads_count(key: str) -> int:
+    total = 0
+    # Each shard counts the threads it holds.
+    for alias in shard_aliases():
+        with use_shard(alias):
+            total += counts(key)[0]
+    return total
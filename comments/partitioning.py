@@ -0,0 +1,369 @@
+"""
+Monthly range partitioning of ``comments_comment`` by ``created_at`` (Postgres).
+
+Enabled with ``COMMENTS_PARTITIONED=1`` before running migrations; migration
+``0005_partition_comment`` then rebuilds the table as a partitioned one and
+``manage.py partition_comments`` keeps partitions ahead and archives old ones.
+Partitions are named ``comments_comment_pYYYYMM``; rows outside every range
+land in ``comments_comment_default``. Indexes are declared on the parent, so
+Postgres creates them on each partition, including ones created later.
+
+Postgres requires the partition key in every unique constraint, so the
+primary key becomes ``(id, created_at)`` (ids still come from one sequence)
+and ``author_id`` loses its unique constraint (each comment creates its own
+author row) but keeps its foreign key and a plain index. Foreign keys *to*
+the comment table (``parent_id``, ``attachment.comment_id``) can't reference
+a partitioned table's ``id``; they are replaced by deferred constraint
+triggers that check the referenced comment exists on insert and update.
+Deletes are not checked: :func:`comments.deletion.purge` removes replies and
+attachments first, and :func:`archive_partitions` archives the replies,
+attachments, snapshots and authors of a partition's comments with it.
+
+Partition pruning needs ``created_at`` in the query: replies are bounded by
+their parent's ``created_at`` (:func:`replies_since`) and created-at feeds
+read the newest partitions first (:func:`newest_first`).
+"""
+import datetime as dt
+import gzip
+import json
+import os
+import re
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from . import namespaces
+
+TABLE = "comments_comment"
+DEFAULT_PARTITION = f"{TABLE}_default"
+SEQUENCE = f"{TABLE}_id_seq"
+PARTITION_RE = re.compile(rf"^{TABLE}_p(\d{{4}})(\d{{2}})$")
+
+# Same names as the indexes Django created in 0001_initial.
+INDEXES = [
+    ("comments_co_parent__10bc81_idx", "(parent_id, created_at)"),
+    ("comments_co_created_5f6a12_idx", "(created_at)"),
+    ("comments_co_author__4d2625_idx", "(author_id)"),
+    # Stands in for the parent_id FK index of the plain table (reply counts, parent lookups).
+    ("comments_comment_parent_idx", "(parent_id)"),
+]
+
+# Same name as the FK Django created in 0001_initial.
+AUTHOR_FK = (
+    "comments_comment_author_id_334ce9e2_fk_comments_user_id",
+    "FOREIGN KEY (author_id) REFERENCES comments_user(id) DEFERRABLE INITIALLY DEFERRED",
+)
+# (table, column) pairs referencing comments_comment(id), checked by REF_CHECK.
+REFS = [("comments_comment", "parent_id"), ("comments_attachment", "comment_id")]
+REF_CHECK = "comments_comment_ref_check"
+# Replies written on another app server may be stamped slightly before their parent.
+CLOCK_SKEW = dt.timedelta(hours=1)
+# Months (before the current one) tried by newest_first before the whole table.
+FEED_WINDOWS = (0, 2, 11)
+# Temp table of the comments archive_partitions takes out with a partition.
+ARCHIVED = "archived_comments"
+
+
+def month_start(d: dt.date) -> dt.date:
+    return dt.date(d.year, d.month, 1)
+
+
+def add_months(d: dt.date, n: int) -> dt.date:
+    y, m = divmod(d.month - 1 + n, 12)
+    return dt.date(d.year + y, m + 1, 1)
+
+
+def partition_name(month: dt.date) -> str:
+    return f"{TABLE}_p{month:%Y%m}"
+
+
+def is_partitioned(cursor) -> bool:
+    cursor.execute(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = %s",
+        [TABLE],
+    )
+    return cursor.fetchone() is not None
+
+
+def list_partitions(cursor) -> list[dt.date]:
+    cursor.execute(
+        """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s
+        """,
+        [TABLE],
+    )
+    months = []
+    for (name,) in cursor.fetchall():
+        m = PARTITION_RE.match(name)
+        if m:
+            months.append(dt.date(int(m.group(1)), int(m.group(2)), 1))
+    return sorted(months)
+
+
+def create_partition(cursor, month: dt.date) -> bool:
+    """Create the partition for ``month``; rows already in the default partition are moved."""
+    name = partition_name(month)
+    lo, hi = month, add_months(month, 1)
+    cursor.execute("SELECT to_regclass(%s)", [name])
+    if cursor.fetchone()[0]:
+        return False
+
+    cursor.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s)",
+        [lo, hi],
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute(
+            f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)", [lo, hi]
+        )
+        return True
+
+    cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}")
+    cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)", [lo, hi])
+    cursor.execute(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved",
+        [lo, hi],
+    )
+    cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+    return True
+
+
+def ensure_partitions(cursor, ahead: int = 3, today: dt.date | None = None) -> list[str]:
+    """Create partitions from the current month up to ``ahead`` months in the future."""
+    start = month_start(today or dt.date.today())
+    created = []
+    for i in range(ahead + 1):
+        month = add_months(start, i)
+        if create_partition(cursor, month):
+            created.append(partition_name(month))
+    return created
+
+
+def convert_to_partitioned(cursor, ahead: int = 3):
+    """Rebuild ``comments_comment`` as a partitioned table, copying every row."""
+    if is_partitioned(cursor):
+        return
+
+    # FKs referencing comments_comment(id) can't point at a partitioned table
+    # whose unique keys include created_at; triggers check them instead.
+    cursor.execute(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = %s::regclass",
+        [TABLE],
+    )
+    for rel, con in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {rel} DROP CONSTRAINT "{con}"')
+
+    cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {TABLE}_legacy")
+    cursor.execute(f"SELECT COALESCE(MAX(id), 0) + 1, MIN(created_at) FROM {TABLE}_legacy")
+    next_id, oldest = cursor.fetchone()
+
+    cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {SEQUENCE}_p")
+    cursor.execute(f"SELECT setval('{SEQUENCE}_p', %s, false)", [next_id])
+    cursor.execute(
+        f"CREATE TABLE {TABLE} (LIKE {TABLE}_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        f"PARTITION BY RANGE (created_at)"
+    )
+    cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCE}_p')")
+    cursor.execute(f"ALTER SEQUENCE {SEQUENCE}_p OWNED BY {TABLE}.id")
+    cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT")
+
+    first = month_start(oldest.date()) if oldest else month_start(dt.date.today())
+    month = first
+    last = add_months(month_start(dt.date.today()), ahead)
+    while month <= last:
+        create_partition(cursor, month)
+        month = add_months(month, 1)
+
+    cursor.execute(f"INSERT INTO {TABLE} SELECT * FROM {TABLE}_legacy")
+    cursor.execute(f"DROP TABLE {TABLE}_legacy")
+    # Constraint and index names are free again once the legacy table is gone.
+    cursor.execute(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, created_at)")
+    for name, cols in INDEXES:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {TABLE} {cols}")
+    restore_constraints(cursor)
+
+
+def restore_constraints(cursor):
+    """
+        Add the author FK back and the triggers standing in for the FKs to
+        ``comments_comment(id)``; does nothing for the ones already there.
+    """
+    cursor.execute(
+        "SELECT 1 FROM pg_constraint WHERE conrelid = %s::regclass AND conname = %s", [TABLE, AUTHOR_FK[0]]
+    )
+    if cursor.fetchone() is None:
+        cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT "{AUTHOR_FK[0]}" {AUTHOR_FK[1]}')
+    cursor.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION {REF_CHECK}() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE ref bigint := (to_jsonb(NEW) ->> TG_ARGV[0])::bigint;
+        BEGIN
+            IF ref IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {TABLE} WHERE id = ref) THEN
+                RAISE foreign_key_violation USING MESSAGE = format(
+                    '%s.%s = %s is not present in table "{TABLE}"', TG_TABLE_NAME, TG_ARGV[0], ref
+                );
+            END IF;
+            RETURN NULL;
+        END $$
+        """
+    )
+    for rel, col in REFS:
+        name = f"{rel}_{col}_ref"
+        cursor.execute("SELECT 1 FROM pg_trigger WHERE tgrelid = %s::regclass AND tgname = %s", [rel, name])
+        if cursor.fetchone():
+            continue
+        cursor.execute(
+            f'CREATE CONSTRAINT TRIGGER "{name}" AFTER INSERT OR UPDATE OF "{col}" ON {rel} '
+            f"DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE FUNCTION {REF_CHECK}('{col}')"
+        )
+
+
+def _utc(month: dt.date) -> dt.datetime:
+    return dt.datetime.combine(month, dt.time.min, tzinfo=dt.timezone.utc)
+
+
+def replies_since(created_at) -> Q:
+    """
+        Lower bound on ``created_at`` for replies to a comment created at
+        ``created_at`` (a value or an expression), so Postgres skips the
+        partitions before it; no filter on an unpartitioned table.
+    """
+    if not settings.COMMENTS_PARTITIONED:
+        return Q()
+    return Q(created_at__gte=created_at - CLOCK_SKEW)
+
+
+def newest_first(qs, lo, hi, anchor=None) -> list:
+    """
+        Rows ``lo:hi`` of ``qs`` ordered by ``-created_at``: read from the
+        partitions of the last months before ``anchor`` (now by default)
+        first, widening to the whole table only when they hold too few rows.
+    """
+    if settings.COMMENTS_PARTITIONED:
+        start = month_start(anchor or timezone.now())
+        for months in FEED_WINDOWS:
+            rows = list(qs.filter(created_at__gte=_utc(add_months(start, -months)))[lo:hi])
+            if len(rows) == hi - lo:
+                return rows
+    return list(qs[lo:hi])
+
+
+def _archive_set(cursor, name):
+    """
+        Temp table of the partition's comments and every reply under them,
+        in any partition, with their visibility and whether they are in it.
+    """
+    cursor.execute(f"DROP TABLE IF EXISTS pg_temp.{ARCHIVED}")
+    cursor.execute(
+        f"""
+        CREATE TEMP TABLE {ARCHIVED} ON COMMIT DROP AS
+        WITH RECURSIVE tree (id, author_id, parent_id, thread_key, hidden) AS (
+            SELECT id, author_id, parent_id, thread_key, deleted_at IS NOT NULL FROM {name} p
+            WHERE parent_id IS NULL OR NOT EXISTS (SELECT 1 FROM {name} WHERE id = p.parent_id)
+            UNION ALL
+            SELECT c.id, c.author_id, c.parent_id, c.thread_key, t.hidden OR c.deleted_at IS NOT NULL
+            FROM {TABLE} c JOIN tree t ON c.parent_id = t.id
+        )
+        SELECT tree.*, EXISTS (SELECT 1 FROM {name} WHERE id = tree.id) AS in_partition FROM tree
+        """
+    )
+
+
+def _dump(cursor, sql, path) -> int:
+    rows = 0
+    with cursor.db.chunked_cursor() as stream, gzip.open(path, "wt", encoding="utf-8") as out:
+        stream.execute(sql)
+        while True:
+            chunk = stream.fetchmany(5000)
+            if not chunk:
+                break
+            for (line,) in chunk:
+                out.write(line)
+                out.write("\n")
+            rows += len(chunk)
+    return rows
+
+
+def archive_partitions(cursor, older_than: int, archive_dir: str, drop: bool = True,
+                       today: dt.date | None = None, dry_run: bool = False) -> list[tuple[str, int, int, int]]:
+    """
+        Detach partitions whose whole range is older than ``older_than``
+        months, dump them to ``<archive_dir>/<partition>.ndjson.gz`` and drop
+        them (or leave them detached with ``drop=False``). Returns
+        ``(partition, comments, later replies, attachments)`` for each.
+
+        Whole subtrees go: replies in newer partitions, attachments (their
+        files are queued in ``OrphanedFile``), snapshots and author rows of
+        the archived comments are dumped next to the partition as
+        ``<partition>.<replies|attachments|users>.ndjson.gz`` and deleted, and
+        the section counters are lowered. Authors of the partition's own rows
+        stay while it is kept detached (its author FK still points at them).
+    """
+    cutoff = add_months(month_start(today or dt.date.today()), -older_than)
+    done = []
+    for month in list_partitions(cursor):
+        if add_months(month, 1) > cutoff:
+            continue
+        name = partition_name(month)
+        _archive_set(cursor, name)
+        cursor.execute(
+            f"SELECT COUNT(*) FILTER (WHERE in_partition), COUNT(*) FILTER (WHERE NOT in_partition), "
+            f"(SELECT COUNT(*) FROM comments_attachment WHERE comment_id IN (SELECT id FROM {ARCHIVED})) "
+            f"FROM {ARCHIVED}"
+        )
+        rows, replies, attachments = cursor.fetchone()
+        if dry_run:
+            done.append((name, rows, replies, attachments))
+            continue
+
+        cursor.execute(
+            f"SELECT thread_key, COUNT(*) FILTER (WHERE parent_id IS NULL), COUNT(*) FROM {ARCHIVED} "
+            f"WHERE NOT hidden GROUP BY thread_key ORDER BY thread_key"
+        )
+        for key, threads, total in cursor.fetchall():
+            namespaces.on_comments_removed(key, threads, total)
+
+        os.makedirs(archive_dir, exist_ok=True)
+        dependents = {
+            "replies": f"SELECT row_to_json(t)::text FROM {TABLE} t "
+                       f"WHERE id IN (SELECT id FROM {ARCHIVED} WHERE NOT in_partition) ORDER BY id",
+            "attachments": f"SELECT row_to_json(t)::text FROM comments_attachment t "
+                           f"WHERE comment_id IN (SELECT id FROM {ARCHIVED}) ORDER BY id",
+            "users": f"SELECT row_to_json(t)::text FROM comments_user t "
+                     f"WHERE id IN (SELECT author_id FROM {ARCHIVED}) ORDER BY id",
+        }
+        for kind, sql in dependents.items():
+            _dump(cursor, sql, os.path.join(archive_dir, f"{name}.{kind}.ndjson.gz"))
+
+        cursor.execute(
+            f"INSERT INTO comments_orphanedfile (name, created_at) SELECT file, now() FROM comments_attachment "
+            f"WHERE comment_id IN (SELECT id FROM {ARCHIVED}) AND file <> ''"
+        )
+        cursor.execute(f"DELETE FROM comments_attachment WHERE comment_id IN (SELECT id FROM {ARCHIVED})")
+        cursor.execute(f"DELETE FROM comments_threadsnapshot WHERE root_id IN (SELECT id FROM {ARCHIVED})")
+        cursor.execute(f"DELETE FROM {TABLE} WHERE id IN (SELECT id FROM {ARCHIVED} WHERE NOT in_partition)")
+
+        cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+        _dump(cursor, f"SELECT row_to_json(t)::text FROM {name} t ORDER BY id",
+              os.path.join(archive_dir, f"{name}.ndjson.gz"))
+        if drop:
+            cursor.execute(f"DROP TABLE {name}")
+        cursor.execute(
+            f"DELETE FROM comments_user WHERE id IN (SELECT author_id FROM {ARCHIVED}"
+            f"{'' if drop else ' WHERE NOT in_partition'})"
+        )
+        done.append((name, rows, replies, attachments))
+    return done
+
+
+def read_archive(path: str):
+    """Yield archived rows as dicts."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,173 @@
+"""
+Opt-in per-request sampling profiler.
+
+With ``PROFILING=1`` a request is profiled when it carries a valid
+``X-Profile`` token (``manage.py profiles token``) or falls into the random
+``PROFILE_SAMPLE_RATE`` fraction. A background thread samples the request
+thread's stack every ``PROFILE_INTERVAL_MS`` and the result is written to
+``PROFILE_DIR`` in collapsed-stack format (``frame;frame;frame count``, as
+read by flamegraph.pl / speedscope), with the GraphQL operation name (or the
+view name) as the root frame. ``manage.py profiles`` lists and merges them.
+
+With ``PROFILING=0`` the middleware removes itself at startup.
+"""
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+
+HEADER = "HTTP_X_PROFILE"
+_SALT = "comments.profile"
+SUFFIX = ".collapsed"
+_OPERATION_RE = re.compile(r"\b(query|mutation|subscription)\s+(\w+)")
+_UNSAFE = re.compile(r"[^\w.-]+")
+
+
+def make_token() -> str:
+    return signing.dumps({"p": 1}, salt=_SALT)
+
+
+def _valid_token(token: str) -> bool:
+    try:
+        signing.loads(token, salt=_SALT, max_age=settings.PROFILE_TOKEN_TTL)
+        return True
+    except signing.BadSignature:
+        return False
+
+
+class StackSampler:
+    """Samples one thread's Python stack from a daemon thread, up to the ``stop_at`` code object."""
+
+    def __init__(self, thread_id: int, interval: float, stop_at=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stop_at = stop_at
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[_collapse(frame, self.stop_at)] += 1
+
+
+def _collapse(frame, stop_at=None) -> str:
+    stack = []
+    while frame is not None and frame.f_code is not stop_at:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def operation_name(request) -> str:
+    """GraphQL operation name, else the resolved view name."""
+    if request.path.rstrip("/").endswith("graphql"):
+        try:
+            if request.method == "GET":
+                payload = {"query": request.GET.get("query", ""), "operationName": request.GET.get("operationName")}
+            elif request.content_type == "multipart/form-data":
+                payload = json.loads(request.POST.get("operations") or "{}")
+            else:
+                payload = json.loads(request.body or b"{}")
+        except Exception:
+            payload = {}
+        if isinstance(payload, dict):
+            if payload.get("operationName"):
+                return payload["operationName"]
+            m = _OPERATION_RE.search(payload.get("query") or "")
+            if m:
+                return m.group(2)
+        return "graphql"
+    match = getattr(request, "resolver_match", None)
+    return (match.view_name if match and match.view_name else None) or request.path
+
+
+def write_profile(counts: Counter, tag: str, elapsed: float) -> str:
+    """Store one profile; returns its file name."""
+    tag = _UNSAFE.sub("_", tag).strip("_") or "request"
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{tag}-{int(elapsed * 1000)}ms-{os.getpid()}-{random.randrange(16 ** 4):04x}{SUFFIX}"
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    path = os.path.join(settings.PROFILE_DIR, name)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        for stack, n in counts.most_common():
+            f.write(f"{tag};{stack} {n}\n")
+    os.replace(f"{path}.tmp", path)
+    return name
+
+
+def read_profile(path: str) -> Counter:
+    counts = Counter()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            stack, _, n = line.rstrip("\n").rpartition(" ")
+            if stack and n.isdigit():
+                counts[stack] += int(n)
+    return counts
+
+
+def list_profiles(directory=None) -> list[dict]:
+    """Stored profiles, newest first, with the tag and duration from the file name."""
+    directory = directory or settings.PROFILE_DIR
+    if not os.path.isdir(directory):
+        return []
+    out = []
+    for name in os.listdir(directory):
+        if not name.endswith(SUFFIX):
+            continue
+        parts = name[: -len(SUFFIX)].split("-")
+        out.append({
+            "name": name,
+            "path": os.path.join(directory, name),
+            "started": parts[0],
+            "tag": "-".join(parts[1:-3]),
+            "ms": int(parts[-3].rstrip("ms") or 0) if len(parts) >= 5 else None,
+        })
+    out.sort(key=lambda p: p["name"], reverse=True)
+    return out
+
+
+class ProfilingMiddleware:
+    """Profiles requests picked by the ``X-Profile`` token or ``PROFILE_SAMPLE_RATE``."""
+
+    def __init__(self, get_response):
+        if not settings.PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.rate = settings.PROFILE_SAMPLE_RATE
+        self.interval = settings.PROFILE_INTERVAL_MS / 1000
+
+    def __call__(self, request):
+        token = request.META.get(HEADER)
+        if not (token and _valid_token(token)) and not (self.rate and random.random() < self.rate):
+            return self.get_response(request)
+
+        sampler = StackSampler(threading.get_ident(), self.interval, stop_at=ProfilingMiddleware.__call__.__code__)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            counts = sampler.stop()
+        elapsed = time.perf_counter() - started
+        if counts:
+            response["X-Profile-Id"] = write_profile(counts, operation_name(request), elapsed)
+        return response
@@ -0,0 +1,149 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+PRIMARY_DB = "default"
+PIN_COOKIE = "db_pin"
+PIN_HEADER = "HTTP_X_DB_PIN"
+# DatabaseCache reports its table under this pseudo app label.
+CACHE_APP_LABEL = "django_cache"
+# Models of this app live on the shard of their thread (see comments/sharding.py),
+# except these, which exist once, on the primary.
+SHARDED_APP = "comments"
+GLOBAL_MODELS = {"idsequence"}
+
+_use_primary: ContextVar[bool] = ContextVar("comments_use_primary", default=False)
+_wrote: ContextVar[bool] = ContextVar("comments_wrote", default=False)
+_read_alias: ContextVar = ContextVar("comments_read_alias", default=None)
+_shard: ContextVar = ContextVar("comments_shard", default=None)
+
+
+def shard_aliases() -> list[str]:
+    return settings.COMMENT_SHARDS
+
+
+def replica_aliases() -> list[str]:
+    return settings.DB_REPLICAS
+
+
+def is_sharded(model) -> bool:
+    return model._meta.app_label == SHARDED_APP and model._meta.model_name not in GLOBAL_MODELS
+
+
+@contextmanager
+def use_primary():
+    """Send every read inside the block to the primary."""
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+def mark_wrote():
+    """Pin the current request to the primary for a write made on its behalf in another thread."""
+    _wrote.set(True)
+
+
+@contextmanager
+def use_shard(alias):
+    """Send every query of the comments app's models inside the block to shard ``alias``."""
+    token = _shard.set(alias)
+    try:
+        yield
+    finally:
+        _shard.reset(token)
+
+
+def _shard_for(model, hints):
+    if not is_sharded(model):
+        return None
+    alias = _shard.get()
+    if alias is not None:
+        return alias
+    # Related lookups stay on the shard their instance was loaded from.
+    db = getattr(getattr(hints.get("instance"), "_state", None), "db", None)
+    return db if db in shard_aliases() else None
+
+
+@contextmanager
+def use_database(alias):
+    """Send every read inside the block to ``alias`` (one transaction, one replica)."""
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """
+        Reads go to a random replica, writes go to ``default``.
+
+        Reads fall back to the primary while :func:`use_primary` is active
+        (mutations, uploads) or while the client is pinned after a write
+        (see :class:`ReplicaPinMiddleware`), and stay on one database inside
+        :func:`use_database`.
+
+        Inside :func:`use_shard` the comments app's models go to that shard;
+        replicas only serve shard 0 (``default``).
+    """
+
+    def db_for_read(self, model, **hints):
+        shard = _shard_for(model, hints)
+        if shard is not None and shard != PRIMARY_DB:
+            return shard
+        replicas = replica_aliases()
+        if not replicas or _use_primary.get() or model._meta.app_label == CACHE_APP_LABEL:
+            return PRIMARY_DB
+        alias = _read_alias.get()
+        if alias is None or (alias != PRIMARY_DB and alias in shard_aliases()):
+            return random.choice(replicas)
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != CACHE_APP_LABEL:
+            _wrote.set(True)
+        return _shard_for(model, hints) or PRIMARY_DB
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema by replication.
+        return db not in replica_aliases()
+
+
+class ReplicaPinMiddleware:
+    """
+        Read-your-writes: after a request that wrote to the primary the client
+        gets a short-lived ``db_pin`` cookie, and its following requests read
+        from the primary until it expires. Clients that can't keep cookies may
+        send ``X-DB-Pin: 1`` instead.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        pinned = bool(request.COOKIES.get(PIN_COOKIE) or request.META.get(PIN_HEADER))
+        primary_token = _use_primary.set(pinned)
+        wrote_token = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get():
+                response.set_cookie(
+                    PIN_COOKIE, "1",
+                    max_age=settings.REPLICA_PIN_SECONDS,
+                    path="/",
+                    httponly=True,
+                    samesite="Lax",
+                    secure=not settings.DEBUG,
+                )
+                response["X-DB-Pin"] = "1"
+            return response
+        finally:
+            _wrote.reset(wrote_token)
+            _use_primary.reset(primary_token)
@@ -8,16 +8,24 @@ from datetime import datetime
 import strawberry
 from strawberry import ID
 from strawberry.types import Info
+from strawberry.types.nodes import SelectedField
 from strawberry.file_uploads import Upload
+from strawberry.scalars import JSON
+from strawberry.extensions import QueryDepthLimiter
 
 from enum import Enum
 
+from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
 
-from django.db.models import Count
-from .models import Comment, User, Attachment
+from django.db.models import Count, Subquery, Value
+from .models import Comment, User, Attachment, ThreadSnapshot
+from . import cache as tiered_cache
+from . import changelog, coalescing, deadlines, deletion, file_urls, namespaces, partitioning, sharding, snapshots, uploads
+from .extensions import QueryCostLimiter
 
 from .utils import sanitize_comment_html, verify_captcha
+from .routers import use_primary, use_shard
 
 
 def _get_client_ip_and_ua(request):
@@ -37,6 +45,7 @@ class OrderField(Enum):
     AUTHOR_EMAIL = "AUTHOR_EMAIL"
     USER_NAME = "USER_NAME"
     EMAIL = "EMAIL"
+    LAST_ACTIVITY = "LAST_ACTIVITY"
 
 
 @strawberry.type
@@ -48,20 +57,34 @@ class AttachmentType:
     width: Optional[int]
     height: Optional[int]
     isImage: bool
+    # Text files: first lines (about 1 KB) and counts, so feeds need no download.
+    preview: Optional[str] = None
+    lineCount: Optional[int] = None
+    charCount: Optional[int] = None
 
     @staticmethod
-    def from_model(a: Attachment) -> "AttachmentType":
+    def from_model(a: Attachment, url: Optional[str] = None) -> "AttachmentType":
         return AttachmentType(
             id=a.id,
-            url=a.file.url,
+            url=url if url is not None else file_urls.url(a.file.name),
             contentType=a.content_type or None,
             size=a.size or 0,
             width=a.width,
             height=a.height,
             isImage=a.is_image,
+            preview=a.preview or None,
+            lineCount=a.line_count,
+            charCount=a.char_count,
         )
 
 
+@strawberry.type
+class UploadResult:
+    name: str
+    attachment: Optional[AttachmentType] = None
+    error: Optional[str] = None
+
+
 @strawberry.type
 class UserType:
     id: ID
@@ -71,11 +94,12 @@ class UserType:
 
     @staticmethod
     def from_model(u: User) -> "UserType":
+        deferred = u.get_deferred_fields()
         return UserType(
             id=str(u.id),
-            name=u.name,
-            email=u.email,
-            homePage=u.home_page or None,
+            name="" if "name" in deferred else u.name,
+            email="" if "email" in deferred else u.email,
+            homePage=None if "home_page" in deferred else (u.home_page or None),
         )
 
 
@@ -88,32 +112,118 @@ class CommentType:
     textHtml: Optional[str] = None
     createdAt: datetime
     repliesCount: int
+    lastActivityAt: Optional[datetime] = None
+    threadKey: str = ""
+    # Filled by list resolvers for the whole page (see _page_attachments).
+    prefetched_attachments: strawberry.Private[Optional[List[AttachmentType]]] = None
 
     @strawberry.field
     def attachments(self, info: Info) -> List[AttachmentType]:
+        if self.prefetched_attachments is not None:
+            return self.prefetched_attachments
         try:
-            rows = Attachment.objects.filter(comment_id=self.id).order_by("id")
-            return [AttachmentType.from_model(a) for a in rows]
+            with sharding.thread(self.id):
+                rows = list(Attachment.objects.filter(comment_id=self.id).order_by("id"))
+            urls = file_urls.urls(a.file.name for a in rows)
+            return [AttachmentType.from_model(a, urls.get(a.file.name)) for a in rows]
         except Exception:
             return []
 
     @staticmethod
-    def from_model(c: Comment) -> "CommentType":
+    def from_model(c: Comment, attachments: Optional[List[AttachmentType]] = None) -> "CommentType":
+        # Rows from Query.comments may be projected down to the selected
+        # fields; columns that were not loaded are never sent, so don't fetch them.
+        deferred = c.get_deferred_fields()
+        if Comment.author.is_cached(c):
+            author = UserType.from_model(c.author)
+        else:
+            author = UserType(id=str(c.author_id), name="", email="")
+        replies = getattr(c, "replies_count", None)
         return CommentType(
             id=c.id,
-            author=UserType.from_model(c.author),
-            parentId=c.parent_id,
-            textRaw=c.text_raw,
-            textHtml=c.text_html,
-            createdAt=c.created_at,
-            repliesCount=getattr(c, "replies_count", None) or c.children.count(),
+            author=author,
+            parentId=None if "parent_id" in deferred else c.parent_id,
+            textRaw="" if "text_raw" in deferred else c.text_raw,
+            textHtml=None if "text_html" in deferred else c.text_html,
+            createdAt=None if "created_at" in deferred else c.created_at,
+            repliesCount=replies if replies is not None else c.children.filter(deleted_at__isnull=True).count(),
+            lastActivityAt=None if "last_activity_at" in deferred else c.last_activity_at,
+            threadKey="" if "thread_key" in deferred else c.thread_key,
+            prefetched_attachments=attachments,
         )
 
 
+def _page_attachments(comment_ids) -> dict:
+    """``{comment_id: [AttachmentType]}`` for a page: one query per shard and one URL batch."""
+    out = {pk: [] for pk in comment_ids}
+    try:
+        rows = []
+        for alias, ids in sharding.group(comment_ids).items():
+            with use_shard(alias):
+                rows += Attachment.objects.filter(comment_id__in=ids).order_by("id")
+        urls = file_urls.urls(a.file.name for a in rows)
+    except Exception:
+        return out
+    for a in rows:
+        out[a.comment_id].append(AttachmentType.from_model(a, urls.get(a.file.name)))
+    return out
+
+
+# GraphQL field -> model column, for projecting Query.comments rows.
+COMMENT_COLUMNS = {
+    "parentId": "parent",
+    "textRaw": "text_raw",
+    "textHtml": "text_html",
+    "createdAt": "created_at",
+    "lastActivityAt": "last_activity_at",
+    "threadKey": "thread_key",
+}
+USER_COLUMNS = {
+    "name": "name",
+    "email": "email",
+    "homePage": "home_page",
+}
+
+
+def _selections(field) -> dict:
+    """Sub-fields selected under ``field`` by name, with fragments flattened."""
+    out = {}
+    if field is None:
+        return out
+    stack = list(field.selections)
+    while stack:
+        sel = stack.pop()
+        if isinstance(sel, SelectedField):
+            out[sel.name] = sel
+        else:
+            stack.extend(sel.selections)
+    return out
+
+
 @strawberry.type
 class CommentList:
     count: int
     results: List[CommentType]
+    # Starting point for commentsSince after this load.
+    syncToken: Optional[str] = None
+    # Top level only: pass as ``after`` for the next page (keyset, no OFFSET).
+    nextCursor: Optional[str] = None
+
+
+@strawberry.type
+class RepliesCountChange:
+    id: ID
+    repliesCount: int
+
+
+@strawberry.type
+class CommentsDelta:
+    created: List[CommentType]
+    repliesChanged: List[RepliesCountChange]
+    # Comments hidden or deleted along with their replies.
+    deleted: List[ID]
+    token: str
+    hasMore: bool
 
 
 @strawberry.type
@@ -127,14 +237,34 @@ class Query:
         orderField: OrderField = OrderField.CREATED_AT,
         desc: bool = True,
         parentId: Optional[ID] = None,
+        threadKey: Optional[str] = None,
+        after: Optional[str] = None,
     ) -> CommentList:
-        qs = Comment.objects.select_related("author")
+        if not 1 <= pageSize <= settings.GRAPHQL_MAX_PAGE_SIZE:
+            raise Exception(f"pageSize must be between 1 and {settings.GRAPHQL_MAX_PAGE_SIZE}")
+        key = namespaces.clean_key(threadKey)
+        qs = Comment.objects.filter(thread_key=key, deleted_at__isnull=True)
         if parentId is None:
             qs = qs.filter(parent__isnull=True)
         else:
-            qs = qs.filter(parent_id=parentId)
-
-        qs = qs.annotate(replies_count=Count("children"))
+            parent_created = Subquery(Comment.objects.filter(pk=parentId).values("created_at")[:1])
+            qs = qs.filter(partitioning.replies_since(parent_created), parent_id=parentId)
+        count_qs = qs
+
+        selected = _selections(info.selected_fields[0])
+        results = _selections(selected.get("results"))
+        author = _selections(results.get("author"))
+
+        columns = ["id", "author"]
+        columns += [COMMENT_COLUMNS[f] for f in results if f in COMMENT_COLUMNS]
+        if author:
+            qs = qs.select_related("author")
+            columns += [f"author__{USER_COLUMNS[f]}" for f in author if f in USER_COLUMNS]
+        qs = qs.only(*columns)
+        if "repliesCount" in results:
+            qs = qs.annotate(replies_count=deletion.replies_count())
+        else:
+            qs = qs.annotate(replies_count=Value(0))
 
         order_map = {
             OrderField.CREATED_AT: "created_at",
@@ -142,21 +272,107 @@ class Query:
             OrderField.AUTHOR_EMAIL: "author__email",
             OrderField.USER_NAME: "author__name",
             OrderField.EMAIL: "author__email",
+            # Only top-level comments track activity; replies fall back to created_at.
+            OrderField.LAST_ACTIVITY: "last_activity_at" if parentId is None else "created_at",
         }
         main = order_map.get(orderField, "created_at")
         prefix = "-" if desc else ""
         order_by = [f"{prefix}{main}", f"{prefix}id"]
 
-        total = qs.count()
-        start = max(page, 1) - 1
-        start *= pageSize
-        rows = list(qs.order_by(*order_by)[start: start + pageSize])
+        total = 0
+        token = cursor = None
+        start = 0 if after else (max(page, 1) - 1) * pageSize
+        with deadlines.budget("comments"), deadlines.atomic(Comment):
+            # Taken before the rows: a change in between is sent again, never lost.
+            if "syncToken" in selected:
+                token = changelog.head_token()
+            if parentId is None:
+                if "count" in selected:
+                    total = namespaces.threads_count(key)
+                # Threads are spread over the shards: a merge of per-shard pages.
+                rows, cursor = sharding.feed_page(qs, main, desc, pageSize, start, after)
+            else:
+                with sharding.thread(parentId), deadlines.atomic(Comment):
+                    # Replies inside a hidden subtree are hidden with it.
+                    if deletion.visible(parentId) is None:
+                        return CommentList(count=0, results=[], syncToken=token)
+                    if "count" in selected:
+                        total = tiered_cache.get_or_set(
+                            "comments", f"count:{key}:{parentId}", count_qs.count, scope=key,
+                        )
+                    rows = list(qs.order_by(*order_by)[start: start + pageSize])
+            attachments = _page_attachments([c.id for c in rows]) if "attachments" in results else {}
 
         return CommentList(
             count=total,
-            results=[CommentType.from_model(c) for c in rows],
+            results=[CommentType.from_model(c, attachments.get(c.id)) for c in rows],
+            syncToken=token,
+            nextCursor=cursor,
+        )
+
+    @strawberry.field
+    def comments_since(
+        self,
+        info: Info,
+        sinceToken: Optional[str] = None,
+        parentId: Optional[ID] = None,
+        limit: int = 50,
+        threadKey: Optional[str] = None,
+    ) -> CommentsDelta:
+        """
+            Comments created or deleted in one list, and reply counts changed in
+            it, after ``sinceToken``. Without a token only the current token is
+            returned.
+        """
+        if not 1 <= limit <= settings.GRAPHQL_MAX_PAGE_SIZE:
+            raise Exception(f"limit must be between 1 and {settings.GRAPHQL_MAX_PAGE_SIZE}")
+        parent = int(parentId) if parentId is not None else None
+        key = namespaces.clean_key(threadKey)
+        with deadlines.budget("comments"), deadlines.atomic(Comment):
+            if sinceToken is None:
+                return CommentsDelta(
+                    created=[], repliesChanged=[], deleted=[], token=changelog.head_token(), hasMore=False,
+                )
+            since = changelog.decode_token(sinceToken)
+            created_ids, replied_ids, deleted_ids, position, has_more = changelog.changes_since(
+                key, parent, since, limit,
+            )
+
+            rows, counts = {}, {}
+            for alias, ids in sharding.group(created_ids).items():
+                with use_shard(alias):
+                    rows.update(
+                        (c.id, c)
+                        for c in Comment.objects.filter(pk__in=ids, deleted_at__isnull=True)
+                        .select_related("author")
+                        .annotate(replies_count=deletion.replies_count())
+                    )
+            created_fields = _selections(_selections(info.selected_fields[0]).get("created"))
+            attachments = _page_attachments(list(rows)) if "attachments" in created_fields else {}
+            created = [CommentType.from_model(rows[i], attachments.get(i)) for i in created_ids if i in rows]
+            for alias, ids in sharding.group(replied_ids).items():
+                with use_shard(alias):
+                    counts.update(
+                        Comment.objects.filter(parent_id__in=ids, deleted_at__isnull=True)
+                        .values("parent_id")
+                        .annotate(n=Count("id"))
+                        .values_list("parent_id", "n")
+                    )
+        return CommentsDelta(
+            created=created,
+            repliesChanged=[RepliesCountChange(id=i, repliesCount=counts.get(i, 0)) for i in replied_ids],
+            deleted=deleted_ids,
+            token=changelog.encode_token(position),
+            hasMore=has_more,
         )
 
+    @strawberry.field
+    def thread_snapshot(self, info: Info, rootId: ID) -> Optional[JSON]:
+        """Whole top-level thread (nested replies and attachments) from its stored snapshot."""
+        with sharding.thread(rootId):
+            snap = ThreadSnapshot.objects.filter(root_id=rootId, root__deleted_at__isnull=True).only("document").first()
+        return snapshots.render(snap.document) if snap else None
+
 
 
 @strawberry.input
@@ -169,6 +385,8 @@ class CreateCommentInput:
     parentId: Optional[ID] = None
     captcha: str
     captchaKey: Optional[str] = None
+    # Section of a new thread; replies always join their parent's.
+    threadKey: Optional[str] = None
 
 
 @strawberry.type
@@ -200,36 +418,63 @@ class Mutation:
         user_name = input.userName or input.name
         if not user_name:
             raise Exception("userName (or name) is required")
-
-        user = User.objects.create(
-            name=user_name,
-            email=input.email,
-            home_page=input.homePage or "",
-            ip=ip or "0.0.0.0",
-            user_agent=ua,
-        )
-
-        html = sanitize_comment_html(input.text)
-        obj = Comment.objects.create(
-            author=user,
-            parent_id=int(input.parentId) if input.parentId else None,
-            text_raw=input.text,
-            text_html=html,
-            ip=ip or None,
-            user_agent=ua,
-        )
-        return CommentType.from_model(obj)
+        thread_key = namespaces.clean_key(input.threadKey)
+
+        with deadlines.budget("mutation"):
+            obj = coalescing.create(coalescing.NewComment(
+                name=user_name,
+                email=input.email,
+                home_page=input.homePage or "",
+                text_raw=input.text,
+                text_html=sanitize_comment_html(input.text),
+                parent_id=int(input.parentId) if input.parentId else None,
+                thread_key=thread_key,
+                ip=ip,
+                user_agent=ua,
+            ))
+            obj.replies_count = 0
+            return CommentType.from_model(obj)
 
     @strawberry.mutation
     def upload_attachment(self, info: Info, commentId: ID, file: Upload) -> AttachmentType:
-        comment = Comment.objects.get(pk=commentId)
-        uploaded: UploadedFile = file
-
-        att = Attachment(comment=comment)
-        att.file.save(uploaded.name, uploaded, save=False)
-        att.full_clean()
-        att.save()
-        return AttachmentType.from_model(att)
+        with sharding.thread(commentId), use_primary(), deadlines.budget("upload"):
+            comment = deletion.visible(commentId)
+            if comment is None:
+                raise Exception("Comment not found")
+            uploaded: UploadedFile = file
+
+            # Attachment.save stores the packed file (or thumbnail) only.
+            att = Attachment(comment=comment, file=uploaded)
+            att.full_clean()
+            with deadlines.atomic(Attachment):
+                att.save()
+                snapshots.on_attachment_created(att)
+            return AttachmentType.from_model(att)
 
-
-schema = strawberry.Schema(query=Query, mutation=Mutation)
+    @strawberry.mutation
+    def upload_attachments(self, info: Info, commentId: ID, files: List[Upload]) -> List[UploadResult]:
+        if len(files) > settings.UPLOAD_MAX_FILES:
+            raise Exception(f"At most {settings.UPLOAD_MAX_FILES} files per request")
+        with sharding.thread(commentId), use_primary(), deadlines.budget("upload"):
+            comment = deletion.visible(commentId)
+            if comment is None:
+                raise Exception("Comment not found")
+            results = uploads.save_many(comment, files)
+        urls = file_urls.urls(r["attachment"].file.name for r in results if r["attachment"])
+        return [
+            UploadResult(
+                name=r["name"],
+                attachment=AttachmentType.from_model(r["attachment"], urls.get(r["attachment"].file.name)) if r["attachment"] else None,
+                error=r["error"],
+            )
+            for r in results
+        ]
+
+schema = strawberry.Schema(
+    query=Query,
+    mutation=Mutation,
+    extensions=[
+        QueryDepthLimiter(max_depth=settings.GRAPHQL_MAX_DEPTH),
+        QueryCostLimiter,
+    ],
+)
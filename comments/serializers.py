@@ -1,8 +1,8 @@
 from django.utils.translation.trans_real import translation
-from django.db import transaction
 from rest_framework import serializers
 from .models import Comment, User
 from .utils import sanitize_comment_html, verify_captcha
+from . import coalescing, deletion, namespaces
 
 def validate_captcha(captcha_token: str, captcha_code: str) -> bool:
     # TODO: реализовать реальную проверку (Redis/сессии)
@@ -20,6 +20,7 @@ class CommentCreateSerializer(serializers.ModelSerializer):
         model = Comment
         fields = (
             'parent',
+            'thread_key',
             'text_raw',
             'name',
             'email',
@@ -30,6 +31,17 @@ class CommentCreateSerializer(serializers.ModelSerializer):
             'captcha',
         )
 
+    def validate_parent(self, value):
+        if value is not None and deletion.is_hidden(value):
+            raise serializers.ValidationError("Нельзя ответить на удалённый комментарий.")
+        return value
+
+    def validate_thread_key(self, value):
+        try:
+            return namespaces.clean_key(value)
+        except ValueError:
+            raise serializers.ValidationError("Недопустимый ключ раздела.")
+
     def validate(self, attrs):
         key = attrs.get('captchaKey') or attrs.get('captcha_token')
         code = attrs.get('captcha') or attrs.get('captcha_code')
@@ -41,7 +53,6 @@ class CommentCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({"text_raw": "Текст сообщения обязателен."})
         return attrs
 
-    @transaction.atomic
     def create(self, validated_data):
         for k in ('captchaKey', 'captcha'):
             validated_data.pop(k, None)
@@ -57,25 +68,19 @@ class CommentCreateSerializer(serializers.ModelSerializer):
         ip = request.META.get("REMOTE_ADDR") if request else None
         ua = request.META.get("HTTP_USER_AGENT", "") if request else ""
 
-        author = User(
+        parent = validated_data.get("parent")
+        item = coalescing.NewComment(
             name=name,
             email=email,
             home_page=home_page,
-            ip=ip,
-            user_agent=ua,
-        )
-        author.full_clean()
-        author.save()
-
-        comment = Comment(
-            author=author,
             text_raw=raw,
             text_html=html,
+            parent_id=parent.pk if parent else None,
+            thread_key=validated_data.get("thread_key", ""),
             ip=ip,
             user_agent=ua,
-            parent=validated_data.get("parent"),
         )
-        comment.full_clean()
-        comment.save()
-
-        return comment
\ No newline at end of file
+        author = User(name=name, email=email, home_page=home_page, ip=ip, user_agent=ua)
+        author.full_clean()
+        item.comment(author).full_clean(exclude=["author", "parent"])
+        return coalescing.create(item)
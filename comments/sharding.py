@@ -0,0 +1,289 @@
+"""
+Horizontal sharding of comment threads.
+
+A thread — the top-level comment, its replies and their authors,
+attachments, snapshot, change log rows and section counters — lives on one
+database of ``COMMENT_SHARDS`` ("default" is shard 0, ``DB_SHARDS`` adds the
+others). The shard is encoded in every comment id, so any comment is routed
+without a lookup::
+
+    id = SHARDED_ID_MIN + seq * SLOTS + slot
+
+``seq`` comes from ``IdSequence`` on the primary, handed to each process in
+blocks of ``COMMENT_ID_BLOCK``. A new thread takes ``slot = seq % SLOTS``
+and its replies inherit it; slots map to shards on a consistent-hash ring,
+so adding a shard remaps about 1/N of the slots. The shard list the ids
+were allocated under is recorded on the sequence row, and no id is
+allocated (nor ``migrate`` run) under a different one until
+``manage.py shard_layout --accept``: the threads on remapped slots would be
+unreachable, so they have to be moved first. Ids below ``SHARDED_ID_MIN``
+predate sharding and stay on "default". With one shard ids come from the
+table as before.
+
+Thread operations run under :func:`thread` (``routers.use_shard``). Lists
+that span threads query every shard: section counts are summed, the change
+feed keeps one position per shard, and the top-level feed is a k-way merge
+of per-shard keyset pages (:func:`feed_page`).
+"""
+import base64
+import bisect
+import datetime as dt
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import connections, transaction
+from django.db.models import CharField, DateTimeField, F, Q, TextField
+from django.db.models.functions import Collate
+
+from . import deadlines, partitioning
+from .models import Comment, IdSequence
+from .routers import PRIMARY_DB, use_shard
+
+SLOTS = 1024
+SHARDED_ID_MIN = 1 << 40
+VNODES = 64
+SEQUENCE = "comment"
+# Byte-order collations: UTF-8 compares like Python strings.
+COLLATIONS = {"postgresql": "C", "sqlite": "BINARY"}
+
+
+def aliases() -> list:
+    return settings.COMMENT_SHARDS
+
+
+def enabled() -> bool:
+    return len(aliases()) > 1
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, ``vnodes`` points per node."""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        self._points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in self._points]
+
+    def lookup(self, key) -> str:
+        i = bisect.bisect(self._hashes, _hash(f"slot:{key}")) % len(self._points)
+        return self._points[i][1]
+
+
+@lru_cache(maxsize=4)
+def _slot_map(shards: tuple) -> tuple:
+    ring = HashRing(shards)
+    return tuple(ring.lookup(slot) for slot in range(SLOTS))
+
+
+def shard_of(comment_id) -> str:
+    """Alias of the database holding ``comment_id``'s thread."""
+    try:
+        comment_id = int(comment_id)
+    except (TypeError, ValueError):
+        return PRIMARY_DB
+    if not enabled() or comment_id < SHARDED_ID_MIN:
+        return PRIMARY_DB
+    return _slot_map(tuple(aliases()))[comment_id % SLOTS]
+
+
+@contextmanager
+def thread(comment_id):
+    """Route the block to the shard of ``comment_id``'s thread."""
+    with use_shard(shard_of(comment_id)):
+        yield
+
+
+def group(comment_ids) -> dict:
+    """``{alias: [ids]}`` for a mixed list of comment ids."""
+    out = {}
+    for pk in comment_ids:
+        out.setdefault(shard_of(pk), []).append(pk)
+    return out
+
+
+class _Allocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+        self._pid = None
+
+    def take(self) -> int:
+        with self._lock:
+            # Blocks taken before a fork (gunicorn --preload) belong to the parent.
+            if self._next >= self._end or self._pid != os.getpid():
+                self._next, self._end = _allocate(settings.COMMENT_ID_BLOCK)
+                self._pid = os.getpid()
+            self._next += 1
+            return self._next - 1
+
+
+def layout_error(row) -> Optional[str]:
+    """Why ids can't be allocated under the current ``COMMENT_SHARDS``, or None."""
+    current = sorted(aliases())
+    # Nothing recorded (ids from before the check) is taken as the current layout.
+    if row.next_value and row.shards and row.shards != current:
+        return (
+            f"COMMENT_SHARDS is {current} but comment ids were allocated under {row.shards}: "
+            f"threads on remapped slots would be unreachable. Move them, then run `manage.py shard_layout --accept`."
+        )
+    return None
+
+
+def check_layout(row):
+    """Record the shard list on the locked sequence row, or raise if it changed since ids were allocated."""
+    error = layout_error(row)
+    if error:
+        raise ImproperlyConfigured(error)
+    if row.shards != sorted(aliases()):
+        row.shards = sorted(aliases())
+        row.save(using=PRIMARY_DB, update_fields=["shards"])
+
+
+def _allocate(count):
+    seqs = IdSequence.objects.using(PRIMARY_DB).filter(name=SEQUENCE)
+    with transaction.atomic(using=PRIMARY_DB):
+        check_layout(seqs.select_for_update().get())
+        seqs.update(next_value=F("next_value") + count)
+        end = seqs.values_list("next_value", flat=True).get()
+    return end - count, end
+
+
+_allocator = _Allocator()
+
+
+def new_comment_id(parent_id=None) -> Optional[int]:
+    """Id for a new comment, on its thread's shard; None (the table's own) without sharding."""
+    if not enabled():
+        return None
+    seq = _allocator.take()
+    if parent_id is None:
+        slot = seq % SLOTS
+    elif int(parent_id) >= SHARDED_ID_MIN:
+        slot = int(parent_id) % SLOTS
+    else:
+        # Reply in a thread from before sharding: any slot of "default".
+        slots = [s for s, alias in enumerate(_slot_map(tuple(aliases()))) if alias == PRIMARY_DB]
+        slot = slots[seq % len(slots)]
+    return SHARDED_ID_MIN + seq * SLOTS + slot
+
+
+def _value(row, field):
+    for part in field.split("__"):
+        row = getattr(row, part)
+    return row
+
+
+def _sort_key(field):
+    # Same order as _ordered: NULLs last ascending and first descending.
+    def key(row):
+        v = _value(row, field)
+        return (v is None, v, row.pk)
+    return key
+
+
+def _target(field):
+    model, *path = Comment, *field.split("__")
+    for part in path[:-1]:
+        model = model._meta.get_field(part).related_model
+    return model._meta.get_field(path[-1])
+
+
+def _ordered(qs, field, desc):
+    """
+        ``qs`` ordered by ``field`` then id the way :func:`_sort_key` orders
+        the merged rows, and the name to compare cursors against: NULLs
+        explicitly placed and, across shards, text in code point order
+        rather than the database collation.
+    """
+    key = field
+    collation = COLLATIONS.get(connections[PRIMARY_DB].vendor)
+    if enabled() and collation and isinstance(_target(field), (CharField, TextField)):
+        key = "feed_key"
+        qs = qs.annotate(feed_key=Collate(F(field), collation))
+    if desc:
+        return qs.order_by(F(key).desc(nulls_first=True), "-id"), key
+    return qs.order_by(F(key).asc(nulls_last=True), "id"), key
+
+
+def encode_cursor(row, field) -> str:
+    v = _value(row, field)
+    if isinstance(v, dt.datetime):
+        v = v.isoformat()
+    raw = json.dumps([field, v, row.pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, field):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        name, v, pk = json.loads(raw)
+        if name != field:
+            raise ValueError(cursor)
+        if v is not None and isinstance(_target(field), DateTimeField):
+            v = dt.datetime.fromisoformat(v)
+        return v, int(pk)
+    except (ValueError, TypeError, UnicodeDecodeError, FieldDoesNotExist):
+        raise ValueError("Invalid cursor") from None
+
+
+def _after(qs, key, field, desc, cursor):
+    v, pk = decode_cursor(cursor, field)
+    op = "lt" if desc else "gt"
+    if v is None:
+        cond = Q(**{f"{key}__isnull": True, f"pk__{op}": pk})
+        if desc:
+            # NULLs come first descending: every value follows them.
+            cond |= Q(**{f"{key}__isnull": False})
+        return qs.filter(cond)
+    cond = Q(**{f"{key}__{op}": v}) | Q(**{key: v, f"pk__{op}": pk})
+    if not desc and _target(field).null:
+        cond |= Q(**{f"{key}__isnull": True})
+    return qs.filter(cond)
+
+
+def feed_page(qs, field, desc, limit, offset=0, after=None):
+    """
+        One page of ``qs`` ordered by ``field`` then id, across every shard.
+
+        Each shard returns its first ``offset + limit`` rows after ``after``
+        (the cursor of a previous page) in feed order and the pages are
+        merged; with one shard it is a plain OFFSET query. Returns
+        ``(rows, next_cursor)``.
+    """
+    if "__" in field:
+        qs = qs.select_related(field.split("__")[0])
+    qs, key = _ordered(qs, field, desc)
+    if after:
+        qs = _after(qs, key, field, desc, after)
+
+    anchor = decode_cursor(after, field)[0] if after else None
+
+    def fetch(lo, hi):
+        if field == "created_at" and desc:
+            # Newest partitions first when comments are partitioned by created_at.
+            return partitioning.newest_first(qs, lo, hi, anchor)
+        return list(qs[lo:hi])
+
+    if not enabled():
+        with deadlines.atomic(Comment):
+            rows = fetch(offset, offset + limit)
+    else:
+        pages = []
+        for alias in aliases():
+            with use_shard(alias), deadlines.atomic(Comment):
+                pages.append(fetch(0, offset + limit))
+        merged = heapq.merge(*pages, key=_sort_key(field), reverse=desc)
+        rows = list(itertools.islice(merged, offset, offset + limit))
+    cursor = encode_cursor(rows[-1], field) if len(rows) == limit else None
+    return rows, cursor
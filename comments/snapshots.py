@@ -0,0 +1,209 @@
+"""
+Per-thread snapshot documents: one JSON row per top-level comment holding the
+rendered thread (author, ``text_html``, attachments, nested replies), so a
+thread is served with a single primary-key read.
+
+Snapshots are patched inside the write transaction of every comment and
+attachment insert; ``rebuild_thread_snapshots`` rebuilds them from the source
+tables and can check stored documents against a fresh build. The same reply
+hook bumps the root's ``last_activity_at``. Hidden subtrees (see
+comments/deletion.py) are left out, and a hidden thread has no snapshot.
+"""
+from typing import Optional
+
+from django.db.models import Value
+from django.db.models.functions import Greatest
+
+from . import file_urls, partitioning
+from .models import Attachment, Comment, ThreadSnapshot
+
+
+def attachment_node(a: Attachment) -> dict:
+    return {
+        "id": a.id,
+        "file": a.file.name,
+        "contentType": a.content_type or None,
+        "size": a.size or 0,
+        "width": a.width,
+        "height": a.height,
+        "isImage": a.is_image,
+        "preview": a.preview or None,
+        "lineCount": a.line_count,
+        "charCount": a.char_count,
+    }
+
+
+def comment_node(c: Comment) -> dict:
+    return {
+        "id": c.id,
+        "parentId": c.parent_id,
+        "author": {
+            "name": c.author.name,
+            "email": c.author.email,
+            "homePage": c.author.home_page or None,
+        },
+        "textHtml": c.text_html,
+        "createdAt": c.created_at.isoformat(),
+        "attachments": [],
+        "replies": [],
+    }
+
+
+def find_root_id(comment_id, parent_id) -> int:
+    """Walk up ``parent`` links to the top-level comment."""
+    while parent_id is not None:
+        comment_id, parent_id = parent_id, (
+            Comment.objects.filter(pk=parent_id).values_list("parent_id", flat=True).first()
+        )
+    return comment_id
+
+
+def _find(node: dict, comment_id: int):
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if n["id"] == comment_id:
+            return n
+        stack.extend(n["replies"])
+    return None
+
+
+def build_document(root: Comment) -> dict:
+    """Build a snapshot from the source tables, one query per tree level."""
+    doc = comment_node(root)
+    nodes = {root.id: doc}
+    level = [root.id]
+    while level:
+        children = list(
+            Comment.objects
+            .filter(partitioning.replies_since(root.created_at), parent_id__in=level, deleted_at__isnull=True)
+            .select_related("author").order_by("created_at", "id")
+        )
+        for c in children:
+            nodes[c.id] = comment_node(c)
+            nodes[c.parent_id]["replies"].append(nodes[c.id])
+        level = [c.id for c in children]
+    for a in Attachment.objects.filter(comment_id__in=list(nodes)).order_by("id"):
+        nodes[a.comment_id]["attachments"].append(attachment_node(a))
+    return doc
+
+
+def rebuild(root: Comment) -> Optional[ThreadSnapshot]:
+    if root.deleted_at is not None:
+        # A hidden thread has no snapshot (see on_subtree_hidden); new replies or uploads don't bring it back.
+        ThreadSnapshot.objects.filter(root_id=root.id).delete()
+        return None
+    snap, _ = ThreadSnapshot.objects.update_or_create(root=root, defaults={"document": build_document(root)})
+    return snap
+
+
+def _locked(root_id):
+    return ThreadSnapshot.objects.select_for_update().filter(root_id=root_id).first()
+
+
+def on_comment_created(comment: Comment):
+    """Patch (or create) the snapshot for a new comment; call inside its transaction."""
+    if comment.parent_id is None:
+        ThreadSnapshot.objects.create(root=comment, document=comment_node(comment))
+        return
+    root_id = find_root_id(comment.id, comment.parent_id)
+    Comment.objects.filter(pk=root_id).update(
+        last_activity_at=Greatest("last_activity_at", Value(comment.created_at))
+    )
+    snap = _locked(root_id)
+    if snap is None:
+        rebuild(Comment.objects.get(pk=root_id))
+        return
+    parent = _find(snap.document, comment.parent_id)
+    if parent is None:
+        rebuild(Comment.objects.get(pk=root_id))
+        return
+    parent["replies"].append(comment_node(comment))
+    snap.save(update_fields=["document", "updated_at"])
+
+
+def on_comments_created(comments):
+    """Batch form of :func:`on_comment_created`: one lock and one write per thread."""
+    roots = [c for c in comments if c.parent_id is None]
+    if roots:
+        ThreadSnapshot.objects.bulk_create([ThreadSnapshot(root=c, document=comment_node(c)) for c in roots])
+    by_root = {}
+    for c in comments:
+        if c.parent_id is not None:
+            by_root.setdefault(find_root_id(c.id, c.parent_id), []).append(c)
+    for root_id, replies in sorted(by_root.items()):
+        Comment.objects.filter(pk=root_id).update(
+            last_activity_at=Greatest("last_activity_at", Value(max(c.created_at for c in replies)))
+        )
+        snap = _locked(root_id)
+        parents = [_find(snap.document, c.parent_id) for c in replies] if snap else [None]
+        if any(p is None for p in parents):
+            rebuild(Comment.objects.get(pk=root_id))
+            continue
+        for parent, c in zip(parents, replies):
+            parent["replies"].append(comment_node(c))
+        snap.save(update_fields=["document", "updated_at"])
+
+
+def on_attachment_created(att: Attachment):
+    """Append an attachment to its comment's node; call inside its transaction."""
+    comment = att.comment
+    root_id = find_root_id(comment.id, comment.parent_id)
+    snap = _locked(root_id)
+    node = _find(snap.document, comment.id) if snap else None
+    if node is None:
+        rebuild(Comment.objects.get(pk=root_id))
+        return
+    node["attachments"].append(attachment_node(att))
+    snap.save(update_fields=["document", "updated_at"])
+
+
+def on_subtree_hidden(comment: Comment, root_id: int):
+    """Drop a hidden subtree from its thread's snapshot; call inside its transaction."""
+    if comment.parent_id is None:
+        ThreadSnapshot.objects.filter(root_id=comment.id).delete()
+        return
+    snap = _locked(root_id)
+    parent = _find(snap.document, comment.parent_id) if snap else None
+    if parent is None:
+        rebuild(Comment.objects.get(pk=root_id))
+        return
+    parent["replies"] = [r for r in parent["replies"] if r["id"] != comment.id]
+    snap.save(update_fields=["document", "updated_at"])
+
+
+def patch_text(comment_ids, html_by_id: dict):
+    """Replace ``textHtml`` of the given comments in their threads' snapshots; call inside a transaction."""
+    by_root = {}
+    for pk, parent_id in Comment.objects.filter(pk__in=comment_ids).values_list("pk", "parent_id"):
+        by_root.setdefault(find_root_id(pk, parent_id), []).append(pk)
+    for root_id, ids in by_root.items():
+        snap = _locked(root_id)
+        if snap is None:
+            continue
+        for pk in ids:
+            node = _find(snap.document, pk)
+            if node is not None:
+                node["textHtml"] = html_by_id[pk]
+        snap.save(update_fields=["document", "updated_at"])
+
+
+def _file_names(document: dict):
+    for a in document["attachments"]:
+        yield a["file"]
+    for r in document["replies"]:
+        yield from _file_names(r)
+
+
+def render(document: dict, urls: dict | None = None) -> dict:
+    """Snapshot document as served to clients: file names become URLs, resolved in one batch."""
+    if urls is None:
+        urls = file_urls.urls(_file_names(document))
+    out = {k: v for k, v in document.items() if k not in ("attachments", "replies")}
+    out["attachments"] = [
+        {**{k: v for k, v in a.items() if k != "file"}, "url": urls.get(a["file"], "")}
+        for a in document["attachments"]
+    ]
+    out["replies"] = [render(r, urls) for r in document["replies"]]
+    out["repliesCount"] = len(document["replies"])
+    return out
@@ -0,0 +1,20 @@
+"""
+Media storage for Google Cloud Storage (``USE_GCS_MEDIA=1``).
+
+Text attachments are stored gzip-compressed as ``*.txt.gz`` (see
+``imaging.pack_text``). They are uploaded with ``Content-Encoding: gzip``,
+so browsers get them as plain text and GCS decompresses them for clients
+that don't accept gzip.
+"""
+from storages.backends.gcloud import GoogleCloudStorage
+
+from .imaging import GZIP_SUFFIX, TEXT_CONTENT_TYPE
+
+
+class MediaStorage(GoogleCloudStorage):
+    def get_object_parameters(self, name):
+        params = super().get_object_parameters(name)
+        if name.endswith(GZIP_SUFFIX):
+            params.setdefault("content_encoding", "gzip")
+            params.setdefault("content_type", TEXT_CONTENT_TYPE)
+        return params
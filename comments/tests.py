@@ -1,3 +1,671 @@
-from django.test import TestCase
+import contextvars
+import datetime as dt
+import json
+import os
+import tempfile
+import threading
+from io import StringIO
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, router, transaction
+from django.db.models import Subquery
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import cache as tiered_cache
+from . import checks, coalescing, deadlines, deletion, file_urls, namespaces, partitioning, sharding, snapshots, uploads, utils
+from . import changelog
+from .models import CommentChange, Attachment, Comment, IdSequence, NamespaceCounter, OrphanedFile, ThreadSnapshot, User
+from .serializers import CommentCreateSerializer
+from .routers import PIN_COOKIE
+from .utils import _SALT as CAPTCHA_SALT, SANITIZE_POLICY_VERSION, make_captcha, verify_captcha
+
+COMMENTS_QUERY = "{ comments(page: 1, pageSize: 10, orderField: CREATED_AT, desc: true) { results { id } } }"
+CREATE_MUTATION = """
+mutation { createComment(input: {name: "alice", email: "a@example.com", text: "hi", captcha: "x", captchaKey: "k"}) { id } }
+"""
+
+
+@override_settings(DB_REPLICAS=["replica"])
+class ReplicaRoutingTests(TestCase):
+    databases = {"default", "replica"}
+
+    def graphql(self, query, **headers):
+        return self.client.post("/graphql/", {"query": query}, content_type="application/json", **headers)
+
+    def listed_ids(self, **headers):
+        response = self.graphql(COMMENTS_QUERY, **headers)
+        return [int(c["id"]) for c in response.json()["data"]["comments"]["results"]]
+
+    def create(self):
+        with mock.patch("comments.schema.verify_captcha", return_value=True):
+            response = self.graphql(CREATE_MUTATION)
+        return response, int(response.json()["data"]["createComment"]["id"])
+
+    def test_write_sets_pin_cookie_and_next_read_uses_primary(self):
+        response, comment_id = self.create()
+        self.assertEqual(response.cookies[PIN_COOKIE].value, "1")
+        self.assertEqual(response["X-DB-Pin"], "1")
+        # The replica hasn't caught up (it never does here); the pinned client still sees its comment.
+        self.assertEqual(self.listed_ids(), [comment_id])
+
+    @override_settings(COMMENT_WRITE_COALESCING=True)
+    def test_coalesced_write_sets_pin_cookie(self):
+        class Writer:
+            # Writes in a context of its own, like the writer thread.
+            def submit(self, item):
+                fut = Future()
+                fut.set_result(contextvars.Context().run(coalescing.write_one, item))
+                return fut
+
+        with mock.patch("comments.coalescing.get_writer", Writer):
+            response, comment_id = self.create()
+        self.assertEqual(response.cookies[PIN_COOKIE].value, "1")
+        self.assertEqual(self.listed_ids(), [comment_id])
+
+    def test_unpinned_reads_go_to_replica(self):
+        self.assertEqual(router.db_for_read(Comment), "replica")
+        self.assertEqual(router.db_for_write(Comment), "default")
+        self.create()
+        self.client.cookies.pop(PIN_COOKIE)
+        self.assertEqual(self.listed_ids(), [])
+        response = self.graphql(COMMENTS_QUERY)
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_pin_header_reads_primary(self):
+        _, comment_id = self.create()
+        self.client.cookies.pop(PIN_COOKIE)
+        self.assertEqual(self.listed_ids(HTTP_X_DB_PIN="1"), [comment_id])
+
+    @override_settings(REPLICA_PIN_SECONDS=3)
+    def test_pin_cookie_expires(self):
+        response, comment_id = self.create()
+        self.assertEqual(response.cookies[PIN_COOKIE]["max-age"], 3)
+        self.assertEqual(self.listed_ids(), [comment_id])
+        # What the browser does once max-age has passed.
+        self.client.cookies.pop(PIN_COOKIE)
+        self.assertEqual(self.listed_ids(), [])
+
+
+class TieredCacheTests(TestCase):
+    def setUp(self):
+        tiered_cache._versions.clear()
+
+    def test_invalidate_is_seen_past_local_copies(self):
+        tiered_cache.set("comments", "k", "old")
+        self.assertEqual(tiered_cache.get("comments", "k"), "old")
+        # Another worker bumps the version in the shared tier; this process's LRU still holds "old".
+        shared = tiered_cache._shared()
+        shared.incr("comments:version")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(tiered_cache.get("comments", "k"), "old")
+        self.assertFalse(queries.captured_queries)
+        later = time.monotonic() + settings.CACHE_VERSION_TTL
+        with mock.patch("comments.cache.time.monotonic", return_value=later):
+            self.assertIsNone(tiered_cache.get("comments", "k"))
+            self.assertEqual(tiered_cache.get_or_set("comments", "k", lambda: "new"), "new")
+
+    def test_invalidate_is_seen_at_once_in_its_process(self):
+        tiered_cache.set("comments", "k", "old")
+        tiered_cache.invalidate("comments")
+        self.assertIsNone(tiered_cache.get("comments", "k"))
+
+    def test_scope_invalidates_one_section(self):
+        for key in ("a", "b"):
+            tiered_cache.set("comments", f"top:{key}", key, scope=key)
+        tiered_cache.invalidate("comments", scope="a")
+        self.assertIsNone(tiered_cache.get("comments", "top:a", scope="a"))
+        self.assertEqual(tiered_cache.get("comments", "top:b", scope="b"), "b")
+        tiered_cache.invalidate("comments")
+        self.assertIsNone(tiered_cache.get("comments", "top:b", scope="b"))
+
+
+class CaptchaTests(TestCase):
+    def token(self):
+        with mock.patch("comments.utils._rand_code", return_value="AbC12"):
+            return make_captcha()[0]
+
+    def test_token_is_accepted_once(self):
+        token = self.token()
+        self.assertTrue(verify_captcha(token, "abc12"))
+        self.assertFalse(verify_captcha(token, "abc12"))
+
+    def test_wrong_answer_spends_the_token(self):
+        token = self.token()
+        self.assertFalse(verify_captcha(token, "wrong"))
+        self.assertFalse(verify_captcha(token, "abc12"))
+
+    def test_forged_token_spends_nothing(self):
+        token = self.token()
+        payload = signing.loads(token, salt=CAPTCHA_SALT)
+        self.assertFalse(verify_captcha(signing.dumps(payload, salt="other"), "abc12"))
+        self.assertTrue(verify_captcha(token, "abc12"))
+
+    def test_filter_forgets_after_two_periods(self):
+        spent = utils._NonceFilter(bits=1 << 10, period=60)
+        start = spent._rotated
+        self.assertTrue(spent.add_if_new("n"))
+        with mock.patch("comments.utils.time.monotonic", return_value=start + 61):
+            self.assertFalse(spent.add_if_new("n"))
+        with mock.patch("comments.utils.time.monotonic", return_value=start + 122):
+            self.assertTrue(spent.add_if_new("n"))
+
+
+@skipUnless(connection.vendor == "postgresql", "Postgres partitioning")
+@override_settings(COMMENTS_PARTITIONED=True)
+class PartitioningTests(TestCase):
+    def setUp(self):
+        # DDL is transactional: the conversion is rolled back with the test.
+        with connection.cursor() as cursor:
+            partitioning.convert_to_partitioned(cursor)
+            for month in range(1, 13):
+                partitioning.create_partition(cursor, dt.date(2025, month, 1))
+
+    def comment(self, parent=None, created_at=None):
+        author = User.objects.create(name="alice", email="a@example.com", ip="127.0.0.1", user_agent="")
+        c = Comment.objects.create(author=author, parent=parent, text_raw="hi", text_html="hi")
+        if created_at:
+            Comment.objects.filter(pk=c.pk).update(created_at=created_at)
+            c.refresh_from_db()
+        return c
+
+    def assertRejected(self, create):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            create()
+            with connection.cursor() as cursor:
+                cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+    def test_constraints_survive(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+                [partitioning.TABLE],
+            )
+            fks = [d for (d,) in cursor.fetchall()]
+        self.assertTrue(any(d.startswith("FOREIGN KEY (author_id) REFERENCES comments_user(id)") for d in fks))
+        self.assertRejected(lambda: self.comment(parent=Comment(pk=10 ** 9)))
+        self.assertRejected(lambda: Attachment.objects.bulk_create([Attachment(comment_id=10 ** 9, file="x")]))
+        self.assertRejected(lambda: Comment.objects.create(
+            author_id=10 ** 9, text_raw="hi", text_html="hi",
+        ))
+        Attachment.objects.bulk_create([Attachment(comment=self.comment(), file="x")])
+
+    def test_archive_takes_dependent_rows(self):
+        root = self.comment(created_at=dt.datetime(2025, 1, 10, tzinfo=dt.timezone.utc))
+        reply = self.comment(parent=root, created_at=dt.datetime(2025, 6, 1, tzinfo=dt.timezone.utc))
+        kept = self.comment(created_at=dt.datetime(2025, 6, 2, tzinfo=dt.timezone.utc))
+        namespaces.on_comments_created([root, reply, kept])
+        Attachment.objects.bulk_create([Attachment(comment=reply, file="attachments/a.txt.gz")])
+        ThreadSnapshot.objects.create(root=root, document={})
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with connection.cursor() as cursor:
+            # The rows above were inserted in this transaction; DROP TABLE refuses pending FK checks.
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            done = partitioning.archive_partitions(cursor, 3, tmp.name, today=dt.date(2025, 5, 1))
+        self.assertEqual(done, [("comments_comment_p202501", 1, 1, 1)])
+        self.assertEqual(list(Comment.objects.values_list("pk", flat=True)), [kept.pk])
+        self.assertEqual(list(User.objects.values_list("pk", flat=True)), [kept.author_id])
+        self.assertFalse(Attachment.objects.exists() or ThreadSnapshot.objects.exists())
+        self.assertEqual(list(OrphanedFile.objects.values_list("name", flat=True)), ["attachments/a.txt.gz"])
+        self.assertEqual(namespaces.counts(""), (1, 1))
+        archived = {
+            kind: [row["id"] for row in partitioning.read_archive(os.path.join(tmp.name, f"comments_comment_p202501{kind}.ndjson.gz"))]
+            for kind in ("", ".replies", ".users")
+        }
+        self.assertEqual(archived, {"": [root.pk], ".replies": [reply.pk], ".users": sorted([root.author_id, reply.author_id])})
+
+    def test_queries_skip_old_partitions(self):
+        root = self.comment(created_at=dt.datetime(2025, 6, 15, tzinfo=dt.timezone.utc))
+        replies = [self.comment(parent=root) for _ in range(2)]
+        older = [self.comment(created_at=dt.datetime(2025, m, 1, tzinfo=dt.timezone.utc)) for m in (1, 2, 3)]
+
+        parent_created = Subquery(Comment.objects.filter(pk=root.pk).values("created_at")[:1])
+        qs = Comment.objects.filter(partitioning.replies_since(parent_created), parent_id=root.pk)
+        self.assertEqual(sorted(c.pk for c in qs), [c.pk for c in replies])
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (ANALYZE, COSTS OFF) {sql}", params)
+            plan = "\n".join(line for (line,) in cursor.fetchall())
+        self.assertIn("comments_comment_p202505 comments_comment_5 (never executed)", plan)
+
+        feed = Comment.objects.filter(parent__isnull=True)
+        rows, cursor = sharding.feed_page(feed, "created_at", True, 2)
+        self.assertIsNotNone(cursor)
+        rows += sharding.feed_page(feed, "created_at", True, 10, after=cursor)[0]
+        self.assertEqual([c.pk for c in rows], [root.pk, *reversed([c.pk for c in older])])
+
+
+class UploadTests(TestCase):
+    def test_stored_files_are_removed_when_rows_fail(self):
+        author = User.objects.create(name="alice", email="a@example.com", ip="127.0.0.1", user_agent="")
+        comment = Comment.objects.create(author=author, text_raw="hi", text_html="hi")
+        files = [SimpleUploadedFile(f"{n}.txt", b"hello", content_type="text/plain") for n in "ab"]
+        storage = Attachment._meta.get_field("file").storage
+        with (
+            ThreadPoolExecutor(1) as pool,
+            mock.patch("comments.uploads.get_pool", return_value=pool),
+            mock.patch.object(Attachment.objects, "bulk_create", side_effect=RuntimeError("db down")),
+            mock.patch.object(storage, "delete", wraps=storage.delete) as delete,
+        ):
+            with self.assertRaises(RuntimeError):
+                uploads.save_many(comment, files)
+        names = [c.args[0] for c in delete.call_args_list]
+        self.assertEqual(len(names), 2)
+        self.assertFalse(any(storage.exists(name) for name in names))
+        self.assertFalse(OrphanedFile.objects.exists())
+
+    def test_graphql_upload_stores_only_the_packed_file(self):
+        author = User.objects.create(name="alice", email="a@example.com", ip="127.0.0.1", user_agent="")
+        comment = Comment.objects.create(author=author, text_raw="hi", text_html="hi")
+        operations = {
+            "query": "mutation($file: Upload!) { uploadAttachment(commentId: %d, file: $file) { id } }" % comment.pk,
+            "variables": {"file": None},
+        }
+        storage = Attachment._meta.get_field("file").storage
+        with mock.patch.object(storage, "save", wraps=storage.save) as save:
+            response = self.client.post("/graphql/", {
+                "operations": json.dumps(operations),
+                "map": json.dumps({"0": ["variables.file"]}),
+                "0": SimpleUploadedFile("notes.txt", b"hello", content_type="text/plain"),
+            })
+        self.assertNotIn("errors", response.json())
+        name = Attachment.objects.get().file.name
+        self.addCleanup(storage.delete, name)
+        self.assertEqual([c.args[0] for c in save.call_args_list], [name])
+        self.assertRegex(name, r"^attachments/\d{4}/\d{2}/\d{2}/notes\.txt\.gz$")
+
+
+# The manifest only exists after collectstatic.
+@override_settings(STORAGES={
+    **settings.STORAGES, "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+})
+class AdminTests(TestCase):
+    def setUp(self):
+        admin = get_user_model().objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.force_login(admin)
+        author = User.objects.create(name="alice", email="a@example.com", ip="127.0.0.1", user_agent="")
+        self.comment = Comment.objects.create(author=author, text_raw="hi", text_html="hi")
+
+    def test_only_listing_runs_in_the_budget(self):
+        url = "/admin/comments/comment/"
+        with mock.patch("comments.admin.deadlines.atomic", wraps=deadlines.atomic) as atomic:
+            self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertEqual(atomic.call_count, 1)
+            response = self.client.post(url, {
+                "action": "hide_with_replies", "_selected_action": [self.comment.pk], "index": 0,
+            })
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(atomic.call_count, 1)
+        self.comment.refresh_from_db()
+        self.assertIsNotNone(self.comment.deleted_at)
+
+    def test_section_counts(self):
+        namespaces.on_comment_created(self.comment)
+        response = self.client.get("/admin/comments/threadnamespace/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["cl"].result_list[0].threads, 1)
+
+
+class AttachmentListTests(TestCase):
+    QUERY = "{ comments(pageSize: 50) { results { id attachments { url } } } }"
+
+    def add_comments(self, n):
+        for _ in range(n):
+            author = User.objects.create(name="alice", email="a@example.com", ip="127.0.0.1", user_agent="")
+            c = Comment.objects.create(author=author, text_raw="hi", text_html="hi")
+            Attachment.objects.bulk_create([Attachment(comment=c, file=f"attachments/{c.pk}-{i}.png") for i in range(2)])
+
+    def run_query(self):
+        with CaptureQueriesContext(connection) as queries, \
+                mock.patch("comments.schema.file_urls.urls", wraps=file_urls.urls) as urls:
+            response = self.client.post("/graphql/", {"query": self.QUERY}, content_type="application/json")
+        results = response.json()["data"]["comments"]["results"]
+        self.assertEqual(urls.call_count, 1)
+        self.assertTrue(all(len(c["attachments"]) == 2 for c in results))
+        return len(results), len(queries)
+
+    def test_attachments_are_loaded_per_page(self):
+        self.add_comments(2)
+        _, few = self.run_query()
+        self.add_comments(8)
+        count, many = self.run_query()
+        self.assertEqual(count, 10)
+        self.assertEqual(many, few)
+
+
+@override_settings(NAMESPACE_COUNTER_STRIPES=4)
+class NamespaceCounterTests(TestCase):
+    def test_counts_are_summed_over_stripes(self):
+        threads = [Comment(id=i, thread_key="blog", parent_id=None) for i in range(1, 13)]
+        replies = [Comment(id=i, thread_key="blog", parent_id=1) for i in range(13, 16)]
+        for c in threads + replies:
+            namespaces.on_comment_created(c)
+        self.assertGreater(NamespaceCounter.objects.filter(namespace_id="blog").count(), 1)
+        self.assertEqual(namespaces.counts("blog"), (12, 15))
+        namespaces.on_comments_removed("blog", 1, 4)
+        self.assertEqual(namespaces.threads_count("blog"), 11)
+        namespaces.on_comments_restored("blog", 1, 4)
+        self.assertEqual(namespaces.counts("blog"), (12, 15))
+        self.assertEqual(namespaces.counts("other"), (0, 0))
+
+
+class CoalescedWriteTests(TransactionTestCase):
+    def item(self, **kw):
+        return coalescing.NewComment(name="alice", email="a@example.com", text_raw="hi", text_html="hi", **kw)
+
+    def test_failure_after_commit_is_not_written_again(self):
+        def invalidate(keys):
+            raise RuntimeError("cache down")
+
+        writer = coalescing.CoalescingWriter.__new__(coalescing.CoalescingWriter)
+        futures = [mock.Mock(), mock.Mock()]
+        with mock.patch("comments.coalescing._invalidate", invalidate), \
+                mock.patch.object(writer, "_write_alone") as write_alone, \
+                self.assertLogs("django.db.backends.base", "ERROR"):
+            writer._flush([(self.item(), futures[0], None), (self.item(), futures[1], None)])
+        write_alone.assert_not_called()
+        self.assertEqual(Comment.objects.count(), 2)
+        for fut in futures:
+            self.assertIsInstance(fut.set_result.call_args.args[0], Comment)
+
+    def test_failure_after_commit_of_single_insert(self):
+        def late():
+            raise RuntimeError("late")
+
+        with mock.patch("comments.changelog.record_comment", lambda c: transaction.on_commit(late)), \
+                self.assertLogs("coalescing", "ERROR"):
+            comment = coalescing.write_one(self.item())
+        self.assertEqual(list(Comment.objects.values_list("pk", flat=True)), [comment.pk])
+
+    def test_deadline_fails_only_expired_items(self):
+        def timed_out(items):
+            # The batch ran under the earliest budget and its transaction was canceled.
+            time.sleep(0.1)
+            return [coalescing.BatchFailed(deadlines.DeadlineExceeded("mutation"))] * len(items)
+
+        now = time.monotonic()
+        futures = [Future() for _ in range(3)]
+        entries = list(zip(
+            [coalescing.NewComment(name="alice", email="a@example.com", text_raw=f"#{i}", text_html="") for i in range(3)],
+            futures, [now + 0.05, None, now + 60],
+        ))
+        writer = coalescing.CoalescingWriter.__new__(coalescing.CoalescingWriter)
+        with mock.patch("comments.coalescing.write_many", timed_out), self.assertLogs("coalescing", "WARNING"):
+            writer._flush(entries)
+        self.assertIsInstance(futures[0].exception(), deadlines.DeadlineExceeded)
+        self.assertEqual([f.result().text_raw for f in futures[1:]], ["#1", "#2"])
+        self.assertEqual(Comment.objects.count(), 2)
+
+
+class HiddenThreadTests(TestCase):
+    def item(self, parent_id=None):
+        return coalescing.NewComment(name="alice", email="a@example.com", text_raw="hi", text_html="hi", parent_id=parent_id)
+
+    def setUp(self):
+        self.root = coalescing.write_one(self.item())
+        self.reply = coalescing.write_one(self.item(self.root.pk))
+        deletion.hide(self.root.pk)
+        self.root.refresh_from_db()
+
+    def test_replies_are_refused(self):
+        for parent in (self.root, self.reply):
+            with self.assertRaisesMessage(ValueError, "Parent comment not found"):
+                coalescing.write_one(self.item(parent.pk))
+        results = coalescing.write_many([self.item(self.reply.pk), self.item()])
+        self.assertIsInstance(results[0], ValueError)
+        self.assertIsInstance(results[1], Comment)
+        self.assertEqual(Comment.objects.filter(parent=self.reply).count(), 0)
+        with self.assertRaisesMessage(Exception, "Нельзя ответить"):
+            CommentCreateSerializer().validate_parent(self.reply)
+
+    def test_uploads_are_refused(self):
+        files = {"commentId": self.reply.pk, "file": SimpleUploadedFile("a.txt", b"hi", content_type="text/plain")}
+        self.assertEqual(self.client.post("/api/attachments/upload/", files).status_code, 404)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_replies_are_not_listed(self):
+        author = User.objects.create(name="bob", email="b@example.com", ip="127.0.0.1", user_agent="")
+        Comment.objects.create(parent=self.reply, author=author, text_raw="hi", text_html="hi")
+        for parent in (self.root, self.reply):
+            query = f"{{ comments(parentId: {parent.pk}) {{ count results {{ id }} }} }}"
+            response = self.client.post("/graphql/", {"query": query}, content_type="application/json")
+            self.assertEqual(response.json()["data"]["comments"], {"count": 0, "results": []})
+
+    def test_no_snapshot_for_hidden_thread(self):
+        self.assertIsNone(snapshots.rebuild(self.root))
+        self.assertFalse(ThreadSnapshot.objects.filter(root=self.root).exists())
+        ThreadSnapshot.objects.create(root=self.root, document={})
+        query = f"{{ threadSnapshot(rootId: {self.root.pk}) }}"
+        response = self.client.post("/graphql/", {"query": query}, content_type="application/json")
+        self.assertIsNone(response.json()["data"]["threadSnapshot"])
+
+
+# Transactional: on Postgres the feed only shows committed transactions.
+class ChangeFeedTests(TransactionTestCase):
+    def item(self, parent_id=None, text="hi"):
+        return coalescing.NewComment(name="alice", email="a@example.com", text_raw=text, text_html=text, parent_id=parent_id)
+
+    def since(self, token=None, parent_id=None, limit=50):
+        args = [f"limit: {limit}"]
+        if token is not None:
+            args.append(f'sinceToken: "{token}"')
+        if parent_id is not None:
+            args.append(f"parentId: {parent_id}")
+        query = f"{{ commentsSince({', '.join(args)}) {{ created {{ id }} repliesChanged {{ id repliesCount }} deleted token hasMore }} }}"
+        response = self.client.post("/graphql/", {"query": query}, content_type="application/json")
+        return response.json()["data"]["commentsSince"]
+
+    def test_changes_after_token(self):
+        start = self.since()
+        self.assertEqual((start["created"], start["hasMore"]), ([], False))
+        root = coalescing.write_one(self.item())
+        reply = coalescing.write_one(self.item(root.pk))
+
+        delta = self.since(start["token"])
+        # A new comment comes with its reply count; it isn't repeated in repliesChanged.
+        self.assertEqual((delta["created"], delta["repliesChanged"]), ([{"id": str(root.pk)}], []))
+        self.assertEqual(self.since(start["token"], parent_id=root.pk)["created"], [{"id": str(reply.pk)}])
+
+        deletion.hide(reply.pk)
+        delta = self.since(delta["token"])
+        self.assertEqual((delta["created"], delta["deleted"]), ([], []))
+        self.assertEqual(delta["repliesChanged"], [{"id": str(root.pk), "repliesCount": 0}])
+        self.assertEqual(self.since(delta["token"], parent_id=root.pk)["deleted"], [str(reply.pk)])
+        self.assertEqual(self.since(self.since(delta["token"])["token"])["repliesChanged"], [])
+
+    def test_has_more(self):
+        start = self.since()["token"]
+        ids = [coalescing.write_one(self.item(text=f"#{i}")).pk for i in range(3)]
+        first = self.since(start, limit=2)
+        self.assertEqual(([int(c["id"]) for c in first["created"]], first["hasMore"]), (ids[:2], True))
+        rest = self.since(first["token"], limit=2)
+        self.assertEqual(([int(c["id"]) for c in rest["created"]], rest["hasMore"]), (ids[2:], False))
+
+    def test_invalid_token(self):
+        query = '{ commentsSince(sinceToken: "nope") { token } }'
+        response = self.client.post("/graphql/", {"query": query}, content_type="application/json")
+        self.assertEqual(response.json()["errors"][0]["message"], "Invalid sinceToken")
+
+    @skipUnless(connection.vendor == "postgresql", "transaction ids")
+    def test_late_commit_is_not_skipped(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_writer():
+            try:
+                with transaction.atomic():
+                    coalescing.write_one(self.item(text="slow"))
+                    started.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        start = self.since()["token"]
+        thread = threading.Thread(target=slow_writer)
+        thread.start()
+        self.assertTrue(started.wait(10))
+        fast = coalescing.write_one(self.item(text="fast"))
+        # The slow write holds the feed back: nothing after it is handed out yet.
+        held = self.since(start); print(list(CommentChange.objects.values_list("id","txid")), changelog.decode_token(start), changelog.decode_token(held["token"]))
+        self.assertEqual((held["created"], held["token"]), ([], start))
+        release.set()
+        thread.join()
+        slow = Comment.objects.get(text_raw="slow")
+        self.assertEqual([int(c["id"]) for c in self.since(start)["created"]], [slow.pk, fast.pk])
+
+
+@override_settings(COMMENT_SHARDS=["default", "shard1"])
+class ShardedBatchTests(TransactionTestCase):
+    databases = {"default", "shard1"}
+
+    def setUp(self):
+        IdSequence.objects.get_or_create(name=sharding.SEQUENCE)
+
+    def flush(self, n, error, budget=None):
+        """Flush ``n`` comments; the second shard's transaction fails with ``error``, after the first committed."""
+        write_shard = coalescing._write_shard
+        shards = []
+
+        def flaky(items, ids):
+            # write_many runs each shard's batch inside use_shard.
+            shards.append(router.db_for_write(Comment))
+            if len(shards) == 2:
+                if budget:
+                    time.sleep(budget)
+                raise error
+            return write_shard(items, ids)
+
+        items = [
+            coalescing.NewComment(name="alice", email="a@example.com", text_raw=f"#{i}", text_html=f"#{i}")
+            for i in range(n)
+        ]
+        futures = [Future() for _ in items]
+        writer = coalescing.CoalescingWriter.__new__(coalescing.CoalescingWriter)
+        with mock.patch("comments.coalescing._write_shard", flaky), self.assertLogs("coalescing", "WARNING"):
+            expiry = time.monotonic() + budget if budget else None
+            writer._flush([(item, fut, expiry) for item, fut in zip(items, futures)])
+        self.assertEqual(len(shards), 2)
+        return futures, shards
+
+    def texts(self, alias):
+        return sorted(Comment.objects.using(alias).values_list("text_raw", flat=True))
+
+    def test_only_the_failed_shard_is_retried(self):
+        futures, (first, second) = self.flush(12, RuntimeError("shard down"))
+        self.assertTrue(all(isinstance(f.result(), Comment) for f in futures))
+        self.assertTrue(self.texts(second))
+        self.assertEqual(sorted(self.texts(first) + self.texts(second)), sorted(f"#{i}" for i in range(12)))
+
+    def test_deadline_fails_only_the_failed_shard(self):
+        futures, (first, second) = self.flush(12, deadlines.DeadlineExceeded("mutation"), budget=0.2)
+        written = sorted(f.result().text_raw for f in futures if f.exception() is None)
+        self.assertEqual(written, self.texts(first))
+        self.assertFalse(self.texts(second))
+        failed = [f.exception() for f in futures if f.exception()]
+        self.assertTrue(failed)
+        self.assertTrue(all(isinstance(e, deadlines.DeadlineExceeded) for e in failed))
+
+
+@override_settings(COMMENT_SHARDS=["default", "shard1", "shard2"])
+class ShardedFeedTests(TransactionTestCase):
+    databases = {"default", "shard1", "shard2"}
+    names = ["alice", "Bob", "bob", "Émile", "emile", "Zed", "zoe", "Ålice", "éa", "Alice", "_x", "bob"]
+
+    def setUp(self):
+        IdSequence.objects.get_or_create(name=sharding.SEQUENCE)
+        for i, name in enumerate(self.names):
+            coalescing.write_one(coalescing.NewComment(
+                name=name, email=f"{name.lower()}@example.com", text_raw=f"#{i}", text_html=f"#{i}",
+            ))
+        self.rows = []
+        base = dt.datetime(2026, 1, 1, tzinfo=dt.timezone.utc)
+        for alias in sharding.aliases():
+            for c in Comment.objects.using(alias).select_related("author"):
+                # Ties on every other value and some threads without activity.
+                c.last_activity_at = None if c.pk % 3 == 0 else base + dt.timedelta(minutes=c.pk % 2)
+                Comment.objects.using(alias).filter(pk=c.pk).update(last_activity_at=c.last_activity_at)
+                self.rows.append(c)
+        self.feed = Comment.objects.filter(parent__isnull=True)
+
+    def expected(self, field, desc):
+        values = [(sharding._value(c, field), c.pk) for c in self.rows]
+        order = sorted(v for v in values if v[0] is not None) + sorted(v for v in values if v[0] is None)
+        order = [pk for _, pk in order]
+        return order[::-1] if desc else order
+
+    def walk(self, field, desc, limit=2):
+        rows, cursor = sharding.feed_page(self.feed, field, desc, limit)
+        while cursor:
+            page, cursor = sharding.feed_page(self.feed, field, desc, limit, after=cursor)
+            rows += page
+        return [c.pk for c in rows]
+
+    def test_threads_are_spread(self):
+        self.assertGreater(sum(bool(Comment.objects.using(a).exists()) for a in sharding.aliases()), 1)
+        self.assertTrue(any(c.last_activity_at is None for c in self.rows))
+
+    def test_text_is_merged_in_code_point_order(self):
+        for desc in (False, True):
+            expected = self.expected("author__name", desc)
+            self.assertEqual(self.walk("author__name", desc), expected)
+            rows, _ = sharding.feed_page(self.feed, "author__name", desc, 3, offset=3)
+            self.assertEqual([c.pk for c in rows], expected[3:6])
+
+    def test_null_values_page_through(self):
+        for desc in (False, True):
+            for limit in (1, 2, 5):
+                self.assertEqual(self.walk("last_activity_at", desc, limit), self.expected("last_activity_at", desc))
+
+    def test_created_at_cursor(self):
+        self.assertEqual(self.walk("created_at", True), self.expected("created_at", True))
+
+    def test_commands_cover_every_shard(self):
+        for alias in sharding.aliases():
+            Comment.objects.using(alias).update(sanitize_version=0, text_html="<b>stale</b>")
+        call_command("backfill_last_activity", stdout=StringIO())
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        checkpoint = os.path.join(tmp.name, "checkpoint")
+        call_command("resanitize_comments", "--workers", "1", "--checkpoint", checkpoint, stdout=StringIO())
+        for alias in sharding.aliases():
+            rows = Comment.objects.using(alias)
+            self.assertFalse(rows.filter(last_activity_at__isnull=True).exists(), alias)
+            self.assertFalse(rows.exclude(sanitize_version=SANITIZE_POLICY_VERSION).exists(), alias)
+
+
+@override_settings(COMMENT_SHARDS=["default", "shard1"])
+class ShardLayoutTests(TransactionTestCase):
+    databases = {"default", "shard1"}
+
+    def setUp(self):
+        IdSequence.objects.update_or_create(name=sharding.SEQUENCE, defaults={"next_value": 0, "shards": []})
+        sharding._allocate(1)
+
+    def test_changed_shards_are_refused_until_accepted(self):
+        self.assertEqual(IdSequence.objects.get().shards, ["default", "shard1"])
+        with override_settings(COMMENT_SHARDS=["default", "shard1", "shard2"]):
+            with self.assertRaisesMessage(ImproperlyConfigured, "shard_layout --accept"):
+                sharding._allocate(1)
+            errors = checks.shard_layout(None, databases=["default"])
+            self.assertEqual([e.id for e in errors], ["comments.E001"])
+            with self.assertRaises(CommandError):
+                call_command("shard_layout", stdout=StringIO())
+            out = StringIO()
+            call_command("shard_layout", "--accept", stdout=out)
+            self.assertIn("slots map to another shard", out.getvalue())
+            self.assertFalse(checks.shard_layout(None, databases=["default"]))
+            sharding._allocate(1)
+
+    def test_layout_before_any_id_is_recorded(self):
+        IdSequence.objects.update(next_value=0)
+        with override_settings(COMMENT_SHARDS=["default"]):
+            self.assertFalse(checks.shard_layout(None, databases=["default"]))
@@ -0,0 +1,152 @@
+"""
+Multi-file attachment uploads.
+
+Validation and thumbnailing run concurrently in a bounded process pool (no
+GIL contention with request threads), storage writes run concurrently in
+threads, and all rows are inserted in one transaction. Each file gets its own
+result or error, so one bad file doesn't fail the others. If the rows can't
+be inserted, the files already stored are deleted again (or queued for
+``deletion.sweep_files`` when storage refuses).
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from . import deadlines, snapshots
+from .imaging import prepare_upload
+from .models import Attachment, OrphanedFile
+
+log = logging.getLogger("uploads")
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """Per-process pool, created lazily (and again after a fork)."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.UPLOAD_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _storage_name(name: str) -> str:
+    field = Attachment._meta.get_field("file")
+    return field.generate_filename(None, name)
+
+
+def _discard(storage, names):
+    """Delete stored files that never got their rows."""
+    left = []
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception:
+            left.append(name)
+    if not left:
+        return
+    try:
+        OrphanedFile.objects.bulk_create([OrphanedFile(name=name) for name in left])
+    except Exception:
+        log.error("orphaned upload files: %s", ", ".join(left), exc_info=True)
+
+
+def save_many(comment, files) -> list[dict]:
+    """
+        Process and store ``files`` (UploadedFile objects) for ``comment``.
+
+        Returns one ``{"name", "attachment", "error"}`` dict per file, in order.
+    """
+    results = [{"name": f.name, "attachment": None, "error": None} for f in files]
+
+    futures = {}
+    pool = get_pool()
+    for i, f in enumerate(files):
+        if f.size and f.size > settings.UPLOAD_MAX_FILE_SIZE:
+            results[i]["error"] = "Файл слишком большой."
+            continue
+        futures[i] = pool.submit(prepare_upload, f.name, f.read(), deadlines.remaining())
+
+    prepared = {}
+    timed_out = False
+    for i, fut in futures.items():
+        left = deadlines.remaining()
+        try:
+            prepared[i] = fut.result(timeout=None if left is None else max(left, 0))
+        except ValueError as e:
+            results[i]["error"] = str(e)
+        except (TimeoutError, deadlines.DeadlineExceeded):
+            fut.cancel()
+            timed_out = True
+            results[i]["error"] = "Файл не успел обработаться, попробуйте ещё раз."
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            results[i]["error"] = "Не удалось обработать файл, попробуйте ещё раз."
+        except Exception as e:
+            results[i]["error"] = f"Не удалось обработать файл: {e}"
+    if timed_out:
+        deadlines.count_timeout("upload")
+
+    storage = Attachment._meta.get_field("file").storage
+
+    def write(item):
+        return storage.save(_storage_name(item["name"]), ContentFile(item["data"]))
+
+    stored = {}
+    if prepared:
+        deadlines.check()
+        with ThreadPoolExecutor(max_workers=min(len(prepared), settings.UPLOAD_POOL_WORKERS * 2)) as io_pool:
+            writes = {i: io_pool.submit(write, item) for i, item in prepared.items()}
+            for i, fut in writes.items():
+                try:
+                    stored[i] = fut.result()
+                except Exception as e:
+                    results[i]["error"] = f"Не удалось сохранить файл: {e}"
+
+    rows = {
+        i: Attachment(
+            comment=comment,
+            file=name,
+            content_type=prepared[i]["content_type"],
+            size=prepared[i]["size"],
+            width=prepared[i]["width"],
+            height=prepared[i]["height"],
+            is_image=prepared[i]["is_image"],
+            preview=prepared[i].get("preview", ""),
+            line_count=prepared[i].get("line_count"),
+            char_count=prepared[i].get("char_count"),
+        )
+        for i, name in stored.items()
+    }
+    if rows:
+        try:
+            with deadlines.atomic(Attachment):
+                Attachment.objects.bulk_create(rows.values())
+                for att in rows.values():
+                    snapshots.on_attachment_created(att)
+        except Exception:
+            _discard(storage, stored.values())
+            raise
+    for i, att in rows.items():
+        results[i]["attachment"] = att
+    return results
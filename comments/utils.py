@@ -1,27 +1,35 @@
-import bleach
-import io, base64, secrets, string, random, hashlib, logging
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from django.core.cache import cache
-from django.core.signing import TimestampSigner, BadSignature, SignatureExpired
+import io, base64, secrets, string, random, hashlib, hmac, logging, threading, time
+from functools import lru_cache
+from django.core import signing
+from django.utils.crypto import salted_hmac
+
+from .deadlines import check as check_deadline
 
 log = logging.getLogger("captcha")
 
 ABC = string.ascii_letters + string.digits
-H = lambda s: hashlib.sha256(s.encode('utf-8')).hexdigest()
-_SIGNER = TimestampSigner(salt="comments.captcha")
+_SALT = "comments.captcha.v2"
 _TTL = 300
 
 ALLOWED_TAGS = ["a", "code", "i", "strong"]
 ALLOWED_ATTRS = {"a": ["href", "title"]}
 ALLOWED_PROTOCOLS = ["http", "https", "mailto"]
-
-CLEANER = bleach.Cleaner(
-    tags=ALLOWED_TAGS,
-    attributes=ALLOWED_ATTRS,
-    protocols=ALLOWED_PROTOCOLS,
-    strip=True,
-    strip_comments=True,
-)
+# Bump whenever the policy above or sanitize_comment_html changes, then run
+# `manage.py resanitize_comments` to reprocess rows stored under older versions.
+SANITIZE_POLICY_VERSION = 1
+
+@lru_cache(maxsize=None)
+def get_cleaner():
+    # bleach (and html5lib under it) is imported on first use, not at startup.
+    import bleach
+
+    return bleach.Cleaner(
+        tags=ALLOWED_TAGS,
+        attributes=ALLOWED_ATTRS,
+        protocols=ALLOWED_PROTOCOLS,
+        strip=True,
+        strip_comments=True,
+    )
 
 def sanitize_comment_html(raw: str) -> str:
     """
@@ -49,20 +57,90 @@ def sanitize_comment_html(raw: str) -> str:
     if not raw:
         return ""
 
+    import bleach
+
+    check_deadline()
     linked = bleach.linkify(raw, parse_email=True)
+    check_deadline()
 
-    safe_html = CLEANER.clean(linked)
+    safe_html = get_cleaner().clean(linked)
     return safe_html
 
+def sanitize_many(rows):
+    """``[(id, raw), ...] -> [(id, html), ...]``; process-pool entry point for bulk re-sanitizing."""
+    return [(pk, sanitize_comment_html(raw)) for pk, raw in rows]
+
 def _rand_code(n=5):
     return ''.join(random.choice(ABC) for _ in range(n))
 
+def _answer_hash(nonce: str, code: str) -> str:
+    return salted_hmac(_SALT, f"{nonce}:{code.lower()}", algorithm="sha256").hexdigest()[:32]
+
+
+
+class _NonceFilter:
+    """
+        Rotating Bloom filter of spent captcha nonces.
+
+        Two generations of ``bits`` bits each; the older one is dropped every
+        ``period`` seconds. With ``period`` equal to the token TTL a nonce is
+        remembered for at least as long as its token is valid, in a fixed
+        2 × ``bits`` / 8 bytes per process and with no shared-state writes.
+    """
+
+    def __init__(self, bits=1 << 20, hashes=4, period=_TTL):
+        self.bits = bits
+        self.hashes = hashes
+        self.period = period
+        self._cur = bytearray(bits // 8)
+        self._prev = bytearray(bits // 8)
+        self._rotated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _positions(self, nonce: str):
+        digest = hashlib.blake2b(nonce.encode(), digest_size=4 * self.hashes).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[4 * i:4 * i + 4], "little") % self.bits
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self._rotated >= self.period:
+            self._prev = self._cur if now - self._rotated < 2 * self.period else bytearray(self.bits // 8)
+            self._cur = bytearray(self.bits // 8)
+            self._rotated = now
+
+    def add_if_new(self, nonce: str) -> bool:
+        """Mark ``nonce`` as spent; False if it (probably) already was."""
+        pos = list(self._positions(nonce))
+        with self._lock:
+            self._rotate()
+            seen = all(self._cur[p >> 3] & (1 << (p & 7)) for p in pos) or \
+                all(self._prev[p >> 3] & (1 << (p & 7)) for p in pos)
+            if seen:
+                return False
+            for p in pos:
+                self._cur[p >> 3] |= 1 << (p & 7)
+            return True
+
+
+_SPENT = _NonceFilter()
+
+
 def make_captcha(ttl=_TTL):
+    """
+        Issue a stateless captcha: the returned token carries the keyed answer
+        hash, nonce and expiry under an HMAC signature, nothing is stored.
+        :func:`verify_captcha` spends the nonce on the first attempt, right or
+        wrong, so a token allows one guess.
+    """
+    from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
     code = _rand_code(5)
-    key  = secrets.token_urlsafe(16)
-    value = H(code.lower())
-    cache.set(f'captcha:{key}', value, ttl)
-    token = _SIGNER.sign(value)
+    nonce = secrets.token_urlsafe(12)
+    token = signing.dumps(
+        {"h": _answer_hash(nonce, code), "n": nonce, "e": int(time.time()) + ttl},
+        salt=_SALT,
+    )
 
     img = Image.new('RGB', (120, 40), '#f3f4f6')
     d = ImageDraw.Draw(img)
@@ -77,18 +155,18 @@ def make_captcha(ttl=_TTL):
     b64 = 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
     return token, b64
 
-def verify_captcha(key_or_token: str | None, code: str | None, max_age=_TTL) -> bool:
-    if not key_or_token or not code:
+def verify_captcha(token: str | None, code: str | None, max_age=_TTL) -> bool:
+    if not token or not code:
         return False
-    raw  = code.strip()
-    low  = raw.lower()
     try:
-        stored_h = _SIGNER.unsign(key_or_token, max_age=max_age)
-        return stored_h in (H(low), H(raw), low, raw)
-    except (BadSignature, SignatureExpired):
-        pass
-    stored = cache.get(f'captcha:{key_or_token}')
-    cache.delete(f'captcha:{key_or_token}')
-    if not stored:
+        payload = signing.loads(token, salt=_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return False
+    if payload.get("e", 0) < time.time():
+        return False
+    nonce = payload.get("n", "")
+    # Spent before the answer is checked: one guess per token, not one per request for its whole TTL.
+    if not _SPENT.add_if_new(nonce):
+        log.info("captcha replay rejected")
         return False
-    return stored in (H(low), H(raw), low, raw)
\ No newline at end of file
+    return hmac.compare_digest(payload.get("h", ""), _answer_hash(nonce, code.strip()))
@@ -1,18 +1,22 @@
 import base64
 
-from django.http import JsonResponse, HttpResponse
+from django.http import Http404, JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.shortcuts import get_object_or_404
 from rest_framework import generics, permissions
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.decorators import api_view
-from django.db.models import Count
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from django.core.exceptions import ValidationError
 from django.conf import settings
 
 from .models import Comment, Attachment
 from .serializers import CommentCreateSerializer
 from .utils import make_captcha
+from .routers import use_primary
+from . import cache as tiered_cache
+from . import compression, deadlines, deletion, file_urls, namespaces, sharding, snapshots, uploads
 
 
 class CommentPagination(PageNumberPagination):
@@ -23,14 +27,21 @@ class CommentCreateView(generics.CreateAPIView):
     serializer_class = CommentCreateSerializer
     permission_classes = [permissions.AllowAny]
 
+    def create(self, request, *args, **kwargs):
+        # The parent is looked up (and the reply written) on its thread's shard.
+        with sharding.thread(request.data.get("parent")), use_primary(), deadlines.budget("mutation"):
+            return super().create(request, *args, **kwargs)
+
 
 SORT_MAP = {
-    "user_name": "user_name",
-    "-user_name": "-user_name",
-    "email": "email",
-    "-email": "-email",
+    "user_name": "author__name",
+    "-user_name": "-author__name",
+    "email": "author__email",
+    "-email": "-author__email",
     "created_at": "created_at",
     "-created_at": "-created_at",
+    "last_activity": "last_activity_at",
+    "-last_activity": "-last_activity_at",
 }
 
 
@@ -38,30 +49,84 @@ SORT_MAP = {
 def top_comments_list(request):
     order = request.GET.get("order", "-created_at")
     order = SORT_MAP.get(order, "-created_at")
+    page_no = request.GET.get(CommentPagination.page_query_param, "1")
+    try:
+        key = namespaces.clean_key(request.GET.get("thread_key"))
+    except ValueError:
+        return JsonResponse({"error": "Invalid thread_key"}, status=400)
+
+    encoding = compression.negotiate(request)
 
+    def build():
+        with deadlines.budget("comments"), deadlines.atomic(Comment):
+            return _top_comments_page(request, order, key)
+
+    def render():
+        data = tiered_cache.get_or_set("comments", f"top:{key}:{order}:{page_no}", build, scope=key)
+        return compression.encode(JSONRenderer().render(data), encoding)
+
+    # Stored per encoding, so hits are served without rendering or recompressing.
+    body = tiered_cache.get_or_set(
+        "comments", f"top:{key}:{order}:{page_no}:{encoding or 'identity'}", render, scope=key,
+    )
+    return compression.cached_response(body)
+
+
+def _top_comments_page(request, order, thread_key=""):
     qs = (
         Comment.objects
-        .filter(parent__isnull=True)
+        .filter(thread_key=thread_key, parent__isnull=True, deleted_at__isnull=True)
         .select_related('author')
-        .order_by(order)
-        .annotate(replies_count=Count('children'))
-        .prefetch_related('attachments')
+        .order_by(order, "-id" if order.startswith("-") else "id")
+        .annotate(replies_count=deletion.replies_count())
     )
     paginator = CommentPagination()
+    if sharding.enabled():
+        return _sharded_page(request, paginator, qs, order, thread_key)
     page = paginator.paginate_queryset(qs, request)
-    data = [
+    return paginator.get_paginated_response(_top_comments_json(page)).data
+
+
+def _sharded_page(request, paginator, qs, order, thread_key):
+    # Same response as PageNumberPagination, from a merge of the shards' pages.
+    try:
+        page_no = int(request.GET.get(paginator.page_query_param, 1))
+    except ValueError:
+        raise NotFound("Invalid page.")
+    count = namespaces.threads_count(thread_key)
+    pages = max(1, -(-count // paginator.page_size))
+    if not 1 <= page_no <= pages:
+        raise NotFound("Invalid page.")
+    rows, _ = sharding.feed_page(
+        qs, order.lstrip("-"), order.startswith("-"), paginator.page_size, (page_no - 1) * paginator.page_size,
+    )
+    url = request.build_absolute_uri()
+    return {
+        "count": count,
+        "next": replace_query_param(url, paginator.page_query_param, page_no + 1) if page_no < pages else None,
+        "previous": (
+            None if page_no == 1
+            else remove_query_param(url, paginator.page_query_param) if page_no == 2
+            else replace_query_param(url, paginator.page_query_param, page_no - 1)
+        ),
+        "results": _top_comments_json(rows),
+    }
+
+
+def _top_comments_json(page):
+    return [
         {
             "id": c.id,
-            "user_name": c.user_name,
-            "email": c.email,
-            "home_page": c.home_page,
+            "user_name": c.author.name,
+            "email": c.author.email,
+            "home_page": c.author.home_page,
             "text_html": c.text_html,
             "created_at": c.created_at,
+            "last_activity_at": c.last_activity_at,
             "replies_count": c.replies_count,
         }
         for c in page
     ]
-    return paginator.get_paginated_response(data)
 
 
 @csrf_exempt
@@ -74,21 +139,20 @@ def upload_attachment_view(request):
     if not comment_id or not f:
         return JsonResponse({"error": "Fields 'commentId' and 'file' are required"}, status=400)
 
-    comment = get_object_or_404(Comment, pk=comment_id)
+    with sharding.thread(comment_id), use_primary(), deadlines.budget("upload"):
+        return _save_attachment(comment_id, f)
+
+
+def _save_attachment(comment_id, f):
+    comment = _visible_or_404(comment_id)
 
     try:
         att = Attachment(comment=comment, file=f)
         att.full_clean()
-        att.save()
-        return JsonResponse({
-            "id": att.id,
-            "url": att.file.url,
-            "contentType": att.content_type,
-            "isImage": att.is_image,
-            "width": att.width,
-            "height": att.height,
-            "size": att.size,
-        })
+        with deadlines.atomic(Attachment):
+            att.save()
+            snapshots.on_attachment_created(att)
+        return JsonResponse(_attachment_json(att))
     except ValidationError as e:
         msgs = []
         if hasattr(e, "message_dict"):
@@ -99,10 +163,64 @@ def upload_attachment_view(request):
         else:
             msgs = [str(e)]
         return JsonResponse({"error": "; ".join(msgs) or "Validation error"}, status=400)
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
 
+@csrf_exempt
+def upload_attachments_view(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "Only POST allowed"}, status=405)
+
+    comment_id = request.POST.get("commentId")
+    files = request.FILES.getlist("files")
+    if not comment_id or not files:
+        return JsonResponse({"error": "Fields 'commentId' and 'files' are required"}, status=400)
+    if len(files) > settings.UPLOAD_MAX_FILES:
+        return JsonResponse({"error": f"At most {settings.UPLOAD_MAX_FILES} files per request"}, status=400)
+
+    with sharding.thread(comment_id), use_primary(), deadlines.budget("upload"):
+        comment = _visible_or_404(comment_id)
+        results = uploads.save_many(comment, files)
+    urls = file_urls.urls(r["attachment"].file.name for r in results if r["attachment"])
+
+    return JsonResponse({
+        "results": [
+            {
+                "name": r["name"],
+                "error": r["error"],
+                "attachment": _attachment_json(r["attachment"], urls.get(r["attachment"].file.name)) if r["attachment"] else None,
+            }
+            for r in results
+        ]
+    })
+
+
+def _visible_or_404(comment_id):
+    # Comments inside a hidden subtree take no uploads.
+    comment = deletion.visible(comment_id)
+    if comment is None:
+        raise Http404("Comment not found")
+    return comment
+
+
+def _attachment_json(att, url=None):
+    return {
+        "id": att.id,
+        "url": url if url is not None else file_urls.url(att.file.name),
+        "contentType": att.content_type,
+        "isImage": att.is_image,
+        "width": att.width,
+        "height": att.height,
+        "size": att.size,
+        "preview": att.preview or None,
+        "lineCount": att.line_count,
+        "charCount": att.char_count,
+    }
+
+
 def captcha_json(request):
     key, img_b64 = make_captcha()
     return JsonResponse({'image_base64': img_b64, 'key': key})
@@ -0,0 +1,40 @@
+"""
+Gunicorn config for FAST_START=1 (see entrypoint.sh).
+
+The app, Django and the URLconf (Strawberry schema) are imported once in the
+master and shared by forked workers. Heavy modules that only a few requests
+need are warmed in a background thread after each worker starts, so neither
+the boot nor the first request pays for them. Database connections (and
+pools, DB_POOL=1) opened by the master are closed before each fork.
+"""
+import os
+import threading
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GTHREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = True
+accesslog = "-"
+errorlog = "-"
+
+
+def _warm_heavy_modules():
+    from django.core.files.storage import default_storage
+    from PIL import Image  # noqa: F401
+
+    from comments.utils import get_cleaner
+
+    get_cleaner()
+    default_storage._setup()
+
+
+def post_worker_init(worker):
+    threading.Thread(target=_warm_heavy_modules, name="warmup", daemon=True).start()
+
+
+def pre_fork(server, worker):
+    # Pool threads and sockets opened in the master don't survive the fork.
+    from comments import dbpool
+
+    dbpool.close_all()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -53,8 +54,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "comments.profiling.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    "comments.compression.CompressionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
 
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -63,6 +66,8 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "comments.routers.ReplicaPinMiddleware",
+    "comments.deadlines.DeadlineMiddleware",
 ]
 
 ROOT_URLCONF = 'core.urls'
@@ -85,7 +90,7 @@ TEMPLATES = [
     },
 ]
 
-CORS_EXPOSE_HEADERS = ["X-Captcha-Key"]
+CORS_EXPOSE_HEADERS = ["X-Captcha-Key", "X-DB-Pin"]
 CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOWED_ORIGINS = [
     *(o.strip() for o in os.getenv(
@@ -93,7 +98,7 @@ CORS_ALLOWED_ORIGINS = [
         "http://localhost:5173,http://127.0.0.1:5173,https://commets-frontend-755819237934.europe-central2.run.app")
     .split(",") if o.strip())
 ]
-CORS_ALLOW_HEADERS = ["authorization", "content-type", "x-requested-with"]
+CORS_ALLOW_HEADERS = ["authorization", "content-type", "x-requested-with", "x-db-pin"]
 CORS_ALLOW_METHODS = ["GET", "POST", "OPTIONS"]
 
 CSRF_TRUSTED_ORIGINS = [
@@ -139,6 +144,156 @@ else:
         }
     }
 
+# Connection pool (comments/dbpool.py): DB_POOL=1 gives each process a bounded pool
+# of Postgres connections (psycopg 3) shared by its threads instead of one persistent
+# connection per thread; connections are checked on checkout.
+DB_POOL = os.getenv("DB_POOL", "0") == "1"
+# Behind PgBouncer in transaction mode: no server-side cursors, prepared statements
+# or session settings (deadlines use SET LOCAL-style set_config already).
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+if DATABASES["default"]["ENGINE"].endswith("postgresql"):
+    options = DATABASES["default"].setdefault("OPTIONS", {})
+    if DB_POOL:
+        DATABASES["default"]["CONN_MAX_AGE"] = 0
+        DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+        options["pool"] = {
+            "min_size": int(os.getenv("DB_POOL_MIN", "1")),
+            # One per request thread, plus the coalescing writer and a spare.
+            "max_size": int(os.getenv("DB_POOL_MAX", str(int(os.getenv("GTHREADS", "4")) + 2))),
+            "timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+            "max_idle": float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+            "max_lifetime": float(os.getenv("DB_POOL_MAX_LIFETIME", "1800")),
+        }
+    if DB_PGBOUNCER:
+        DATABASES["default"]["DISABLE_SERVER_SIDE_CURSORS"] = True
+        options["prepare_threshold"] = None
+
+# Read replicas: DB_REPLICA_HOSTS=host1,host2[:port]. Same credentials as the primary.
+DB_REPLICA_HOSTS = [h.strip() for h in os.getenv("DB_REPLICA_HOSTS", "").split(",") if h.strip()]
+for i, replica in enumerate(DB_REPLICA_HOSTS, start=1):
+    host, _, port = replica.partition(":")
+    DATABASES[f"replica{i}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"].get("PORT", ""),
+        "TEST": {"MIRROR": "default"},
+    }
+DB_REPLICAS = [f"replica{i}" for i in range(1, len(DB_REPLICA_HOSTS) + 1)]
+
+# Comment shards (comments/sharding.py): DB_SHARDS=host1,host2[:port] adds shard1..N
+# next to "default" (shard 0), same database name and credentials; with the SQLite
+# default every entry is a database file instead. Run `migrate --database shardN`.
+DB_SHARDS = [s.strip() for s in os.getenv("DB_SHARDS", "").split(",") if s.strip()]
+for i, shard in enumerate(DB_SHARDS, start=1):
+    if DATABASES["default"]["ENGINE"].endswith("sqlite3"):
+        DATABASES[f"shard{i}"] = {**DATABASES["default"], "NAME": BASE_DIR / shard}
+    else:
+        host, _, port = shard.partition(":")
+        DATABASES[f"shard{i}"] = {**DATABASES["default"], "HOST": host, "PORT": port or DATABASES["default"].get("PORT", "")}
+COMMENT_SHARDS = ["default", *(f"shard{i}" for i in range(1, len(DB_SHARDS) + 1))]
+# Comment ids are handed to each process in blocks of this many.
+COMMENT_ID_BLOCK = int(os.getenv("COMMENT_ID_BLOCK", "1000"))
+
+# `manage.py test`: test databases for a replica and two shards, used by tests that
+# switch them on with override_settings(DB_REPLICAS=[...]) / (COMMENT_SHARDS=[...]).
+if sys.argv[1:2] == ["test"]:
+    for alias in ("replica", "shard1", "shard2"):
+        test_name = None if DATABASES["default"]["ENGINE"].endswith("sqlite3") else f"test_{DATABASES['default']['NAME']}_{alias}"
+        DATABASES[alias] = {**DATABASES["default"], "TEST": {"NAME": test_name}}
+
+DATABASE_ROUTERS = ["comments.routers.PrimaryReplicaRouter"]
+# How long a client keeps reading from the primary after its own write.
+REPLICA_PIN_SECONDS = int(os.getenv("REPLICA_PIN_SECONDS", "10"))
+
+
+# Cache
+# Shared tier behind comments.cache; the per-process LRU sits in front of it.
+# CACHE_BACKEND=db (default; the table comes with `migrate`) | file; REDIS_URL wins if set.
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("REDIS_URL"),
+        }
+    }
+elif os.getenv("CACHE_BACKEND", "db") == "file":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.getenv("CACHE_LOCATION", "/tmp/comments-cache"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "comments_cache",
+        }
+    }
+
+CACHE_LOCAL_MAXSIZE = int(os.getenv("CACHE_LOCAL_MAXSIZE", "1024"))
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", "2"))
+# How long a worker trusts its copy of a cache version before re-reading it from the shared tier.
+CACHE_VERSION_TTL = float(os.getenv("CACHE_VERSION_TTL", "1"))
+
+# Monthly range partitioning of comments by created_at (Postgres only); must be
+# set when `migrate` runs. See comments/partitioning.py.
+COMMENTS_PARTITIONED = os.getenv("COMMENTS_PARTITIONED", "0") == "1"
+
+# GraphQL limits (comments/extensions.py): static query cost budget, nesting
+# depth and the largest pageSize Query.comments accepts.
+GRAPHQL_MAX_COST = int(os.getenv("GRAPHQL_MAX_COST", "300"))
+GRAPHQL_MAX_DEPTH = int(os.getenv("GRAPHQL_MAX_DEPTH", "8"))
+GRAPHQL_MAX_PAGE_SIZE = int(os.getenv("GRAPHQL_MAX_PAGE_SIZE", "100"))
+GRAPHQL_COST_ATTACHMENTS_PER_COMMENT = int(os.getenv("GRAPHQL_COST_ATTACHMENTS_PER_COMMENT", "1"))
+
+# Multi-file uploads (comments/uploads.py): process pool size and limits.
+UPLOAD_POOL_WORKERS = int(os.getenv("UPLOAD_POOL_WORKERS", "2"))
+UPLOAD_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", "10"))
+UPLOAD_MAX_FILE_SIZE = int(os.getenv("UPLOAD_MAX_FILE_SIZE", str(10 * 1024 * 1024)))
+
+# Time budgets per operation in ms (0 disables one): Postgres statement_timeout
+# for the operation's transaction plus deadline checks in sanitizing/thumbnailing.
+OPERATION_BUDGETS_MS = {
+    "comments": int(os.getenv("BUDGET_COMMENTS_MS", "500")),
+    "mutation": int(os.getenv("BUDGET_MUTATION_MS", "2000")),
+    "upload": int(os.getenv("BUDGET_UPLOAD_MS", "10000")),
+    "admin": int(os.getenv("BUDGET_ADMIN_MS", "5000")),
+}
+
+# Opt-in request profiler (comments/profiling.py): off unless PROFILING=1; then
+# requests with a signed X-Profile header or a random PROFILE_SAMPLE_RATE share.
+PROFILING = os.getenv("PROFILING", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_TOKEN_TTL = int(os.getenv("PROFILE_TOKEN_TTL", "3600"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", str(BASE_DIR / "profiles"))
+
+# gzip/Brotli for API responses from this many bytes (static files are WhiteNoise's).
+COMPRESS_PATHS = ("/graphql/", "/api/")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))
+
+# Signed attachment URLs are reused for this long (capped at half their expiry).
+FILE_URL_CACHE_TTL = int(os.getenv("FILE_URL_CACHE_TTL", "3600"))
+
+# Group concurrent comment inserts of a worker into one transaction (comments/coalescing.py).
+COMMENT_WRITE_COALESCING = os.getenv("COMMENT_WRITE_COALESCING", "0") == "1"
+COMMENT_COALESCE_WINDOW_MS = float(os.getenv("COMMENT_COALESCE_WINDOW_MS", "3"))
+COMMENT_COALESCE_MAX_BATCH = int(os.getenv("COMMENT_COALESCE_MAX_BATCH", "100"))
+
+# Section counters are spread over this many rows per section, so concurrent
+# inserts into one section don't queue on a single row (comments/namespaces.py).
+NAMESPACE_COUNTER_STRIPES = int(os.getenv("NAMESPACE_COUNTER_STRIPES", "16"))
+
+# Subtree deletes (comments/deletion.py): ids per delete transaction, and how
+# long soft-deleted subtrees are kept before purge_comments removes them.
+COMMENT_PURGE_BATCH = int(os.getenv("COMMENT_PURGE_BATCH", "1000"))
+COMMENT_TOMBSTONE_DAYS = float(os.getenv("COMMENT_TOMBSTONE_DAYS", "30"))
+
+# Admin changelists use the planner's row estimate above this many rows.
+ADMIN_EXACT_COUNT_LIMIT = int(os.getenv("ADMIN_EXACT_COUNT_LIMIT", "10000"))
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -194,14 +349,14 @@ if USE_GCS_MEDIA and GS_BUCKET_NAME:
     INSTALLED_APPS += ["storages"]
 
     STORAGES["default"] = {
-        "BACKEND": "storages.backends.gcloud.GoogleCloudStorage",
+        "BACKEND": "comments.storage.MediaStorage",
         "OPTIONS": {
             "bucket_name": GS_BUCKET_NAME,
             **({"location": os.getenv("GS_LOCATION")} if os.getenv("GS_LOCATION") else {}),
         },
     }
 
-    DEFAULT_FILE_STORAGE = "storages.backends.gcloud.GoogleCloudStorage"
+    DEFAULT_FILE_STORAGE = "comments.storage.MediaStorage"
 
     GS_QUERYSTRING_AUTH = os.getenv("GS_QUERYSTRING_AUTH", "0") == "1"
     GS_DEFAULT_ACL = None
@@ -22,13 +22,14 @@ from django.conf.urls.static import static
 from strawberry.django.views import GraphQLView
 
 from comments.schema import schema
-from comments.views import upload_attachment_view,captcha_json, captcha_image
+from comments.views import upload_attachment_view, upload_attachments_view, captcha_json, captcha_image
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path("graphql/", csrf_exempt(GraphQLView.as_view(schema=schema)), name="graphql"),
+    path("graphql/", csrf_exempt(GraphQLView.as_view(schema=schema, multipart_uploads_enabled=True)), name="graphql"),
     path("api/attachments/upload/", upload_attachment_view, name="upload-attachment"),
+    path("api/attachments/upload-many/", upload_attachments_view, name="upload-attachments"),
     path('api/captcha/', captcha_image),
     path('api/', include('comments.urls'))
 ]
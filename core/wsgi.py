@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_wsgi_application()
+
+if os.getenv("FAST_START") == "1":
+    # Import the URLconf (and the GraphQL schema) before gunicorn forks.
+    from django.urls import get_resolver
+
+    get_resolver().url_patterns
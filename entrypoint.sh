@@ -6,11 +6,18 @@ export WEB_CONCURRENCY="${WEB_CONCURRENCY:-2}"
 export GTHREADS="${GTHREADS:-4}"
 export GUNICORN_TIMEOUT="${GUNICORN_TIMEOUT:-120}"
 
-export MIGRATE_ON_START="${MIGRATE_ON_START:-1}"
+export FAST_START="${FAST_START:-0}"
 export MIGRATE_RETRIES="${MIGRATE_RETRIES:-15}"
 export MIGRATE_SLEEP="${MIGRATE_SLEEP:-3}"
 
-python manage.py collectstatic --noinput || true
+# FAST_START=1: static files and the migration check are baked into the image,
+# migrations run as a separate job, gunicorn preloads the app before forking.
+if [ "$FAST_START" = "1" ]; then
+  export MIGRATE_ON_START="${MIGRATE_ON_START:-0}"
+else
+  export MIGRATE_ON_START="${MIGRATE_ON_START:-1}"
+  python manage.py collectstatic --noinput || true
+fi
 
 if [ "$MIGRATE_ON_START" = "1" ]; then
   echo "Applying database migrations..."
@@ -27,6 +34,10 @@ if [ "$MIGRATE_ON_START" = "1" ]; then
   echo "Migrations applied successfully."
 fi
 
+if [ "$FAST_START" = "1" ]; then
+  exec gunicorn core.wsgi:application -c core/gunicorn_conf.py
+fi
+
 exec gunicorn core.wsgi:application \
   --bind 0.0.0.0:"$PORT" \
   --workers "$WEB_CONCURRENCY" \
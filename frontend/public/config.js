@@ -1,5 +1,6 @@
 window.__CONFIG__ = {
   API_BASE: "https://comments-backend-755819237934.europe-central2.run.app",
   GRAPHQL_URL: "/graphql/",
-  CAPTCHA_URL: "/api/captcha/"
+  CAPTCHA_URL: "/api/captcha/",
+  THREAD_KEY: ""
 };
\ No newline at end of file
@@ -22,4 +22,27 @@ export async function uploadAttachmentREST(commentId, file) {
     throw new Error(msg)
   }
   return data
-}
\ No newline at end of file
+}
+export async function uploadAttachmentsREST(commentId, files) {
+  if (!commentId) throw new Error('commentId is required')
+  if (!files || !files.length) return []
+
+  const fd = new FormData()
+  fd.append('commentId', String(commentId))
+  for (const f of files) fd.append('files', f)
+
+  const res = await fetch(`${API_BASE}/api/attachments/upload-many/`, {
+    method: 'POST',
+    body: fd,
+    credentials: 'include',
+  })
+
+  let data = null
+  try { data = await res.json() } catch (_) {}
+
+  if (!res.ok) {
+    const msg = (data && (data.error || data.detail)) || `HTTP ${res.status}`
+    throw new Error(msg)
+  }
+  return data.results
+}
@@ -3,6 +3,9 @@ import { createUploadLink } from 'apollo-upload-client';
 
 const graphqlURL = (window.__CONFIG__?.GRAPHQL_URL || '/graphql/').replace(/\/?$/, '/');
 
+// Comment section shown by this page; "" is the default one.
+export const THREAD_KEY = window.__CONFIG__?.THREAD_KEY || '';
+
 export const CAPTCHA_URL = ((window.__CONFIG__?.CAPTCHA_URL) || '/api/captcha/').replace(/\/?$/, '/');
 
 export const getCaptchaImageUrl = () => `${CAPTCHA_URL}image?ts=${Date.now()}`;
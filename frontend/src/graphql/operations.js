@@ -7,6 +7,7 @@ export const COMMENTS_QUERY = gql`
     $orderField: OrderField!
     $desc: Boolean!
     $parentId: ID
+    $threadKey: String
   ) {
     comments(
       page: $page
@@ -14,6 +15,7 @@ export const COMMENTS_QUERY = gql`
       orderField: $orderField
       desc: $desc
       parentId: $parentId
+      threadKey: $threadKey
     ) {
       count
       results {
@@ -34,6 +36,8 @@ export const COMMENTS_QUERY = gql`
           width
           height
           size
+          preview
+          lineCount
           __typename
         }
         __typename
@@ -63,6 +67,8 @@ export const CREATE_COMMENT_MUTATION = gql`
         width
         height
         size
+        preview
+        lineCount
         __typename
       }
       __typename